@@ -0,0 +1,188 @@
+'''
+    pcapgen.py
+    Generador de trazas pcap sintéticas y reproducibles (misma semilla => misma traza) para pruebas de
+    rendimiento. Permite elegir la mezcla de protocolos (Ethernet, ARP, IPv4/TCP, IPv4/UDP), la distribución
+    de tamaños de paquete, el número de flujos y la distribución de tiempos entre llegadas. Los paquetes se
+    escriben con pcap_writer, que agrupa las escrituras en bloques grandes.
+
+    Ejemplo:
+        python3 pcapgen.py --out traza.pcap --count 5000000 --seed 1 --mix tcp:6,udp:3,arp:1 --size imix --iat exp:10 --flows 1000
+
+    2020 EPS-UAM
+'''
+
+from rc1_pcap import *
+import sys
+import argparse
+from argparse import RawTextHelpFormatter
+import random
+import struct
+import time
+import logging
+
+ETH_FRAME_MAX = 1514
+ETH_FRAME_MIN = 60
+ETH_HDR_LEN = 14
+IP_HDR_LEN = 20
+TCP_HDR_LEN = 20
+UDP_HDR_LEN = 8
+ARP_LEN = 28
+#Ethertype de uso experimental local para las tramas Ethernet sin protocolo superior conocido
+ETHERTYPE_LOCAL = 0x88b5
+#Tamaños IMIX simple (tamaño de trama sin FCS, peso)
+IMIX = [(60,7),(590,4),(1514,1)]
+#Carga útil de relleno compartida por todos los paquetes
+PADDING = bytes(ETH_FRAME_MAX)
+
+
+def parse_mix(text):
+	#'tcp:6,udp:3,arp:1' -> (['tcp','udp','arp'], [6.0, 3.0, 1.0])
+	kinds = []
+	weights = []
+	for item in text.split(','):
+		kind,weight = item.split(':')
+		if kind not in ('eth','arp','tcp','udp'):
+			raise ValueError('Protocolo desconocido en la mezcla: {}'.format(kind))
+		kinds.append(kind)
+		weights.append(float(weight))
+	return kinds,weights
+
+
+def size_sampler(text,rng):
+	#Devuelve una función sin argumentos que genera tamaños de trama: fixed:N, uniform:A:B, imix o N1:P1,N2:P2...
+	parts = text.split(':')
+	if parts[0] == 'fixed':
+		n = int(parts[1])
+		return lambda: n
+	if parts[0] == 'uniform':
+		a,b = int(parts[1]),int(parts[2])
+		return lambda: rng.randint(a,b)
+	table = IMIX if text == 'imix' else [tuple(int(x) for x in item.split(':')) for item in text.split(',')]
+	sizes = [s for s,_ in table]
+	cum = []
+	acc = 0
+	for _,w in table:
+		acc += w
+		cum.append(acc)
+	return lambda: rng.choices(sizes,cum_weights=cum)[0]
+
+
+def iat_sampler(text,rng):
+	#Devuelve una función que genera tiempos entre llegadas en ns: const:US, exp:MEDIA_US (Poisson) o uniform:A_US:B_US
+	parts = text.split(':')
+	if parts[0] == 'const':
+		ns = int(float(parts[1]) * 1000)
+		return lambda: ns
+	if parts[0] == 'exp':
+		rate = 1 / (float(parts[1]) * 1000)
+		return lambda: int(rng.expovariate(rate))
+	if parts[0] == 'uniform':
+		a,b = int(float(parts[1]) * 1000),int(float(parts[2]) * 1000)
+		return lambda: rng.randint(a,b)
+	raise ValueError('Distribución de tiempos desconocida: {}'.format(text))
+
+
+def ip_checksum(hdr):
+	s = sum(struct.unpack('!10H',hdr))
+	s = (s & 0xffff) + (s >> 16)
+	s = (s & 0xffff) + (s >> 16)
+	return ~s & 0xffff
+
+
+class flow():
+	#Flujo entre dos equipos de la LAN simulada (10.0.0.0/8) con sus puertos y número de secuencia TCP
+	__slots__ = ('src_mac','dst_mac','src_ip','dst_ip','sport','dport','seq','ip_id')
+	def __init__(self,rng):
+		self.src_mac = bytes([0x02] + [rng.randrange(256) for _ in range(5)])
+		self.dst_mac = bytes([0x02] + [rng.randrange(256) for _ in range(5)])
+		self.src_ip = bytes([10] + [rng.randrange(256) for _ in range(3)])
+		self.dst_ip = bytes([10] + [rng.randrange(256) for _ in range(3)])
+		self.sport = rng.randrange(1024,65536)
+		self.dport = rng.choice((53,80,443,8080,rng.randrange(1024,65536)))
+		self.seq = rng.randrange(1 << 32)
+		self.ip_id = rng.randrange(1 << 16)
+
+
+def build_packet(kind,f,size):
+	#Construye una trama del tipo kind para el flujo f con tamaño total size (ajustado a los límites del protocolo)
+	if kind == 'arp':
+		arp = struct.pack('!HHBBH6s4s6s4s',1,0x0800,6,4,1,f.src_mac,f.src_ip,bytes(6),f.dst_ip)
+		frame = b'\xff' * 6 + f.src_mac + b'\x08\x06' + arp
+		return frame + PADDING[:ETH_FRAME_MIN - len(frame)]
+	if kind == 'eth':
+		size = max(ETH_FRAME_MIN,min(size,ETH_FRAME_MAX))
+		return f.dst_mac + f.src_mac + struct.pack('!H',ETHERTYPE_LOCAL) + PADDING[:size - ETH_HDR_LEN]
+	l4len = TCP_HDR_LEN if kind == 'tcp' else UDP_HDR_LEN
+	size = max(ETH_HDR_LEN + IP_HDR_LEN + l4len,min(size,ETH_FRAME_MAX))
+	iplen = size - ETH_HDR_LEN
+	paylen = iplen - IP_HDR_LEN - l4len
+	f.ip_id = (f.ip_id + 1) & 0xffff
+	ip = bytearray(struct.pack('!BBHHHBBH4s4s',0x45,0,iplen,f.ip_id,0x4000,64,6 if kind == 'tcp' else 17,0,f.src_ip,f.dst_ip))
+	struct.pack_into('!H',ip,10,ip_checksum(ip))
+	if kind == 'tcp':
+		#Checksum de nivel 4 a 0 (no se calcula para no penalizar la generación)
+		l4 = struct.pack('!HHIIBBHHH',f.sport,f.dport,f.seq,0,5 << 4,0x18,65535,0,0)
+		f.seq = (f.seq + paylen) & 0xffffffff
+	else:
+		l4 = struct.pack('!HHHH',f.sport,f.dport,UDP_HDR_LEN + paylen,0)
+	return f.dst_mac + f.src_mac + b'\x08\x00' + bytes(ip) + l4 + PADDING[:paylen]
+
+
+def generate(fname,count,seed=0,mix='tcp:6,udp:3,arp:1',size='imix',iat='exp:10',flows=100,start=1600000000.0,
+			 max_bytes=0):
+	'''
+		Escribe en fname una traza de count paquetes generada con la semilla seed. mix es la mezcla de protocolos
+		(eth, arp, tcp, udp con sus pesos), size la distribución de tamaños, iat la de tiempos entre llegadas y flows
+		el número de flujos entre los que se reparten los paquetes. Devuelve el número de bytes de paquetes escritos
+	'''
+	rng = random.Random(seed)
+	kinds,weights = parse_mix(mix)
+	cum = []
+	acc = 0
+	for w in weights:
+		acc += w
+		cum.append(acc)
+	next_size = size_sampler(size,rng)
+	next_iat = iat_sampler(iat,rng)
+	flow_list = [flow(rng) for _ in range(max(1,flows))]
+	ts = int(start * 1000000000)
+	total = 0
+	with pcap_writer(fname,DLT_EN10MB,ETH_FRAME_MAX,max_bytes=max_bytes) as writer:
+		for _ in range(count):
+			kind = rng.choices(kinds,cum_weights=cum)[0]
+			frame = build_packet(kind,rng.choice(flow_list),next_size())
+			writer.write(ts // 1000000000,ts % 1000000000 // 1000,frame)
+			total += len(frame)
+			ts += next_iat()
+	return total
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Genera trazas pcap sintéticas y reproducibles para pruebas de rendimiento',
+	formatter_class=RawTextHelpFormatter)
+	parser.add_argument('--out', dest='out', default='sintetica.pcap',help='Fichero pcap de salida')
+	parser.add_argument('--count', dest='count', type=int, default=1000000,help='Número de paquetes')
+	parser.add_argument('--seed', dest='seed', type=int, default=0,help='Semilla del generador aleatorio')
+	parser.add_argument('--mix', dest='mix', default='tcp:6,udp:3,arp:1',help='Mezcla de protocolos con pesos: eth, arp, tcp, udp (p.ej. tcp:6,udp:3,arp:1)')
+	parser.add_argument('--size', dest='size', default='imix',help='Tamaños de trama: fixed:N, uniform:A:B, imix o tabla N1:P1,N2:P2,...')
+	parser.add_argument('--iat', dest='iat', default='exp:10',help='Tiempos entre llegadas en us: const:T, exp:MEDIA o uniform:A:B')
+	parser.add_argument('--flows', dest='flows', type=int, default=100,help='Número de flujos')
+	parser.add_argument('--start', dest='start', type=float, default=1600000000.0,help='Timestamp UNIX del primer paquete')
+	parser.add_argument('--rotate-mb', dest='rotate_mb', type=int, default=0,help='Rotar el fichero de salida al alcanzar este tamaño en MB (0: sin límite)')
+	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
+	args = parser.parse_args()
+
+	if args.debug:
+		logging.basicConfig(level = logging.DEBUG, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+	else:
+		logging.basicConfig(level = logging.INFO, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+
+	try:
+		t0 = time.perf_counter()
+		total = generate(args.out, args.count, args.seed, args.mix, args.size, args.iat, args.flows, args.start,
+						 args.rotate_mb * 1024 * 1024)
+		elapsed = time.perf_counter() - t0
+	except ValueError as e:
+		logging.error(str(e))
+		sys.exit(-1)
+	logging.info('Escritos {} paquetes ({} bytes) en {:.2f} s ({:.0f} paquetes/s)'.format(args.count, total, elapsed, args.count / elapsed))
@@ -9,11 +9,13 @@
 
 from rc1_pcap import *
 import sys
+import os
 import binascii
 import signal
 import argparse
 from argparse import RawTextHelpFormatter
 import time
+import bisect
 import logging
 
 ETH_FRAME_MAX = 1514
@@ -23,6 +25,15 @@ NO_PROMISC = 0
 TO_MS = 10
 num_paquete = 0
 TIME_OFFSET = 30*60
+#Límites de los intervalos del histograma de tamaños del modo resumen
+SIZE_BOUNDS = [65,128,256,512,1024,1519]
+SIZE_LABELS = ['<=64','65-127','128-255','256-511','512-1023','1024-1518','>1518']
+#Salida estándar con buffer grande: se vuelca una vez por segundo de captura y no en cada paquete
+salida = open(sys.stdout.fileno(), 'w', buffering=1 << 16, closefd=False)
+segundo = None
+resumen = None
+#Modo ventana (--rolling-mb/--rolling-secs): se ha pedido volcar la ventana a disco
+instantanea_pedida = False
 
 def signal_handler(nsignal,frame):
 	logging.info('Control C pulsado')
@@ -30,19 +41,87 @@ def signal_handler(nsignal,frame):
 		pcap_breakloop(handle)
 
 
+def usr1_handler(nsignal,frame):
+	#Solo se marca la petición: el volcado se hace en el bucle de captura, fuera del manejador
+	global instantanea_pedida
+	instantanea_pedida = True
+
+
+def revisa_instantanea():
+	#Vuelca la ventana de paquetes a una traza si se ha pedido con SIGUSR1 o creando el fichero de disparo
+	global instantanea_pedida
+	if args.trigger is not False and os.path.exists(args.trigger):
+		try:
+			os.unlink(args.trigger)
+		except OSError:
+			pass
+		instantanea_pedida = True
+	if instantanea_pedida:
+		instantanea_pedida = False
+		fname = 'instantanea.{}.{}.pcap'.format(args.interface, time.time())
+		n = pdumper.snapshot(fname)
+		logging.info('{} paquetes volcados en {}'.format(n, fname))
+
+
+class resumen_segundo():
+	#Contadores del segundo en curso para el modo --output summary: paquetes, bytes e histograma de tamaños
+	def __init__(self,out):
+		self.out = out
+		self.sec = None
+		self.pkts = 0
+		self.bytes = 0
+		self.hist = [0] * len(SIZE_LABELS)
+
+	def add(self,length):
+		self.pkts += 1
+		self.bytes += length
+		self.hist[bisect.bisect_right(SIZE_BOUNDS,length)] += 1
+
+	def emit(self,sec):
+		#Escribe la línea del segundo acabado (si tuvo tráfico) y empieza a contar el segundo sec
+		if self.pkts > 0:
+			hist = ' '.join('{}:{}'.format(label,n) for label,n in zip(SIZE_LABELS,self.hist) if n)
+			self.out.write('{} {} pps {} bps {}\n'.format(self.sec,self.pkts,self.bytes * 8,hist))
+		self.sec = sec
+		self.pkts = 0
+		self.bytes = 0
+		self.hist = [0] * len(SIZE_LABELS)
+
+
+def revisa_reloj():
+	#Se llama en cada timeout de lectura: sin tráfico no llega ningún paquete que cierre el segundo, así que se
+	#cierra (y se vuelca la salida) cuando el reloj ya ha pasado de él
+	global segundo
+	if segundo is not None and time.time() >= segundo + 1:
+		if resumen is not None:
+			resumen.emit(None)
+		salida.flush()
+		segundo = None
+
+
 def procesa_paquete(us,header,data):
-	global num_paquete, pdumper, args
-	logging.info('Nuevo paquete de {} bytes capturado en el timestamp UNIX {}.{}'.format(header.len,header.ts.tv_sec,header.ts.tv_usec))
+	global num_paquete, pdumper, args, segundo
 	num_paquete += 1
-	#TODO imprimir los N primeros bytes
-	byteStr = ""
-	for i in range(min([args.nbytes, header.len])):
-		byteStr += '{:02X} '.format(data[i])
-	print(byteStr)
+	if header.ts.tv_sec != segundo:
+		#Cambio de segundo (según el timestamp de los paquetes): se cierra el resumen y se vuelca la salida
+		segundo = header.ts.tv_sec
+		if resumen is not None:
+			resumen.emit(segundo)
+		salida.flush()
+		if args.rolling:
+			revisa_instantanea()
+	if args.debug:
+		logging.debug('Nuevo paquete de {} bytes capturado en el timestamp UNIX {}.{:06d}'.format(header.len,header.ts.tv_sec,header.ts.tv_usec))
+	if resumen is not None:
+		resumen.add(header.len)
+	elif num_paquete % args.sample == 0:
+		#Los N primeros bytes en hexadecimal (uno de cada args.sample paquetes)
+		ts = header.ts
+		salida.write(linea.format(ts.tv_sec, ts.tv_nsec if args.nano else ts.tv_usec, header.len, memoryview(data)[:args.nbytes].hex(' ')))
 	#Escribir el tráfico al fichero de captura con el offset temporal
 	if pdumper is not None:
 		header.ts.tv_sec += TIME_OFFSET
-		pcap_dump(pdumper, header, data)
+		pdumper.dump(header, data)
 
 
 if __name__ == "__main__":
@@ -52,6 +131,24 @@ if __name__ == "__main__":
 	parser.add_argument('--file', dest='tracefile', default=False,help='Fichero pcap a abrir')
 	parser.add_argument('--itf', dest='interface', default=False,help='Interfaz a abrir')
 	parser.add_argument('--nbytes', dest='nbytes', type=int, default=16,help='Número de bytes a mostrar por paquete')
+	parser.add_argument('--snaplen', dest='snaplen', type=int, default=None,help='Número máximo de bytes a capturar por paquete (por defecto {}; con --transform sin recortar)'.format(ETH_FRAME_MAX))
+	parser.add_argument('--buffer-mb', dest='buffer_mb', type=int, default=0,help='Tamaño del buffer de captura del kernel en MB (0: valor por defecto)')
+	parser.add_argument('--immediate', dest='immediate', default=False, action='store_true',help='Entregar cada paquete en cuanto llega (modo inmediato)')
+	parser.add_argument('--rotate-mb', dest='rotate_mb', type=int, default=0,help='Rotar el fichero de volcado al alcanzar este tamaño en MB (0: sin límite)')
+	parser.add_argument('--rotate-pkts', dest='rotate_pkts', type=int, default=0,help='Rotar el fichero de volcado cada este número de paquetes (0: sin límite)')
+	parser.add_argument('--rotate-secs', dest='rotate_secs', type=int, default=0,help='Rotar el fichero de volcado cada este número de segundos (0: sin límite)')
+	parser.add_argument('--queue-mb', dest='queue_mb', type=int, default=0,help='Volcar a disco desde un hilo aparte a través de una cola de este tamaño en MB (0: volcado en el propio bucle de captura)')
+	parser.add_argument('--rolling-mb', dest='rolling_mb', type=int, default=0,help='No volcar a disco: guardar en memoria los últimos paquetes que quepan en estos MB y volcarlos al recibir SIGUSR1')
+	parser.add_argument('--rolling-secs', dest='rolling_secs', type=float, default=0,help='Como --rolling-mb pero guardando los paquetes de los últimos segundos indicados (con --rolling-mb limita también la memoria, por defecto 64 MB)')
+	parser.add_argument('--trigger', dest='trigger', default=False,help='En modo ventana, volcar también cuando aparezca este fichero (se borra tras el volcado)')
+	parser.add_argument('--tpacket', dest='tpacket', default=False, action='store_true',help='Capturar con el anillo TPACKET_V3 en lugar de libpcap')
+	parser.add_argument('--output', dest='output', choices=['hex','summary'], default='hex',help='Salida: hex (timestamp, longitud y primeros bytes de cada paquete) o summary (pps, bps e histograma de tamaños por segundo)')
+	parser.add_argument('--sample', dest='sample', type=int, default=1,help='En modo hex, mostrar solo uno de cada N paquetes')
+	parser.add_argument('--transform', dest='transform', default=False,help='Copiar la traza de --file a este fichero aplicando --time-offset, --snaplen, --first y --count')
+	parser.add_argument('--time-offset', dest='time_offset', type=float, default=0.0,help='Desplazamiento de los timestamps en segundos con --transform (por defecto 0)')
+	parser.add_argument('--first', dest='first', type=int, default=0,help='Primer paquete (desde 0) que se copia con --transform')
+	parser.add_argument('--count', dest='count', type=int, default=-1,help='Número de paquetes que se copian con --transform (-1: todos)')
+	parser.add_argument('--nano', dest='nano', default=False, action='store_true',help='Timestamps con precisión de nanosegundos (captura y volcado)')
 	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
 	args = parser.parse_args()
 
@@ -70,38 +167,107 @@ if __name__ == "__main__":
 		parser.print_help()
 		sys.exit(-1)
 
+	if args.sample < 1:
+		logging.error('--sample debe ser mayor que 0')
+		sys.exit(-1)
+
+	if args.transform is not False:
+		#Modo transformación: se reescribe la traza completa sin procesar cada paquete en Python
+		if args.tracefile is False:
+			logging.error('--transform necesita una traza de entrada (--file)')
+			sys.exit(-1)
+		t0 = time.perf_counter()
+		try:
+			n = pcap_transform(args.tracefile, args.transform, args.time_offset, args.snaplen or 0, args.first, args.count)
+		except (OSError, ValueError) as e:
+			logging.error('Error al transformar la traza: {}'.format(e))
+			sys.exit(-1)
+		elapsed = time.perf_counter() - t0
+		logging.info('{} paquetes escritos en {} en {:.2f} s'.format(n, args.transform, elapsed))
+		sys.exit(0)
+
+	if args.snaplen is None:
+		args.snaplen = ETH_FRAME_MAX
+
+	if args.queue_mb > 0 and (args.rotate_mb or args.rotate_pkts or args.rotate_secs):
+		logging.error('--queue-mb no admite rotación del fichero de volcado')
+		sys.exit(-1)
+
+	args.rolling = args.rolling_mb > 0 or args.rolling_secs > 0
+	if args.rolling and (args.interface is False or args.queue_mb > 0):
+		logging.error('El modo ventana necesita una interfaz (--itf) y no admite --queue-mb')
+		sys.exit(-1)
+
 	signal.signal(signal.SIGINT, signal_handler)
+	if args.rolling:
+		signal.signal(signal.SIGUSR1, usr1_handler)
+	linea = '{}.{:09d} {} {}\n' if args.nano else '{}.{:06d} {} {}\n'
+	if args.output == 'summary':
+		resumen = resumen_segundo(salida)
 
 	errbuf = bytearray()
 	handle = None
-	handle2 = None
 	pdumper = None
+	precision = PCAP_TSTAMP_PRECISION_NANO if args.nano else PCAP_TSTAMP_PRECISION_MICRO
 	
 	#TODO abrir la interfaz especificada para captura o la traza
 	if args.tracefile is not False:
-		handle = pcap_open_offline(args.tracefile, errbuf)
+		handle = pcap_open_offline_with_tstamp_precision(args.tracefile, precision, errbuf)
 	else:
-		handle = pcap_open_live(args.interface, ETH_FRAME_MAX, PROMISC, TO_MS, errbuf)
+		if args.tpacket:
+			handle = tpacket_open_live(args.interface, args.snaplen, PROMISC, TO_MS, errbuf)
+		else:
+			handle = pcap_open_live_ext(args.interface, args.snaplen, PROMISC, TO_MS, errbuf, args.buffer_mb*1024*1024, args.immediate, precision)
+	if handle is None:
+		logging.error('Error al abrir la captura: {}'.format(errbuf.decode('ascii', 'replace')))
+		sys.exit(-1)
 	#TODO abrir un dumper para volcar el tráfico (si se ha especificado interfaz) 
-	if args.interface is not False:
-		handle2 = pcap_open_dead(ETH_LINKTYPE, ETH_FRAME_MAX)
-		pdumper = pcap_dump_open(handle2, 'captura.{}.{}.pcap'.format(args.interface, time.time()))
-
-
-	ret = pcap_loop(handle,-1,procesa_paquete,None)
-	if ret == -1:
-		logging.error('Error al capturar un paquete')
-	elif ret == -2:
-		logging.debug('pcap_breakloop() llamado')
-	elif ret == 0:
-		logging.debug('No mas paquetes o limite superado')
+	if args.rolling:
+		#Memoria fija: los paquetes se quedan en la ventana y solo se escriben al pedir una instantánea
+		pdumper = pcap_rolling_buffer((args.rolling_mb or 64)*1024*1024, args.rolling_secs, args.snaplen, ETH_LINKTYPE,
+			precision=precision)
+		logging.info('Modo ventana: kill -USR1 {} para volcar los últimos paquetes'.format(os.getpid()))
+	elif args.interface is not False and args.queue_mb > 0:
+		#El callback solo encola; un hilo escritor vuelca la cola a disco y si se llena se descartan paquetes
+		pdumper = pcap_ring_writer('captura.{}.{}.pcap'.format(args.interface, time.time()), ETH_LINKTYPE, args.snaplen,
+			ring_size=args.queue_mb*1024*1024, precision=precision)
+	elif args.interface is not False:
+		pdumper = pcap_writer('captura.{}.{}.pcap'.format(args.interface, time.time()), ETH_LINKTYPE, args.snaplen,
+			max_bytes=args.rotate_mb*1024*1024, max_packets=args.rotate_pkts, max_seconds=args.rotate_secs, precision=precision)
+
+
+	#Lectura de paquetes bajo demanda con pcap_next_ex (termina al final de la traza o con pcap_breakloop)
+	try:
+		#Los timeouts de lectura (cada TO_MS sin paquetes) sirven para cerrar el segundo en curso y, en modo ventana,
+		#para atender las peticiones de volcado sin tráfico
+		for item in pcap_capture(handle, timeouts=True):
+			if item is None:
+				revisa_reloj()
+				if args.rolling:
+					revisa_instantanea()
+				continue
+			procesa_paquete(None, item[0], item[1])
+		logging.debug('No mas paquetes o pcap_breakloop() llamado')
+	except RuntimeError as e:
+		logging.error('Error al capturar un paquete: {}'.format(e))
+	if resumen is not None:
+		resumen.emit(None)
+	salida.flush()
 	logging.info('{} paquetes procesados'.format(num_paquete))
+	#Estadísticas de la captura (paquetes descartados por libpcap/kernel y tiempo de procesado por paquete)
+	print(pcap_get_stats(handle))
 	
 	#TODO si se ha creado un dumper cerrarlo
-	if pdumper is not None:
-		pcap_dump_close(pdumper)
+	if args.rolling:
+		print(pdumper)
+	elif pdumper is not None:
+		#close relanza el error que haya tenido el hilo escritor (p.ej. disco lleno); se informa y se sigue cerrando
+		try:
+			pdumper.close()
+		except OSError as e:
+			logging.error('Error al escribir la traza: {}'.format(e))
+		if args.queue_mb > 0:
+			print(pdumper.stats())
 	if handle is not None:
 		pcap_close(handle)
-	if handle2 is not None:
-		pcap_close(handle2)
 
@@ -5,7 +5,7 @@
     2020
     V0.2
 '''
-import ctypes,sys
+import ctypes,sys,os,mmap,struct,heapq,time,socket,select,asyncio,errno,multiprocessing,queue,array,bisect,threading
 from ctypes.util import find_library
 from typing import Callable
 
@@ -14,21 +14,13 @@ from typing import Callable
 
 
 
-user_callback = None
 
 DLT_EN10MB = 1
 
-def mycallback(us,h,data):
-    header = pcap_pkthdr ()
-    header.len = h[0].len
-    header.caplen = h[0].caplen
-    header.ts = timeval(h[0].tv_sec,h[0].tv_usec)
-    if user_callback is not None:
-        user_callback (us,header,bytes(data[:header.caplen]))
-
 
 
 pcap = ctypes.cdll.LoadLibrary("libpcap.so")
+libc = ctypes.CDLL(find_library("c"),use_errno=True)
 
 
 
@@ -37,21 +29,1656 @@ pcap = ctypes.cdll.LoadLibrary("libpcap.so")
 
 
 class timeval():
-    def __init__(self,tv_sec,tv_usec):
+    #__slots__: se crea uno por paquete, así ocupa menos y se crea más rápido que un objeto con __dict__.
+    #Internamente se guardan nanosegundos; tv_usec se mantiene como propiedad para el código existente
+    __slots__ = ('tv_sec','tv_nsec')
+    def __init__(self,tv_sec,tv_usec=0,tv_nsec=None):
         self.tv_sec = tv_sec
-        self.tv_usec = tv_usec
+        self.tv_nsec = tv_usec * 1000 if tv_nsec is None else tv_nsec
+
+    @property
+    def tv_usec(self) -> int:
+        return self.tv_nsec // 1000
+
+    @tv_usec.setter
+    def tv_usec(self,value:int):
+        self.tv_nsec = value * 1000
+
+    @property
+    def ts_ns(self) -> int:
+        #Timestamp como un único entero de nanosegundos
+        return self.tv_sec * 1000000000 + self.tv_nsec
 
 class pcap_pkthdr():
+    __slots__ = ('len','caplen','ts')
+    def __init__(self,len=0,caplen=0,ts=None):
+        self.len=len
+        self.caplen=caplen
+        self.ts=timeval(0,0) if ts is None else ts
+
+    @property
+    def ts_ns(self) -> int:
+        return self.ts.ts_ns
+
+class pcap_columns():
+    '''
+        Lote de paquetes en columnas en lugar de un objeto pcap_pkthdr por paquete: arrays paralelos con el
+        timestamp en ns ('q'), caplen y len ('I') y el desplazamiento de los datos de cada paquete ('q') dentro
+        del buffer data. Lo rellenan pcap_dispatch_columns y pcap_mmap_reader.columns sin crear objetos por paquete.
+    '''
+    __slots__ = ('ts_ns','caplen','len','offset','data')
     def __init__(self):
-        self.len=0
-        self.caplen=0
-        self.ts=timeval(0,0)
+        self.ts_ns = array.array('q')
+        self.caplen = array.array('I')
+        self.len = array.array('I')
+        self.offset = array.array('q')
+        self.data = None
+
+    def __len__(self):
+        return len(self.ts_ns)
+
+    def packet(self,i:int) -> memoryview:
+        #Datos del paquete i (memoryview sobre data, sin copia)
+        off = self.offset[i]
+        return memoryview(self.data)[off:off + self.caplen[i]]
+
+    def header(self,i:int) -> pcap_pkthdr:
+        ts = self.ts_ns[i]
+        return pcap_pkthdr(self.len[i],self.caplen[i],timeval(ts // 1000000000,tv_nsec=ts % 1000000000))
+
+    def clear(self):
+        for col in (self.ts_ns,self.caplen,self.len,self.offset):
+            del col[:]
+        self.data = None
 
 class pcappkthdr(ctypes.Structure):
     _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long), ("caplen", ctypes.c_uint32), ("len", ctypes.c_uint32)]
 
+class bpf_insn(ctypes.Structure):
+    _fields_ = [("code", ctypes.c_ushort), ("jt", ctypes.c_ubyte), ("jf", ctypes.c_ubyte), ("k", ctypes.c_uint32)]
+
+class iovec(ctypes.Structure):
+    #iov_base como c_char_p: al asignar un objeto bytes se apunta a su buffer sin copiarlo
+    _fields_ = [("iov_base", ctypes.c_char_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32), ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t), ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+class bpf_program(ctypes.Structure):
+    _fields_ = [("bf_len", ctypes.c_uint), ("bf_insns", ctypes.POINTER(bpf_insn))]
+
+#Códigos de retorno de libpcap
+PCAP_ERROR = -1
+PCAP_ERROR_BREAK = -2
+
+#Precisión de los timestamps (pcap_set_tstamp_precision)
+PCAP_TSTAMP_PRECISION_MICRO = 0
+PCAP_TSTAMP_PRECISION_NANO = 1
+
+#Máscara de red para pcap_compile cuando no se conoce la de la interfaz
+PCAP_NETMASK_UNKNOWN = 0xffffffff
+
+class pcap_stat(ctypes.Structure):
+    _fields_ = [("ps_recv", ctypes.c_uint), ("ps_drop", ctypes.c_uint), ("ps_ifdrop", ctypes.c_uint)]
+
+#Número de intervalos del histograma de tiempos de procesado por paquete. El intervalo i cuenta los
+#paquetes que tardaron entre 2^(i-1) y 2^i nanosegundos (el último acumula todos los mayores)
+STATS_HIST_BUCKETS = 40
+
+class pcap_capture_stats():
+    '''
+        Instantánea de las estadísticas de una captura: contadores de libpcap (recv, drop, ifdrop; None si no
+        están disponibles, por ejemplo en trazas), paquetes y bytes entregados a Python e histograma del tiempo
+        que tarda el código de usuario en procesar cada paquete. Si los paquetes pasan por una cola de procesado
+        (p.ej. el conjunto de hilos del nivel Ethernet) queue_depth, queue_high y queue_drops indican su ocupación
+        actual y máxima y los paquetes descartados por tenerla llena.
+    '''
+    def __init__(self):
+        self.recv = None
+        self.drop = None
+        self.ifdrop = None
+        self.queue_depth = None
+        self.queue_high = None
+        self.queue_drops = None
+        self.packets = 0
+        self.bytes = 0
+        self.histogram = [0] * STATS_HIST_BUCKETS
+
+    def __str__(self):
+        lines = []
+        if self.recv is not None:
+            lines.append('libpcap: {} recibidos, {} descartados, {} descartados por la interfaz'.format(self.recv,self.drop,self.ifdrop))
+        lines.append('Python: {} paquetes, {} bytes'.format(self.packets,self.bytes))
+        if self.queue_depth is not None:
+            lines.append('Cola de procesado: {} en cola, máximo {}, {} descartados'.format(self.queue_depth,self.queue_high,self.queue_drops))
+        if any(self.histogram):
+            lines.append('Tiempo de procesado por paquete:')
+            for i,n in enumerate(self.histogram):
+                if n:
+                    lines.append('  < {:>12} ns: {}'.format(1 << i,n) if i < STATS_HIST_BUCKETS - 1 else '  >= {:>11} ns: {}'.format(1 << (i - 1),n))
+        return '\n'.join(lines)
+
+    def add(self,other:'pcap_capture_stats'):
+        #Acumula en este objeto las estadísticas de otra captura (p.ej. de cada proceso de pcap_fanout)
+        for name in ('recv','drop','ifdrop'):
+            if getattr(other,name) is not None:
+                setattr(self,name,(getattr(self,name) or 0) + getattr(other,name))
+        self.packets += other.packets
+        self.bytes += other.bytes
+        self.histogram = [a + b for a,b in zip(self.histogram,other.histogram)]
+
+#  typedef void (*pcap_handler)(u_char *user, const struct pcap_pkthdr *h,const u_char *bytes);
+PCAP_HANDLER = ctypes.CFUNCTYPE(None, ctypes.c_void_p,ctypes.POINTER(pcappkthdr),ctypes.POINTER(ctypes.c_ubyte))
+
+#Prototipos de las funciones de libpcap y libc. Se declaran una única vez al importar el módulo
+#pcap_t *pcap_open_offline(const char *fname, char *errbuf);
+pcap.pcap_open_offline.argtypes = [ctypes.c_char_p,ctypes.c_char_p]
+pcap.pcap_open_offline.restype = ctypes.c_void_p
+#pcap_t *pcap_open_dead(int linktype, int snaplen)
+pcap.pcap_open_dead.argtypes = [ctypes.c_int,ctypes.c_int]
+pcap.pcap_open_dead.restype = ctypes.c_void_p
+#pcap_t *pcap_open_offline_with_tstamp_precision(const char *fname, u_int precision, char *errbuf);
+pcap.pcap_open_offline_with_tstamp_precision.argtypes = [ctypes.c_char_p,ctypes.c_uint,ctypes.c_char_p]
+pcap.pcap_open_offline_with_tstamp_precision.restype = ctypes.c_void_p
+#pcap_t *pcap_open_dead_with_tstamp_precision(int linktype, int snaplen, u_int precision);
+pcap.pcap_open_dead_with_tstamp_precision.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.c_uint]
+pcap.pcap_open_dead_with_tstamp_precision.restype = ctypes.c_void_p
+#pcap_t *pcap_open_live(const char *device, int snaplen,int promisc, int to_ms, char *errbuf)
+pcap.pcap_open_live.argtypes = [ctypes.c_char_p,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_char_p]
+pcap.pcap_open_live.restype = ctypes.c_void_p
+#void pcap_close(pcap_t *p);
+pcap.pcap_close.argtypes = [ctypes.c_void_p]
+pcap.pcap_close.restype = None
+#int pcap_snapshot(pcap_t *p);
+pcap.pcap_snapshot.argtypes = [ctypes.c_void_p]
+pcap.pcap_snapshot.restype = ctypes.c_int
+#char *pcap_geterr(pcap_t *p);
+pcap.pcap_geterr.argtypes = [ctypes.c_void_p]
+pcap.pcap_geterr.restype = ctypes.c_char_p
+#pcap_dumper_t *pcap_dump_open(pcap_t *p, const char *fname);
+pcap.pcap_dump_open.argtypes = [ctypes.c_void_p,ctypes.c_char_p]
+pcap.pcap_dump_open.restype = ctypes.c_void_p
+#pcap_dumper_t *pcap_dump_fopen(pcap_t *p, FILE *fp);
+pcap.pcap_dump_fopen.argtypes = [ctypes.c_void_p,ctypes.c_void_p]
+pcap.pcap_dump_fopen.restype = ctypes.c_void_p
+#void pcap_dump(u_char *user, struct pcap_pkthdr *h,u_char *sp);
+pcap.pcap_dump.argtypes = [ctypes.c_void_p,ctypes.POINTER(pcappkthdr),ctypes.c_char_p]
+pcap.pcap_dump.restype = None
+#int pcap_dump_flush(pcap_dumper_t *p);
+pcap.pcap_dump_flush.argtypes = [ctypes.c_void_p]
+pcap.pcap_dump_flush.restype = ctypes.c_int
+#long pcap_dump_ftell(pcap_dumper_t *p);
+pcap.pcap_dump_ftell.argtypes = [ctypes.c_void_p]
+pcap.pcap_dump_ftell.restype = ctypes.c_long
+#void pcap_dump_close(pcap_dumper_t *p);
+pcap.pcap_dump_close.argtypes = [ctypes.c_void_p]
+pcap.pcap_dump_close.restype = None
+#const u_char *pcap_next(pcap_t *p, struct pcap_pkthdr *h)
+pcap.pcap_next.argtypes = [ctypes.c_void_p,ctypes.POINTER(pcappkthdr)]
+pcap.pcap_next.restype = ctypes.POINTER(ctypes.c_ubyte)
+#int pcap_next_ex(pcap_t *p, struct pcap_pkthdr **pkt_header, const u_char **pkt_data);
+pcap.pcap_next_ex.argtypes = [ctypes.c_void_p,ctypes.POINTER(ctypes.POINTER(pcappkthdr)),ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte))]
+pcap.pcap_next_ex.restype = ctypes.c_int
+#int pcap_loop(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
+pcap.pcap_loop.argtypes = [ctypes.c_void_p,ctypes.c_int,PCAP_HANDLER,ctypes.c_void_p]
+pcap.pcap_loop.restype = ctypes.c_int
+#int pcap_dispatch(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
+pcap.pcap_dispatch.argtypes = [ctypes.c_void_p,ctypes.c_int,PCAP_HANDLER,ctypes.c_void_p]
+pcap.pcap_dispatch.restype = ctypes.c_int
+#void pcap_breakloop(pcap_t *);
+pcap.pcap_breakloop.argtypes = [ctypes.c_void_p]
+pcap.pcap_breakloop.restype = None
+#int pcap_inject(pcap_t *p, const void *buf, size_t size);
+pcap.pcap_inject.argtypes = [ctypes.c_void_p,ctypes.c_char_p,ctypes.c_size_t]
+pcap.pcap_inject.restype = ctypes.c_int
+#pcap_t *pcap_create(const char *source, char *errbuf);
+pcap.pcap_create.argtypes = [ctypes.c_char_p,ctypes.c_char_p]
+pcap.pcap_create.restype = ctypes.c_void_p
+#int pcap_set_snaplen(pcap_t *p, int snaplen);
+pcap.pcap_set_snaplen.argtypes = [ctypes.c_void_p,ctypes.c_int]
+pcap.pcap_set_snaplen.restype = ctypes.c_int
+#int pcap_set_promisc(pcap_t *p, int promisc);
+pcap.pcap_set_promisc.argtypes = [ctypes.c_void_p,ctypes.c_int]
+pcap.pcap_set_promisc.restype = ctypes.c_int
+#int pcap_set_timeout(pcap_t *p, int to_ms);
+pcap.pcap_set_timeout.argtypes = [ctypes.c_void_p,ctypes.c_int]
+pcap.pcap_set_timeout.restype = ctypes.c_int
+#int pcap_set_buffer_size(pcap_t *p, int buffer_size);
+pcap.pcap_set_buffer_size.argtypes = [ctypes.c_void_p,ctypes.c_int]
+pcap.pcap_set_buffer_size.restype = ctypes.c_int
+#int pcap_set_immediate_mode(pcap_t *p, int immediate_mode);
+pcap.pcap_set_immediate_mode.argtypes = [ctypes.c_void_p,ctypes.c_int]
+pcap.pcap_set_immediate_mode.restype = ctypes.c_int
+#int pcap_set_tstamp_precision(pcap_t *p, int tstamp_precision);
+pcap.pcap_set_tstamp_precision.argtypes = [ctypes.c_void_p,ctypes.c_int]
+pcap.pcap_set_tstamp_precision.restype = ctypes.c_int
+#int pcap_activate(pcap_t *p);
+pcap.pcap_activate.argtypes = [ctypes.c_void_p]
+pcap.pcap_activate.restype = ctypes.c_int
+#const char *pcap_statustostr(int error);
+pcap.pcap_statustostr.argtypes = [ctypes.c_int]
+pcap.pcap_statustostr.restype = ctypes.c_char_p
+#int pcap_stats(pcap_t *p, struct pcap_stat *ps);
+pcap.pcap_stats.argtypes = [ctypes.c_void_p,ctypes.POINTER(pcap_stat)]
+pcap.pcap_stats.restype = ctypes.c_int
+#int pcap_compile(pcap_t *p, struct bpf_program *fp, const char *str, int optimize, bpf_u_int32 netmask);
+pcap.pcap_compile.argtypes = [ctypes.c_void_p,ctypes.POINTER(bpf_program),ctypes.c_char_p,ctypes.c_int,ctypes.c_uint32]
+pcap.pcap_compile.restype = ctypes.c_int
+#int pcap_setfilter(pcap_t *p, struct bpf_program *fp);
+pcap.pcap_setfilter.argtypes = [ctypes.c_void_p,ctypes.POINTER(bpf_program)]
+pcap.pcap_setfilter.restype = ctypes.c_int
+#void pcap_freecode(struct bpf_program *fp);
+pcap.pcap_freecode.argtypes = [ctypes.POINTER(bpf_program)]
+pcap.pcap_freecode.restype = None
+#int pcap_get_selectable_fd(pcap_t *p);
+pcap.pcap_get_selectable_fd.argtypes = [ctypes.c_void_p]
+pcap.pcap_get_selectable_fd.restype = ctypes.c_int
+#int pcap_setnonblock(pcap_t *p, int nonblock, char *errbuf);
+pcap.pcap_setnonblock.argtypes = [ctypes.c_void_p,ctypes.c_int,ctypes.c_char_p]
+pcap.pcap_setnonblock.restype = ctypes.c_int
+#int pcap_getnonblock(pcap_t *p, char *errbuf);
+pcap.pcap_getnonblock.argtypes = [ctypes.c_void_p,ctypes.c_char_p]
+pcap.pcap_getnonblock.restype = ctypes.c_int
+#FILE *fmemopen(void *buf, size_t size, const char *mode);
+libc.fmemopen.argtypes = [ctypes.c_void_p,ctypes.c_size_t,ctypes.c_char_p]
+libc.fmemopen.restype = ctypes.c_void_p
+#int fseek(FILE *stream, long offset, int whence);
+libc.fseek.argtypes = [ctypes.c_void_p,ctypes.c_long,ctypes.c_int]
+libc.fseek.restype = ctypes.c_int
+#int fclose(FILE *stream);
+libc.fclose.argtypes = [ctypes.c_void_p]
+libc.fclose.restype = ctypes.c_int
+#int sendmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen, int flags);
+libc.sendmmsg.argtypes = [ctypes.c_int,ctypes.POINTER(mmsghdr),ctypes.c_uint,ctypes.c_int]
+libc.sendmmsg.restype = ctypes.c_int
+
+#pcap_dump como pcap_handler, para que pcap_dispatch_batch vuelque los paquetes sin pasar por Python
+pcap_dump_handler = ctypes.cast(pcap.pcap_dump,PCAP_HANDLER)
+
+
+class pcap_handle():
+    '''
+        Descriptor de captura devuelto por las funciones pcap_open_*. Envuelve el pcap_t de libpcap y guarda su propio
+        callback de usuario y su propio trampolín C (creado una sola vez), de forma que varias capturas pueden
+        ejecutarse a la vez en hilos distintos sin pisarse. Gracias a _as_parameter_ el objeto se pasa directamente
+        a las funciones de libpcap.
+    '''
+    def __init__(self,p:int):
+        self._as_parameter_ = ctypes.c_void_p(p)
+        self.callback = None
+        self.user = None
+        self.batch = None
+        #Con precisión de nanosegundos libpcap entrega nanosegundos en el campo tv_usec; ts_mult lo pasa a ns
+        self.precision = PCAP_TSTAMP_PRECISION_MICRO
+        self.ts_mult = 1000
+        self.trampoline = PCAP_HANDLER(self.handler)
+        #Punteros de salida reutilizados por pcap_next_ex
+        self.next_hdr = ctypes.POINTER(pcappkthdr)()
+        self.next_data = ctypes.POINTER(ctypes.c_ubyte)()
+        #Contadores del lado Python. Solo los modifica el hilo de captura; stats() puede llamarse desde cualquier hilo
+        self.packets = 0
+        self.bytes = 0
+        self.histogram = [0] * STATS_HIST_BUCKETS
+        #pcap_async_reader que está leyendo el descriptor (pcap_breakloop lo despierta)
+        self.async_reader = None
+
+    def __bool__(self):
+        return self._as_parameter_.value is not None
+
+    def handler(self,us,h,data):
+        hdr = h[0]
+        header = pcap_pkthdr(hdr.len,hdr.caplen,timeval(hdr.tv_sec,tv_nsec=hdr.tv_usec * self.ts_mult))
+        t0 = time.perf_counter_ns()
+        self.callback(self.user,header,ctypes.string_at(data,hdr.caplen))
+        self.record(hdr.caplen,time.perf_counter_ns() - t0)
+
+    def record(self,caplen:int,elapsed_ns:int):
+        self.packets += 1
+        self.bytes += caplen
+        self.histogram[min(elapsed_ns.bit_length(),STATS_HIST_BUCKETS - 1)] += 1
+
+    def loop(self,cnt:int,callback_fun,user) -> int:
+        self.callback = callback_fun
+        self.user = user
+        try:
+            return pcap.pcap_loop(self,cnt,self.trampoline,None)
+        finally:
+            self.callback = None
+            self.user = None
+
+    def dispatch(self,cnt:int,callback_fun,user) -> int:
+        self.callback = callback_fun
+        self.user = user
+        try:
+            return pcap.pcap_dispatch(self,cnt,self.trampoline,None)
+        finally:
+            self.callback = None
+            self.user = None
+
+    def next_ex(self) -> tuple:
+        #Devuelve (ret, header, data) donde ret es el retorno de pcap_next_ex: 1 si hay paquete, 0 si vence el
+        #timeout, PCAP_ERROR_BREAK al final de la traza o tras pcap_breakloop y PCAP_ERROR si hay un error
+        ret = pcap.pcap_next_ex(self,ctypes.byref(self.next_hdr),ctypes.byref(self.next_data))
+        if ret != 1:
+            return ret,None,None
+        hdr = self.next_hdr[0]
+        header = pcap_pkthdr(hdr.len,hdr.caplen,timeval(hdr.tv_sec,tv_nsec=hdr.tv_usec * self.ts_mult))
+        return ret,header,ctypes.string_at(self.next_data,hdr.caplen)
+
+    def stats(self) -> pcap_capture_stats:
+        st = pcap_capture_stats()
+        ps = pcap_stat()
+        if self and pcap.pcap_stats(self,ctypes.byref(ps)) == 0:
+            st.recv = ps.ps_recv
+            st.drop = ps.ps_drop
+            st.ifdrop = ps.ps_ifdrop
+        st.packets = self.packets
+        st.bytes = self.bytes
+        st.histogram = list(self.histogram)
+        return st
+
+    def breakloop(self):
+        pcap.pcap_breakloop(self)
+
+    def setfilter(self,filter:str) -> int:
+        #Compila el filtro BPF y lo instala en el descriptor (en el kernel si la plataforma lo permite)
+        program = bpf_program()
+        if pcap_compile(self,program,filter,1,PCAP_NETMASK_UNKNOWN) != 0:
+            return -1
+        ret = pcap_setfilter(self,program)
+        pcap_freecode(program)
+        return ret
+
+    def geterr(self) -> str:
+        return pcap.pcap_geterr(self).decode('ascii','replace')
+
+    def fileno(self) -> int:
+        return pcap.pcap_get_selectable_fd(self)
+
+    def set_precision(self,precision:int):
+        self.precision = precision
+        self.ts_mult = 1 if precision == PCAP_TSTAMP_PRECISION_NANO else 1000
+
+    def setnonblock(self,nonblock:int,errbuf:bytearray) -> int:
+        eb = ctypes.create_string_buffer(256)
+        ret = pcap.pcap_setnonblock(self,nonblock,eb)
+        errbuf.extend(bytes(format(eb.value).encode('ascii')))
+        return ret
+
+    def getnonblock(self,errbuf:bytearray) -> int:
+        eb = ctypes.create_string_buffer(256)
+        ret = pcap.pcap_getnonblock(self,eb)
+        errbuf.extend(bytes(format(eb.value).encode('ascii')))
+        return ret
+
+    def close(self):
+        if self.batch is not None:
+            self.batch.close()
+            self.batch = None
+        if self:
+            pcap.pcap_close(self)
+            self._as_parameter_ = ctypes.c_void_p(None)
+        self.trampoline = None
+
+#Formato de fichero pcap clásico (ver pcap-savefile(5))
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_SWAPPED = 0xd4c3b2a1
+#Trazas con timestamps en nanosegundos
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_MAGIC_NSEC_SWAPPED = 0x4d3cb2a1
+PCAP_FILE_HDR_LEN = 24
+PCAP_REC_HDR_LEN = 16
+
+#Índice auxiliar (fichero traza.pcap.idx) para acceso aleatorio a trazas pcap clásicas
+PCAP_INDEX_MAGIC = b'RC1PIDX1'
+#magic, tamaño y mtime (ns) de la traza indexada, paso, entradas y paquetes totales
+PCAP_INDEX_HDR = struct.Struct('<8sQqIQQ')
+PCAP_INDEX_STEP = 1000
+
+#pcap_parallel_reduce sin índice: tamaño mínimo de cada trozo y registros consecutivos que deben ser coherentes
+#para aceptar un desplazamiento como inicio de registro al resincronizar (pcap_mmap_reader.resync)
+PCAP_REDUCE_MIN_CHUNK = 1 << 20
+PCAP_SYNC_RECORDS = 8
+#Máxima diferencia (s) entre los timestamps de dos registros consecutivos al resincronizar
+PCAP_SYNC_MAX_GAP = 86400
+#Máxima longitud original de un paquete que se acepta al resincronizar (el snaplen máximo de libpcap)
+PCAP_SYNC_MAX_LEN = 0x40000
+
+class pcap_mmap_reader():
+    '''
+        Lector de trazas pcap clásicas que no pasa por libpcap. El fichero se mapea en memoria y
+        se recorren directamente las cabeceras de cada registro. Cada paquete se devuelve como una tupla
+        (ts_sec, ts_usec, caplen, len, data) en la que data es un memoryview sobre el propio fichero,
+        por lo que no se copia ningún byte. Los memoryview solo son válidos hasta llamar a close().
+        Igual que pcap_open_offline_with_tstamp_precision, la fracción de segundo se devuelve en la precisión
+        pedida (microsegundos o nanosegundos) sea cual sea la de la traza (file_precision).
+    '''
+    def __init__(self,fname:str,precision:int=PCAP_TSTAMP_PRECISION_MICRO):
+        if fname is None:
+            raise ValueError("El objeto fname no puede ser None")
+        self.fname = fname
+        self.file = open(fname,'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            #mmap no permite mapear ficheros vacíos
+            self.file.close()
+            raise ValueError("El fichero {} está vacío".format(fname))
+        self.view = memoryview(self.mm)
+        if len(self.mm) < PCAP_FILE_HDR_LEN:
+            self.close()
+            raise ValueError("El fichero {} no es una traza pcap".format(fname))
+        magic = struct.unpack_from('<I',self.mm,0)[0]
+        self.file_precision = PCAP_TSTAMP_PRECISION_MICRO
+        if magic in (PCAP_MAGIC_NSEC,PCAP_MAGIC_NSEC_SWAPPED):
+            self.file_precision = PCAP_TSTAMP_PRECISION_NANO
+        if magic in (PCAP_MAGIC,PCAP_MAGIC_NSEC):
+            self.endian = '<'
+        elif magic in (PCAP_MAGIC_SWAPPED,PCAP_MAGIC_NSEC_SWAPPED):
+            self.endian = '>'
+        else:
+            self.close()
+            raise ValueError("El fichero {} no es una traza pcap".format(fname))
+        self.version_major,self.version_minor,_,_,self.snaplen,self.linktype = struct.unpack_from(self.endian + 'HHiIII',self.mm,4)
+        self.rechdr = struct.Struct(self.endian + 'IIII')
+        #file_mult pasa a ns la fracción de la traza y ts_mult la fracción devuelta por records
+        self.file_mult = 1 if self.file_precision == PCAP_TSTAMP_PRECISION_NANO else 1000
+        self.precision = precision
+        self.ts_mult = 1 if precision == PCAP_TSTAMP_PRECISION_NANO else 1000
+        self.idx = None
+
+    def records(self,start:int=PCAP_FILE_HDR_LEN,end:int=None):
+        #Recorre los registros entre los desplazamientos start y end. Un registro truncado al final
+        #del fichero (captura interrumpida) se ignora.
+        mm = self.mm
+        view = self.view
+        unpack = self.rechdr.unpack_from
+        size = len(mm)
+        if end is None or end > size:
+            end = size
+        off = start
+        if self.file_mult != self.ts_mult:
+            #La precisión pedida no es la de la traza: se convierte la fracción de cada paquete
+            mult = self.file_mult
+            div = self.ts_mult
+            while off + PCAP_REC_HDR_LEN <= end:
+                ts_sec,ts_frac,caplen,wirelen = unpack(mm,off)
+                off += PCAP_REC_HDR_LEN
+                if off + caplen > end:
+                    break
+                yield ts_sec,ts_frac * mult // div,caplen,wirelen,view[off:off + caplen]
+                off += caplen
+            return
+        while off + PCAP_REC_HDR_LEN <= end:
+            ts_sec,ts_usec,caplen,wirelen = unpack(mm,off)
+            off += PCAP_REC_HDR_LEN
+            if off + caplen > end:
+                break
+            yield ts_sec,ts_usec,caplen,wirelen,view[off:off + caplen]
+            off += caplen
+
+    def resync(self,off:int,count:int=PCAP_SYNC_RECORDS) -> int:
+        #Devuelve el primer desplazamiento >= off en el que empieza un registro (o el tamaño del fichero si no hay
+        #ninguno). Un candidato se acepta si sus count primeras cabeceras son coherentes (fracción de segundo
+        #válida, 0 < len <= PCAP_SYNC_MAX_LEN, caplen <= len y caplen <= snaplen, timestamps cercanos) y encadenan
+        #hasta el final del fichero o hasta completar count registros
+        mm = self.mm
+        unpack = self.rechdr.unpack_from
+        size = len(mm)
+        units = 1000000000 if self.file_mult == 1 else 1000000
+        maxcap = self.snaplen if self.snaplen > 0 else PCAP_SYNC_MAX_LEN
+        if off < PCAP_FILE_HDR_LEN:
+            off = PCAP_FILE_HDR_LEN
+        while off + PCAP_REC_HDR_LEN <= size:
+            pos = off
+            prev = None
+            n = 0
+            while n < count and pos + PCAP_REC_HDR_LEN <= size:
+                ts_sec,ts_frac,caplen,wirelen = unpack(mm,pos)
+                if ts_frac >= units or wirelen == 0 or wirelen > PCAP_SYNC_MAX_LEN or caplen > wirelen or caplen > maxcap:
+                    break
+                if prev is not None and abs(ts_sec - prev) > PCAP_SYNC_MAX_GAP:
+                    break
+                prev = ts_sec
+                pos += PCAP_REC_HDR_LEN + caplen
+                n += 1
+            else:
+                #count registros coherentes, o una cadena que llega al final (quizá con un registro truncado)
+                return off
+            off += 1
+        return size
+
+    def __iter__(self):
+        return self.records()
+
+    def columns(self,cols:pcap_columns,start:int=PCAP_FILE_HDR_LEN,end:int=None,max_pkts:int=0) -> int:
+        #Llena cols con los registros entre start y end (como mucho max_pkts si es mayor que 0) sin crear objetos
+        #por paquete; cols.data es el propio fichero mapeado. Devuelve el desplazamiento del siguiente registro,
+        #desde el que se puede continuar en la siguiente llamada
+        cols.clear()
+        mm = self.mm
+        unpack = self.rechdr.unpack_from
+        size = len(mm)
+        if end is None or end > size:
+            end = size
+        ts_ns,caplens,lens,offsets = cols.ts_ns,cols.caplen,cols.len,cols.offset
+        mult = self.file_mult
+        off = start
+        n = 0
+        while off + PCAP_REC_HDR_LEN <= end and (max_pkts <= 0 or n < max_pkts):
+            ts_sec,ts_frac,caplen,wirelen = unpack(mm,off)
+            if off + PCAP_REC_HDR_LEN + caplen > end:
+                break
+            ts_ns.append(ts_sec * 1000000000 + ts_frac * mult)
+            caplens.append(caplen)
+            lens.append(wirelen)
+            offsets.append(off + PCAP_REC_HDR_LEN)
+            off += PCAP_REC_HDR_LEN + caplen
+            n += 1
+        cols.data = self.view
+        return off
+
+    def index(self,step:int=PCAP_INDEX_STEP) -> 'pcap_index':
+        #Índice auxiliar de la traza (ver pcap_index); se carga o construye la primera vez que se pide
+        if self.idx is None or self.idx.step != step or not self.idx.valid():
+            self.idx = pcap_index(self.fname,step)
+        return self.idx
+
+    def records_from(self,n:int,step:int=PCAP_INDEX_STEP):
+        #Recorre los registros a partir del paquete número n (empezando en 0) usando el índice
+        off,first = self.index(step).seek_packet(n)
+        records = self.records(off)
+        for _ in range(n - first):
+            next(records,None)
+        return records
+
+    def records_between(self,t0:float,t1:float=None,step:int=PCAP_INDEX_STEP):
+        #Recorre los registros con timestamp en [t0, t1) (segundos UNIX) saltando al principio con el índice.
+        #Supone que la traza está ordenada en el tiempo: termina en el primer paquete con timestamp >= t1
+        off,_ = self.index(step).seek_time(t0)
+        t0_ns = int(round(t0 * 1000000000))
+        t1_ns = None if t1 is None else int(round(t1 * 1000000000))
+        mult = self.ts_mult
+        for rec in self.records(off):
+            ts_ns = rec[0] * 1000000000 + rec[1] * mult
+            if ts_ns < t0_ns:
+                continue
+            if t1_ns is not None and ts_ns >= t1_ns:
+                break
+            yield rec
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        try:
+            self.mm.close()
+        except BufferError:
+            #Aún quedan memoryview de paquetes vivos; el mapeo se liberará cuando desaparezcan
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+
+
+class pcap_index():
+    '''
+        Índice de una traza pcap clásica: guarda el desplazamiento en el fichero y el timestamp (en ns) de uno
+        de cada step paquetes. Se guarda junto a la traza (fname + '.idx') como dos arrays compactos y se reutiliza
+        mientras el tamaño y la fecha de modificación de la traza no cambien; si cambian (o cambia step) se
+        reconstruye automáticamente. Con él se puede saltar a un número de paquete o a un instante con una búsqueda
+        binaria en lugar de recorrer la traza desde el principio. Si no se puede escribir el fichero .idx el
+        índice se usa solo en memoria. Con build=False solo se carga un .idx ya existente y válido; si no lo hay el
+        índice queda vacío (sin entradas) y no se recorre la traza ni se escribe nada.
+    '''
+    def __init__(self,fname:str,step:int=PCAP_INDEX_STEP,rebuild:bool=False,build:bool=True):
+        if fname is None:
+            raise ValueError("El objeto fname no puede ser None")
+        if step <= 0:
+            raise ValueError("step debe ser mayor que 0")
+        self.fname = fname
+        self.idxname = fname + '.idx'
+        self.step = step
+        self.offsets = array.array('q')
+        self.ts = array.array('q')
+        self.packets = 0
+        st = os.stat(fname)
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        if (rebuild or not self.load()) and build:
+            self.build()
+            self.save()
+
+    def load(self) -> bool:
+        #Carga el fichero .idx si existe y corresponde a la traza actual
+        try:
+            with open(self.idxname,'rb') as f:
+                hdr = f.read(PCAP_INDEX_HDR.size)
+                if len(hdr) != PCAP_INDEX_HDR.size:
+                    return False
+                magic,size,mtime_ns,step,count,packets = PCAP_INDEX_HDR.unpack(hdr)
+                if magic != PCAP_INDEX_MAGIC or size != self.size or mtime_ns != self.mtime_ns or step != self.step:
+                    return False
+                offsets = array.array('q')
+                ts = array.array('q')
+                offsets.fromfile(f,count)
+                ts.fromfile(f,count)
+        except (OSError,EOFError):
+            return False
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+            ts.byteswap()
+        self.offsets = offsets
+        self.ts = ts
+        self.packets = packets
+        return True
+
+    def build(self):
+        #Recorre las cabeceras de registro de la traza guardando una de cada step
+        offsets = array.array('q')
+        ts = array.array('q')
+        n = 0
+        step = self.step
+        with pcap_mmap_reader(self.fname) as reader:
+            mm = reader.mm
+            unpack = reader.rechdr.unpack_from
+            mult = reader.file_mult
+            end = min(len(mm),self.size)
+            off = PCAP_FILE_HDR_LEN
+            while off + PCAP_REC_HDR_LEN <= end:
+                ts_sec,ts_frac,caplen,wirelen = unpack(mm,off)
+                if off + PCAP_REC_HDR_LEN + caplen > end:
+                    break
+                if n % step == 0:
+                    offsets.append(off)
+                    ts.append(ts_sec * 1000000000 + ts_frac * mult)
+                n += 1
+                off += PCAP_REC_HDR_LEN + caplen
+        self.offsets = offsets
+        self.ts = ts
+        self.packets = n
+
+    def save(self):
+        offsets = self.offsets
+        ts = self.ts
+        if sys.byteorder == 'big':
+            offsets = array.array('q',offsets)
+            ts = array.array('q',ts)
+            offsets.byteswap()
+            ts.byteswap()
+        tmp = self.idxname + '.tmp'
+        try:
+            with open(tmp,'wb') as f:
+                f.write(PCAP_INDEX_HDR.pack(PCAP_INDEX_MAGIC,self.size,self.mtime_ns,self.step,len(offsets),self.packets))
+                offsets.tofile(f)
+                ts.tofile(f)
+            os.replace(tmp,self.idxname)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def valid(self) -> bool:
+        #True si la traza no ha cambiado desde que se construyó el índice
+        try:
+            st = os.stat(self.fname)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+    def seek_packet(self,n:int) -> tuple:
+        #Devuelve (desplazamiento, número de paquete) de la entrada indexada más cercana por debajo del paquete n
+        #(empezando en 0). Desde ahí hay que saltar como mucho step - 1 paquetes
+        if n < 0 or n >= self.packets:
+            raise ValueError("El paquete {} no existe en la traza ({} paquetes)".format(n,self.packets))
+        i = n // self.step
+        return self.offsets[i],i * self.step
+
+    def seek_time(self,ts:float) -> tuple:
+        #Devuelve (desplazamiento, número de paquete) de la última entrada indexada con timestamp anterior a ts
+        #(segundos UNIX). Supone que la traza está ordenada en el tiempo
+        target = int(round(ts * 1000000000))
+        i = bisect.bisect_left(self.ts,target) - 1
+        if i < 0:
+            i = 0
+        if not self.offsets:
+            return PCAP_FILE_HDR_LEN,0
+        return self.offsets[i],i * self.step
+
+#Estado de cada proceso de pcap_parallel_reduce (lo fija pcap_reduce_init al arrancar el proceso)
+pcap_reduce_state = None
+
+def pcap_reduce_init(fname:str,func,reducer,batch_size:int):
+    global pcap_reduce_state
+    pcap_reduce_state = (fname,func,reducer,batch_size)
+
+def pcap_reduce_chunk(bounds:tuple) -> tuple:
+    #Procesa los registros entre los desplazamientos bounds = (start, end, sync) y devuelve (hay_resultado, resultado).
+    #Con sync los límites son desplazamientos cualesquiera y se llevan al siguiente inicio de registro; los trozos
+    #vecinos resincronizan el mismo límite con la misma función, así que cada registro se procesa una sola vez
+    fname,func,reducer,batch_size = pcap_reduce_state
+    start,end,sync = bounds
+    found = False
+    acc = None
+    def combine(value):
+        nonlocal found,acc
+        if value is None:
+            return
+        acc = reducer(acc,value) if found else value
+        found = True
+    rec = batch = None
+    with pcap_mmap_reader(fname) as reader:
+        if sync:
+            if start > PCAP_FILE_HDR_LEN:
+                start = reader.resync(start)
+            if end < len(reader.mm):
+                end = reader.resync(end)
+        if batch_size > 0:
+            batch = []
+            for rec in reader.records(start,end):
+                batch.append(rec)
+                if len(batch) >= batch_size:
+                    combine(func(batch))
+                    batch = []
+            if batch:
+                combine(func(batch))
+        else:
+            for rec in reader.records(start,end):
+                combine(func(*rec))
+        #Se sueltan los memoryview del último paquete antes de cerrar el lector
+        rec = batch = None
+    return found,acc
+
+def pcap_parallel_reduce(fname:str,func,reducer,nworkers:int=None,batch_size:int=0,initial=None,
+                         chunks_per_worker:int=4,step:int=PCAP_INDEX_STEP):
+    '''
+        Procesa en paralelo una traza pcap clásica. La traza se divide en trozos de bytes del mismo tamaño y cada
+        trozo se procesa en un proceso de un multiprocessing.Pool, que empieza en el primer registro que encuentra
+        a partir de su límite (pcap_mmap_reader.resync). Si ya existe un índice pcap_index válido los trozos empiezan
+        en sus entradas; no se construye ni se escribe ningún índice. Sin índice, unos datos de paquete que imiten
+        una cadena de cabeceras válidas justo en un límite podrían desplazar ese límite; si eso preocupa, construir
+        antes el índice garantiza límites exactos.
+        Si batch_size es 0 se llama a func(ts_sec, ts_usec, caplen, len, data) por cada paquete; si no, a
+        func(lista de registros) con lotes de hasta batch_size registros. Los valores devueltos distintos de None
+        se combinan con reducer(a, b), que debe ser asociativa: primero dentro de cada trozo y después los
+        resultados de los trozos en el orden de la traza. Devuelve initial si no hay ningún valor.
+        data es un memoryview válido solo durante la llamada. Los procesos se crean con fork, así que func y
+        reducer pueden ser cualquier función (incluso lambdas); los resultados deben poder serializarse con pickle.
+    '''
+    if fname is None:
+        raise ValueError("El objeto fname no puede ser None")
+    if func is None:
+        raise ValueError("El objeto func no puede ser None")
+    if reducer is None:
+        raise ValueError("El objeto reducer no puede ser None")
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    idx = pcap_index(fname,step,build=False)
+    size = idx.size
+    offsets = list(idx.offsets)
+    if offsets:
+        nchunks = max(1,min(len(offsets),nworkers * chunks_per_worker))
+        starts = [offsets[i * len(offsets) // nchunks] for i in range(nchunks)]
+    else:
+        data = max(0,size - PCAP_FILE_HDR_LEN)
+        nchunks = max(1,min(nworkers * chunks_per_worker,data // PCAP_REDUCE_MIN_CHUNK))
+        starts = [PCAP_FILE_HDR_LEN + i * data // nchunks for i in range(nchunks)]
+    sync = not offsets
+    bounds = [(start,end,sync) for start,end in zip(starts,starts[1:] + [size])]
+    if nworkers == 1 or len(bounds) == 1:
+        pcap_reduce_init(fname,func,reducer,batch_size)
+        partial = [pcap_reduce_chunk(b) for b in bounds]
+    else:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(nworkers,pcap_reduce_init,(fname,func,reducer,batch_size)) as pool:
+            partial = pool.map(pcap_reduce_chunk,bounds,1)
+    found = False
+    acc = initial
+    for ok,value in partial:
+        if ok:
+            acc = reducer(acc,value) if found else value
+            found = True
+    return acc
+
+def pcap_transform(fin:str,fout:str,time_offset:float=0.0,snaplen:int=0,first:int=0,count:int=-1,
+                   bufsize:int=1 << 22) -> int:
+    '''
+        Copia la traza pcap clásica fin en fout desplazando los timestamps time_offset segundos, recortando los
+        paquetes a snaplen bytes (0: sin recortar) y quedándose con count paquetes (-1: todos) a partir del
+        paquete número first (empezando en 0). No se crean objetos por paquete: los registros se copian del fichero
+        mapeado en bloques de bufsize bytes y solo se reescriben sus cabeceras. Sin desplazamiento ni recorte los
+        bloques se escriben directamente desde el mapeo. La traza de salida conserva el orden de bytes y la
+        precisión de timestamps de la de entrada. Devuelve el número de paquetes escritos. Si el desplazamiento
+        deja algún timestamp fuera del rango de pcap (antes de 1970 o después de 2106) se lanza ValueError y la
+        traza de salida queda incompleta.
+    '''
+    if fin is None:
+        raise ValueError("El objeto fin no puede ser None")
+    if fout is None:
+        raise ValueError("El objeto fout no puede ser None")
+    with pcap_mmap_reader(fin) as reader, open(fout,'wb') as out:
+        mm = reader.mm
+        view = reader.view
+        size = len(mm)
+        unpack = reader.rechdr.unpack_from
+        pack = reader.rechdr.pack_into
+        #Unidades por segundo de la fracción de la traza (micro o nanosegundos)
+        units = 1000000000 if reader.file_mult == 1 else 1000000
+        shift = int(round(time_offset * units))
+        if snaplen >= reader.snaplen:
+            snaplen = 0
+        filehdr = bytearray(mm[:PCAP_FILE_HDR_LEN])
+        if snaplen > 0:
+            struct.pack_into(reader.endian + 'I',filehdr,16,snaplen)
+        out.write(filehdr)
+        #Salto hasta el primer paquete pedido (con el índice si ya se había construido)
+        off = PCAP_FILE_HDR_LEN
+        n = 0
+        if first > 0 and os.path.exists(fin + '.idx'):
+            idx = reader.index()
+            if first < idx.packets:
+                off,n = idx.seek_packet(first)
+            else:
+                off = size
+        while n < first and off + PCAP_REC_HDR_LEN <= size:
+            off += PCAP_REC_HDR_LEN + unpack(mm,off)[2]
+            n += 1
+        buf = bytearray(max(bufsize,PCAP_REC_HDR_LEN + snaplen))
+        written = 0
+        while off + PCAP_REC_HDR_LEN <= size and written != count:
+            if snaplen > 0:
+                #Con recorte cada registro se copia al buffer con su nueva longitud capturada
+                pos = 0
+                while off + PCAP_REC_HDR_LEN <= size and written != count and pos + PCAP_REC_HDR_LEN + snaplen <= len(buf):
+                    ts_sec,ts_frac,caplen,wirelen = unpack(mm,off)
+                    start = off + PCAP_REC_HDR_LEN
+                    if start + caplen > size:
+                        #Registro truncado al final de la traza
+                        size = off
+                        break
+                    if shift:
+                        ts_sec,ts_frac = divmod(ts_sec * units + ts_frac + shift,units)
+                        if not 0 <= ts_sec <= 0xffffffff:
+                            raise ValueError("El desplazamiento deja el paquete {} fuera del rango de timestamps pcap".format(n + written))
+                    newcap = min(caplen,snaplen)
+                    pack(buf,pos,ts_sec,ts_frac,newcap,wirelen)
+                    pos += PCAP_REC_HDR_LEN
+                    buf[pos:pos + newcap] = view[start:start + newcap]
+                    pos += newcap
+                    off = start + caplen
+                    written += 1
+                out.write(memoryview(buf)[:pos])
+                continue
+            #Sin recorte se copia un bloque de registros completos; con desplazamiento el bloque pasa por el buffer
+            #para reescribir las cabeceras y si no se escribe directamente desde el mapeo
+            length = min(size - off,len(buf))
+            if shift:
+                buf[:length] = view[off:off + length]
+                src = buf
+                base = 0
+            else:
+                src = mm
+                base = off
+            p = base
+            limit = base + length
+            while p + PCAP_REC_HDR_LEN <= limit and written != count:
+                ts_sec,ts_frac,caplen,wirelen = unpack(src,p)
+                if p + PCAP_REC_HDR_LEN + caplen > limit:
+                    break
+                if shift:
+                    ts_sec,ts_frac = divmod(ts_sec * units + ts_frac + shift,units)
+                    if not 0 <= ts_sec <= 0xffffffff:
+                        raise ValueError("El desplazamiento deja el paquete {} fuera del rango de timestamps pcap".format(n + written))
+                    pack(buf,p,ts_sec,ts_frac,caplen,wirelen)
+                p += PCAP_REC_HDR_LEN + caplen
+                written += 1
+            used = p - base
+            if used == 0:
+                caplen = unpack(mm,off)[2]
+                if off + PCAP_REC_HDR_LEN + caplen > size:
+                    #Registro truncado al final de la traza
+                    break
+                #Registro mayor que el buffer
+                buf = bytearray(PCAP_REC_HDR_LEN + caplen)
+                continue
+            if shift:
+                out.write(memoryview(buf)[:used])
+            else:
+                out.write(view[off:off + used])
+            off += used
+    return written
 
-def pcap_open_offline(fname:str,errbuf:bytearray) -> ctypes.c_void_p:
+class pcap_writer():
+    '''
+        Escritor de trazas pcap clásicas que no pasa por libpcap. Las cabeceras de registro se empaquetan con
+        struct.pack_into sobre un buffer de escritura reutilizable que se vuelca al fichero en bloques grandes.
+        Opcionalmente rota el fichero de salida (como tcpdump -C/-G) al superar max_bytes bytes, max_packets
+        paquetes o max_seconds segundos de traza (según el timestamp de los paquetes). Los ficheros rotados
+        se nombran insertando un índice antes de la extensión: traza.pcap, traza.1.pcap, traza.2.pcap...
+        Con precision PCAP_TSTAMP_PRECISION_NANO la traza se escribe con el magic de nanosegundos y write
+        recibe la fracción de segundo en nanosegundos.
+    '''
+    def __init__(self,fname:str,linktype:int=DLT_EN10MB,snaplen:int=65535,bufsize:int=1 << 20,
+                 max_bytes:int=0,max_packets:int=0,max_seconds:int=0,precision:int=PCAP_TSTAMP_PRECISION_MICRO):
+        if fname is None:
+            raise ValueError("El objeto fname no puede ser None")
+        if bufsize < PCAP_FILE_HDR_LEN + PCAP_REC_HDR_LEN:
+            raise ValueError("bufsize es demasiado pequeño")
+        self.fname = fname
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.max_bytes = max_bytes
+        self.max_packets = max_packets
+        self.max_seconds = max_seconds
+        self.precision = precision
+        self.magic = PCAP_MAGIC_NSEC if precision == PCAP_TSTAMP_PRECISION_NANO else PCAP_MAGIC
+        self.buf = bytearray(bufsize)
+        self.pos = 0
+        self.rechdr = struct.Struct('<IIII')
+        self.file = None
+        self.nfile = 0
+        self.open_file()
+
+    def file_name(self,n:int) -> str:
+        if n == 0:
+            return self.fname
+        root,ext = os.path.splitext(self.fname)
+        return '{}.{}{}'.format(root,n,ext)
+
+    def open_file(self):
+        self.file = open(self.file_name(self.nfile),'wb')
+        struct.pack_into('<IHHiIII',self.buf,self.pos,self.magic,2,4,0,0,self.snaplen,self.linktype)
+        self.pos += PCAP_FILE_HDR_LEN
+        self.file_bytes = PCAP_FILE_HDR_LEN
+        self.file_packets = 0
+        self.file_start = None
+
+    def rotate(self):
+        self.flush()
+        self.file.close()
+        self.nfile += 1
+        self.open_file()
+
+    def write(self,ts_sec:int,ts_usec:int,data:bytes,wirelen:int=None):
+        #Añade un paquete a la traza. wirelen es la longitud original del paquete (por defecto len(data)).
+        #ts_usec va en la precisión del escritor (nanosegundos si es PCAP_TSTAMP_PRECISION_NANO)
+        if data is None:
+            raise ValueError("El objeto data no puede ser None")
+        caplen = len(data)
+        if wirelen is None:
+            wirelen = caplen
+        if caplen > self.snaplen:
+            caplen = self.snaplen
+            data = memoryview(data)[:caplen]
+        reclen = PCAP_REC_HDR_LEN + caplen
+        if self.file_packets > 0 and ((self.max_bytes and self.file_bytes + reclen > self.max_bytes) or
+                (self.max_packets and self.file_packets >= self.max_packets) or
+                (self.max_seconds and ts_sec - self.file_start >= self.max_seconds)):
+            self.rotate()
+        if self.file_start is None:
+            self.file_start = ts_sec
+        if self.pos + reclen > len(self.buf):
+            self.flush()
+        if reclen > len(self.buf):
+            #Paquete mayor que el buffer: se escribe directamente
+            self.file.write(self.rechdr.pack(ts_sec,ts_usec,caplen,wirelen))
+            self.file.write(data)
+        else:
+            pos = self.pos
+            self.rechdr.pack_into(self.buf,pos,ts_sec,ts_usec,caplen,wirelen)
+            self.buf[pos + PCAP_REC_HDR_LEN:pos + reclen] = data
+            self.pos = pos + reclen
+        self.file_bytes += reclen
+        self.file_packets += 1
+
+    def dump(self,header,data:bytes):
+        #Equivalente a pcap_dump con la cabecera pcap_pkthdr
+        if self.precision == PCAP_TSTAMP_PRECISION_NANO:
+            self.write(header.ts.tv_sec,header.ts.tv_nsec,data,header.len)
+        else:
+            self.write(header.ts.tv_sec,header.ts.tv_usec,data,header.len)
+
+    def flush(self):
+        if self.pos > 0:
+            self.file.write(memoryview(self.buf)[:self.pos])
+            self.pos = 0
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+class pcap_ring_stats():
+    #Instantánea de las estadísticas de un pcap_ring_writer: paquetes encolados, bytes escritos, descartes y
+    #ocupación de la cola (actual y máxima, en bytes)
+    def __init__(self,packets:int,bytes:int,drops:int,drop_bytes:int,depth:int,high_water:int,size:int,writes:int):
+        self.packets = packets
+        self.bytes = bytes
+        self.drops = drops
+        self.drop_bytes = drop_bytes
+        self.depth = depth
+        self.high_water = high_water
+        self.size = size
+        self.writes = writes
+
+    def __str__(self):
+        return ('Volcado: {} paquetes encolados, {} bytes escritos en {} escrituras, {} descartados por cola llena ({} bytes)\n'
+                'Cola: {} bytes ocupados, máximo {} de {} ({:.1f}%)').format(
+                    self.packets,self.bytes,self.writes,self.drops,self.drop_bytes,self.depth,self.high_water,self.size,
+                    100.0 * self.high_water / self.size if self.size else 0.0)
+
+class pcap_ring_writer():
+    '''
+        Volcado a disco desacoplado de la captura. dump/write (llamados desde el callback de captura) solo copian el
+        registro pcap (cabecera + datos) en un anillo de bytes preasignado de ring_size bytes; un hilo escritor
+        vuelca los tramos ocupados del anillo directamente al fichero, en escrituras de al menos min_write bytes o
+        cada flush_ms milisegundos. Si el anillo está lleno porque el disco no da abasto el paquete se descarta y
+        se cuenta en lugar de bloquear la captura. stats() informa de la ocupación actual y máxima del anillo, de
+        lo escrito y de lo descartado. La traza de salida tiene el mismo formato que la de pcap_writer.
+    '''
+    def __init__(self,fname:str,linktype:int=DLT_EN10MB,snaplen:int=65535,ring_size:int=64 << 20,
+                 min_write:int=1 << 20,flush_ms:int=200,precision:int=PCAP_TSTAMP_PRECISION_MICRO):
+        if fname is None:
+            raise ValueError("El objeto fname no puede ser None")
+        if ring_size < PCAP_REC_HDR_LEN + snaplen:
+            raise ValueError("ring_size es demasiado pequeño para snaplen")
+        self.fname = fname
+        self.snaplen = snaplen
+        self.precision = precision
+        self.min_write = min(min_write,ring_size // 2)
+        self.flush_s = flush_ms / 1000
+        self.buf = bytearray(ring_size)
+        self.view = memoryview(self.buf)
+        self.size = ring_size
+        self.rechdr = struct.Struct('<IIII')
+        #Los datos ocupan [tail, head) o, si el productor ha dado la vuelta, [tail, end) y [0, head)
+        self.head = 0
+        self.tail = 0
+        self.end = ring_size
+        self.used = 0
+        self.high_water = 0
+        self.packets = 0
+        self.bytes = 0
+        self.drops = 0
+        self.drop_bytes = 0
+        self.writes = 0
+        self.error = None
+        self.closing = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        magic = PCAP_MAGIC_NSEC if precision == PCAP_TSTAMP_PRECISION_NANO else PCAP_MAGIC
+        self.file = open(fname,'wb')
+        self.file.write(struct.pack('<IHHiIII',magic,2,4,0,0,snaplen,linktype))
+        self.thread = threading.Thread(target=self.run,name='pcap_ring_writer',daemon=True)
+        self.thread.start()
+
+    def reserve(self,reclen:int) -> int:
+        #Devuelve la posición del anillo en la que copiar un registro de reclen bytes o -1 si no cabe.
+        #Se llama con el cerrojo tomado
+        if self.used == 0:
+            self.head = self.tail = 0
+            self.end = self.size
+        head = self.head
+        if head > self.tail or self.used == 0:
+            if head + reclen <= self.size:
+                return head
+            if reclen <= self.tail:
+                #No cabe al final: el hueco hasta el final se salta y se sigue al principio del anillo
+                self.end = head
+                return 0
+            return -1
+        if head + reclen <= self.tail:
+            return head
+        return -1
+
+    def write(self,ts_sec:int,ts_usec:int,data:bytes,wirelen:int=None) -> bool:
+        #Encola un paquete (misma interfaz que pcap_writer.write). Devuelve False si se ha descartado
+        if data is None:
+            raise ValueError("El objeto data no puede ser None")
+        caplen = len(data)
+        if wirelen is None:
+            wirelen = caplen
+        if caplen > self.snaplen:
+            caplen = self.snaplen
+        reclen = PCAP_REC_HDR_LEN + caplen
+        with self.lock:
+            pos = self.reserve(reclen)
+            if pos < 0 or self.closing:
+                self.drops += 1
+                self.drop_bytes += reclen
+                return False
+            self.rechdr.pack_into(self.buf,pos,ts_sec,ts_usec,caplen,wirelen)
+            self.buf[pos + PCAP_REC_HDR_LEN:pos + reclen] = memoryview(data)[:caplen]
+            self.head = pos + reclen
+            self.used += reclen
+            self.packets += 1
+            if self.used > self.high_water:
+                self.high_water = self.used
+            if self.used >= self.min_write:
+                self.cond.notify()
+        return True
+
+    def dump(self,header,data:bytes) -> bool:
+        #Equivalente a pcap_dump con la cabecera pcap_pkthdr
+        if self.precision == PCAP_TSTAMP_PRECISION_NANO:
+            return self.write(header.ts.tv_sec,header.ts.tv_nsec,data,header.len)
+        return self.write(header.ts.tv_sec,header.ts.tv_usec,data,header.len)
+
+    def dump_batch(self,packets:list) -> int:
+        #Encola una lista de (header, data) como las de pcap_dispatch_batch. Devuelve los paquetes encolados
+        n = 0
+        for header,data in packets:
+            if self.dump(header,data):
+                n += 1
+        return n
+
+    def run(self):
+        #Hilo escritor: espera a que haya min_write bytes (o a que pase flush_ms) y escribe el tramo contiguo
+        #más largo disponible sin tener el cerrojo tomado, de modo que la captura sigue encolando mientras tanto
+        while True:
+            with self.lock:
+                if self.used < self.min_write and not self.closing:
+                    self.cond.wait(self.flush_s)
+                if self.used == 0:
+                    if self.closing:
+                        break
+                    continue
+                tail = self.tail
+                stop = self.head if self.head > tail else self.end
+            try:
+                self.file.write(self.view[tail:stop])
+            except OSError as e:
+                #Con el disco en error se sigue vaciando el anillo para no bloquear la captura
+                self.error = e
+            n = stop - tail
+            with self.lock:
+                self.used -= n
+                self.tail = stop
+                if stop == self.end and self.head <= stop and self.used > 0:
+                    self.tail = 0
+                    self.end = self.size
+                self.writes += 1
+                self.bytes += n
+        try:
+            self.file.flush()
+        except OSError as e:
+            if self.error is None:
+                self.error = e
+
+    def stats(self) -> pcap_ring_stats:
+        with self.lock:
+            return pcap_ring_stats(self.packets,self.bytes,self.drops,self.drop_bytes,self.used,self.high_water,
+                                   self.size,self.writes)
+
+    def close(self):
+        #Vacía el anillo y cierra el fichero
+        if self.file is None:
+            return
+        with self.lock:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join()
+        try:
+            self.file.close()
+        except OSError as e:
+            #Lo que el hilo no pudo escribir se vuelve a intentar al cerrar y vuelve a fallar
+            if self.error is None:
+                self.error = e
+        self.file = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+class pcap_rolling_buffer():
+    '''
+        Ventana deslizante en memoria con los últimos paquetes capturados. Los registros pcap (cabecera + datos) se
+        copian en un arena circular preasignado de size bytes y un índice circular compacto (dos array de enteros con
+        el desplazamiento y el timestamp en ns de cada registro) recuerda dónde empieza cada uno. Al añadir un
+        paquete se expulsan los más antiguos que no dejen sitio, que superen max_packets o que tengan más de
+        max_seconds segundos respecto al último (0: sin límite de tiempo), de modo que la memoria usada es fija por
+        mucho que dure la captura. snapshot() vuelca la ventana a una traza pcap escribiendo directamente desde el
+        arena los tramos contiguos de registros, sin copiarlos. Se puede usar desde varios hilos.
+    '''
+    def __init__(self,size:int=64 << 20,max_seconds:float=0,snaplen:int=65535,linktype:int=DLT_EN10MB,
+                 max_packets:int=None,precision:int=PCAP_TSTAMP_PRECISION_MICRO):
+        if size < PCAP_REC_HDR_LEN + snaplen:
+            raise ValueError("size es demasiado pequeño para snaplen")
+        if max_packets is None:
+            #Suficiente para llenar el arena con tramas Ethernet mínimas
+            max_packets = size // (PCAP_REC_HDR_LEN + 60) + 1
+        self.size = size
+        self.snaplen = snaplen
+        self.linktype = linktype
+        self.precision = precision
+        self.ts_mult = 1 if precision == PCAP_TSTAMP_PRECISION_NANO else 1000
+        self.max_ns = int(max_seconds * 1000000000)
+        self.arena = bytearray(size)
+        self.view = memoryview(self.arena)
+        self.rechdr = struct.Struct('<IIII')
+        self.offsets = array.array('q',bytes(8 * max_packets))
+        self.ts = array.array('q',bytes(8 * max_packets))
+        self.capacity = max_packets
+        #Registros en el índice: count a partir de first. head es donde se copia el siguiente registro
+        self.first = 0
+        self.count = 0
+        self.head = 0
+        self.used = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def evict(self):
+        #Expulsa el registro más antiguo de la ventana. Se llama con el cerrojo tomado
+        off = self.offsets[self.first]
+        self.used -= PCAP_REC_HDR_LEN + self.rechdr.unpack_from(self.arena,off)[2]
+        self.first = (self.first + 1) % self.capacity
+        self.count -= 1
+        self.evicted += 1
+
+    def reserve(self,reclen:int) -> int:
+        #Posición del arena en la que cabe un registro de reclen bytes sin pisar la ventana, o -1
+        if self.count == 0:
+            return 0
+        head = self.head
+        tail = self.offsets[self.first]
+        if head > tail:
+            if head + reclen <= self.size:
+                return head
+            if reclen <= tail:
+                return 0
+            return -1
+        if head + reclen <= tail:
+            return head
+        return -1
+
+    def write(self,ts_sec:int,ts_usec:int,data:bytes,wirelen:int=None):
+        #Añade un paquete a la ventana (misma interfaz que pcap_writer.write)
+        if data is None:
+            raise ValueError("El objeto data no puede ser None")
+        caplen = len(data)
+        if wirelen is None:
+            wirelen = caplen
+        if caplen > self.snaplen:
+            caplen = self.snaplen
+        reclen = PCAP_REC_HDR_LEN + caplen
+        ts_ns = ts_sec * 1000000000 + ts_usec * self.ts_mult
+        with self.lock:
+            if self.count == self.capacity:
+                self.evict()
+            pos = self.reserve(reclen)
+            while pos < 0:
+                self.evict()
+                pos = self.reserve(reclen)
+            self.rechdr.pack_into(self.arena,pos,ts_sec,ts_usec,caplen,wirelen)
+            self.arena[pos + PCAP_REC_HDR_LEN:pos + reclen] = memoryview(data)[:caplen]
+            i = (self.first + self.count) % self.capacity
+            self.offsets[i] = pos
+            self.ts[i] = ts_ns
+            self.count += 1
+            self.head = pos + reclen
+            self.used += reclen
+            if self.max_ns:
+                limit = ts_ns - self.max_ns
+                while self.ts[self.first] < limit:
+                    self.evict()
+
+    def dump(self,header,data:bytes):
+        #Equivalente a pcap_dump con la cabecera pcap_pkthdr
+        if self.precision == PCAP_TSTAMP_PRECISION_NANO:
+            self.write(header.ts.tv_sec,header.ts.tv_nsec,data,header.len)
+        else:
+            self.write(header.ts.tv_sec,header.ts.tv_usec,data,header.len)
+
+    def snapshot(self,fname:str,last_seconds:float=0) -> int:
+        #Vuelca a fname los paquetes de la ventana (solo los de los últimos last_seconds segundos si es mayor que 0).
+        #La captura que comparta el objeto espera mientras se escribe. Devuelve el número de paquetes escritos
+        if fname is None:
+            raise ValueError("El objeto fname no puede ser None")
+        magic = PCAP_MAGIC_NSEC if self.precision == PCAP_TSTAMP_PRECISION_NANO else PCAP_MAGIC
+        with self.lock, open(fname,'wb') as f:
+            f.write(struct.pack('<IHHiIII',magic,2,4,0,0,self.snaplen,self.linktype))
+            capacity = self.capacity
+            offsets = self.offsets
+            i = self.first
+            n = self.count
+            if last_seconds > 0 and n > 0:
+                limit = self.ts[(i + n - 1) % capacity] - int(last_seconds * 1000000000)
+                while n > 0 and self.ts[i] < limit:
+                    i = (i + 1) % capacity
+                    n -= 1
+            unpack = self.rechdr.unpack_from
+            start = end = None
+            for _ in range(n):
+                off = offsets[i]
+                if off != end:
+                    if start is not None:
+                        f.write(self.view[start:end])
+                    start = off
+                end = off + PCAP_REC_HDR_LEN + unpack(self.arena,off)[2]
+                i = (i + 1) % capacity
+            if start is not None:
+                f.write(self.view[start:end])
+        return n
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        with self.lock:
+            span = 0.0
+            if self.count > 0:
+                span = (self.ts[(self.first + self.count - 1) % self.capacity] - self.ts[self.first]) / 1e9
+            return 'Ventana: {} paquetes, {} de {} bytes, {:.3f} s, {} paquetes expulsados'.format(
+                self.count,self.used,self.size,span,self.evicted)
+
+
+#Formato pcapng (ver draft-ietf-opsawg-pcapng)
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_IF_NAME = 2
+PCAPNG_OPT_IF_TSRESOL = 9
+
+class pcapng_interface():
+    #Interfaz declarada en un Interface Description Block. tsresol es el número de unidades de timestamp por segundo
+    def __init__(self,linktype:int,snaplen:int,name:str=None,tsresol:int=1000000):
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.name = name
+        self.tsresol = tsresol
+
+def pcapng_tsresol(value:int) -> int:
+    #Convierte el valor de la opción if_tsresol en unidades por segundo (bit alto a 0: 10^-n, a 1: 2^-n)
+    if value & 0x80:
+        return 1 << (value & 0x7f)
+    return 10 ** value
+
+class pcapng_reader():
+    '''
+        Lector en streaming de trazas pcapng que no pasa por libpcap. Igual que pcap_mmap_reader mapea el fichero
+        en memoria y produce cada paquete como una tupla (if_id, ts_sec, ts_usec, caplen, len, data) en la que data
+        es un memoryview sobre el fichero. Soporta varias secciones y varias interfaces por sección, cada una con
+        su propia resolución de timestamp. interfaces contiene las interfaces de la sección que se está leyendo.
+        La fracción de segundo se devuelve en la precisión pedida (microsegundos o nanosegundos).
+    '''
+    def __init__(self,fname:str,precision:int=PCAP_TSTAMP_PRECISION_MICRO):
+        if fname is None:
+            raise ValueError("El objeto fname no puede ser None")
+        self.fname = fname
+        self.file = open(fname,'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError("El fichero {} está vacío".format(fname))
+        self.view = memoryview(self.mm)
+        if len(self.mm) < 12 or struct.unpack_from('<I',self.mm,0)[0] != PCAPNG_SHB:
+            self.close()
+            raise ValueError("El fichero {} no es una traza pcapng".format(fname))
+        self.precision = precision
+        self.units = 1000000000 if precision == PCAP_TSTAMP_PRECISION_NANO else 1000000
+        self.interfaces = []
+
+    def parse_options(self,endian:str,off:int,end:int) -> dict:
+        options = {}
+        while off + 4 <= end:
+            code,length = struct.unpack_from(endian + 'HH',self.mm,off)
+            off += 4
+            if code == PCAPNG_OPT_ENDOFOPT:
+                break
+            options[code] = self.view[off:off + length]
+            off += (length + 3) & ~3
+        return options
+
+    def records(self):
+        mm = self.mm
+        view = self.view
+        units = self.units
+        size = len(mm)
+        endian = '<'
+        blkhdr = struct.Struct('<II')
+        epbhdr = struct.Struct('<IIIII')
+        off = 0
+        while off + 12 <= size:
+            btype,blen = blkhdr.unpack_from(mm,off)
+            if btype == PCAPNG_SHB:
+                #El orden de bytes de la sección lo marca el Byte-Order Magic de su cabecera
+                bom = struct.unpack_from('<I',mm,off + 8)[0]
+                endian = '<' if bom == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                blkhdr = struct.Struct(endian + 'II')
+                epbhdr = struct.Struct(endian + 'IIIII')
+                blen = blkhdr.unpack_from(mm,off)[1]
+                self.interfaces = []
+            if blen < 12 or off + blen > size:
+                #Bloque truncado al final del fichero
+                break
+            body = off + 8
+            if btype == PCAPNG_EPB:
+                if_id,ts_high,ts_low,caplen,wirelen = epbhdr.unpack_from(mm,body)
+                if if_id >= len(self.interfaces):
+                    raise ValueError("Paquete en el offset {} de interfaz desconocida {}".format(off,if_id))
+                tsresol = self.interfaces[if_id].tsresol
+                ts = (ts_high << 32) | ts_low
+                yield if_id,ts // tsresol,(ts % tsresol) * units // tsresol,caplen,wirelen,view[body + 20:body + 20 + caplen]
+            elif btype == PCAPNG_SPB:
+                wirelen = struct.unpack_from(endian + 'I',mm,body)[0]
+                caplen = min(wirelen,blen - 16)
+                if not self.interfaces:
+                    raise ValueError("Paquete simple en el offset {} de interfaz desconocida 0".format(off))
+                if self.interfaces[0].snaplen:
+                    caplen = min(caplen,self.interfaces[0].snaplen)
+                yield 0,0,0,caplen,wirelen,view[body + 4:body + 4 + caplen]
+            elif btype == PCAPNG_PB:
+                if_id,_,ts_high,ts_low,caplen,wirelen = struct.unpack_from(endian + 'HHIIII',mm,body)
+                if if_id >= len(self.interfaces):
+                    raise ValueError("Paquete en el offset {} de interfaz desconocida {}".format(off,if_id))
+                tsresol = self.interfaces[if_id].tsresol
+                ts = (ts_high << 32) | ts_low
+                yield if_id,ts // tsresol,(ts % tsresol) * units // tsresol,caplen,wirelen,view[body + 20:body + 20 + caplen]
+            elif btype == PCAPNG_IDB:
+                linktype,_,snaplen = struct.unpack_from(endian + 'HHI',mm,body)
+                options = self.parse_options(endian,body + 8,off + blen - 4)
+                name = None
+                if PCAPNG_OPT_IF_NAME in options:
+                    name = bytes(options[PCAPNG_OPT_IF_NAME]).decode('utf-8','replace')
+                tsresol = 1000000
+                if PCAPNG_OPT_IF_TSRESOL in options:
+                    tsresol = pcapng_tsresol(options[PCAPNG_OPT_IF_TSRESOL][0])
+                self.interfaces.append(pcapng_interface(linktype,snaplen,name,tsresol))
+            off += blen
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        try:
+            self.mm.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+class pcapng_writer():
+    '''
+        Escritor en streaming de trazas pcapng. Escribe una única sección con las interfaces que se declaren con
+        add_interface y los paquetes como Enhanced Packet Blocks. Igual que pcap_writer, los bloques se empaquetan
+        sobre un buffer reutilizable que se vuelca al fichero en escrituras grandes. write recibe la fracción de
+        segundo en la precisión del escritor (microsegundos o nanosegundos), independiente del if_tsresol de
+        cada interfaz.
+    '''
+    def __init__(self,fname:str,bufsize:int=1 << 20,precision:int=PCAP_TSTAMP_PRECISION_MICRO):
+        if fname is None:
+            raise ValueError("El objeto fname no puede ser None")
+        self.fname = fname
+        self.precision = precision
+        self.units = 1000000000 if precision == PCAP_TSTAMP_PRECISION_NANO else 1000000
+        self.file = open(fname,'wb')
+        self.buf = bytearray(bufsize)
+        self.pos = 0
+        self.interfaces = []
+        self.epbhdr = struct.Struct('<IIIIIII')
+        #Section Header Block sin opciones y con longitud de sección desconocida (-1)
+        self.write_block(struct.pack('<IIIHHqI',PCAPNG_SHB,28,PCAPNG_BYTE_ORDER_MAGIC,1,0,-1,28))
+
+    def write_block(self,block:bytes):
+        if self.pos + len(block) > len(self.buf):
+            self.flush()
+        if len(block) > len(self.buf):
+            self.file.write(block)
+        else:
+            self.buf[self.pos:self.pos + len(block)] = block
+            self.pos += len(block)
+
+    def add_interface(self,linktype:int=DLT_EN10MB,snaplen:int=0,name:str=None,tsresol:int=6) -> int:
+        #Declara una interfaz y devuelve su identificador. tsresol es el valor de la opción if_tsresol (6: microsegundos)
+        options = b''
+        if name is not None:
+            value = name.encode('utf-8')
+            options += struct.pack('<HH',PCAPNG_OPT_IF_NAME,len(value)) + value + bytes((-len(value)) & 3)
+        if tsresol != 6:
+            options += struct.pack('<HHB3x',PCAPNG_OPT_IF_TSRESOL,1,tsresol)
+        if options:
+            options += struct.pack('<HH',PCAPNG_OPT_ENDOFOPT,0)
+        blen = 20 + len(options)
+        self.write_block(struct.pack('<IIHHI',PCAPNG_IDB,blen,linktype,0,snaplen) + options + struct.pack('<I',blen))
+        self.interfaces.append(pcapng_interface(linktype,snaplen,name,pcapng_tsresol(tsresol)))
+        return len(self.interfaces) - 1
+
+    def write(self,if_id:int,ts_sec:int,ts_usec:int,data:bytes,wirelen:int=None):
+        if data is None:
+            raise ValueError("El objeto data no puede ser None")
+        if not 0 <= if_id < len(self.interfaces):
+            raise ValueError("Escritura en interfaz desconocida {}".format(if_id))
+        iface = self.interfaces[if_id]
+        caplen = len(data)
+        if wirelen is None:
+            wirelen = caplen
+        if iface.snaplen and caplen > iface.snaplen:
+            caplen = iface.snaplen
+            data = memoryview(data)[:caplen]
+        ts = ts_sec * iface.tsresol + ts_usec * iface.tsresol // self.units
+        pad = (-caplen) & 3
+        blen = 32 + caplen + pad
+        if self.pos + blen > len(self.buf):
+            self.flush()
+        if blen > len(self.buf):
+            self.file.write(self.epbhdr.pack(PCAPNG_EPB,blen,if_id,ts >> 32,ts & 0xffffffff,caplen,wirelen))
+            self.file.write(data)
+            self.file.write(bytes(pad) + struct.pack('<I',blen))
+            return
+        pos = self.pos
+        self.epbhdr.pack_into(self.buf,pos,PCAPNG_EPB,blen,if_id,ts >> 32,ts & 0xffffffff,caplen,wirelen)
+        pos += 28
+        self.buf[pos:pos + caplen] = data
+        pos += caplen
+        self.buf[pos:pos + pad] = bytes(pad)
+        struct.pack_into('<I',self.buf,pos + pad,blen)
+        self.pos = pos + pad + 4
+
+    def flush(self):
+        if self.pos > 0:
+            self.file.write(memoryview(self.buf)[:self.pos])
+            self.pos = 0
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+def pcapng_merge(fname:str,inputs:list) -> int:
+    #Mezcla por orden de timestamp varias trazas (pcap clásico o pcapng) en un único pcapng con una interfaz por
+    #cada interfaz de entrada. Cada traza de entrada debe estar ordenada temporalmente. Devuelve el número de paquetes
+    if fname is None:
+        raise ValueError("El objeto fname no puede ser None")
+    if inputs is None:
+        raise ValueError("El objeto inputs no puede ser None")
+    #Se trabaja en nanosegundos para no perder resolución de las trazas que la tengan
+    writer = pcapng_writer(fname,precision=PCAP_TSTAMP_PRECISION_NANO)
+    readers = []
+
+    def classic_records(reader):
+        if_id = writer.add_interface(reader.linktype,reader.snaplen,tsresol=9 if reader.file_mult == 1 else 6)
+        for ts_sec,ts_usec,caplen,wirelen,data in reader:
+            yield ts_sec,ts_usec,if_id,wirelen,data
+
+    def pcapng_records(reader):
+        ids = {}
+        for if_id,ts_sec,ts_usec,caplen,wirelen,data in reader:
+            iface = reader.interfaces[if_id]
+            if id(iface) not in ids:
+                ids[id(iface)] = writer.add_interface(iface.linktype,iface.snaplen,iface.name,9 if iface.tsresol > 1000000 else 6)
+            yield ts_sec,ts_usec,ids[id(iface)],wirelen,data
+
+    try:
+        sources = []
+        for name in inputs:
+            with open(name,'rb') as f:
+                magic = f.read(4)
+            if len(magic) == 4 and struct.unpack('<I',magic)[0] == PCAPNG_SHB:
+                reader = pcapng_reader(name,PCAP_TSTAMP_PRECISION_NANO)
+                sources.append(pcapng_records(reader))
+            else:
+                reader = pcap_mmap_reader(name,PCAP_TSTAMP_PRECISION_NANO)
+                sources.append(classic_records(reader))
+            readers.append(reader)
+        n = 0
+        for ts_sec,ts_usec,if_id,wirelen,data in heapq.merge(*sources,key=lambda r: (r[0],r[1])):
+            writer.write(if_id,ts_sec,ts_usec,data,wirelen)
+            n += 1
+        return n
+    finally:
+        writer.close()
+        for reader in readers:
+            reader.close()
+
+
+def pcap_open_offline(fname:str,errbuf:bytearray) -> pcap_handle:
     #pcap_t *pcap_open_offline(const char *fname, char *errbuf);
     if fname is None:
         raise ValueError("El objeto fname no puede ser None")
@@ -59,35 +1686,75 @@ def pcap_open_offline(fname:str,errbuf:bytearray) -> ctypes.c_void_p:
         raise ValueError("El objeto errbuf no puede ser None")
     poo = pcap.pcap_open_offline
     fn =  bytes(str(fname), 'ascii')
-    poo.restype = ctypes.POINTER(ctypes.c_void_p)
     eb = ctypes.create_string_buffer(256)
     handle = poo(fn,eb)
     errbuf.extend(bytes(format(eb.value).encode('ascii')))
-    return handle
+    if handle is None:
+        return None
+    return pcap_handle(handle)
 
 
-def pcap_open_dead(linktype:int,snaplen:int) -> ctypes.c_void_p:
+def pcap_open_dead(linktype:int,snaplen:int) -> pcap_handle:
     #pcap_t *pcap_open_dead(int linktype, int snaplen)
     pod = pcap.pcap_open_dead
-    pod.restype = ctypes.POINTER(ctypes.c_void_p)
-    lt = ctypes.c_int(linktype)
-    sn = ctypes.c_int(snaplen)
-    handle = pod(lt,sn)
+    handle = pod(linktype,snaplen)
+    if handle is None:
+        return None
+    return pcap_handle(handle)
+
+def pcap_open_offline_with_tstamp_precision(fname:str,precision:int,errbuf:bytearray) -> pcap_handle:
+    #pcap_t *pcap_open_offline_with_tstamp_precision(const char *fname, u_int precision, char *errbuf);
+    #libpcap convierte los timestamps de la traza a la precisión pedida
+    if fname is None:
+        raise ValueError("El objeto fname no puede ser None")
+    if errbuf is None:
+        raise ValueError("El objeto errbuf no puede ser None")
+    poo = pcap.pcap_open_offline_with_tstamp_precision
+    fn =  bytes(str(fname), 'ascii')
+    eb = ctypes.create_string_buffer(256)
+    handle = poo(fn,precision,eb)
+    errbuf.extend(bytes(format(eb.value).encode('ascii')))
+    if handle is None:
+        return None
+    handle = pcap_handle(handle)
+    handle.set_precision(precision)
+    return handle
+
+def pcap_open_dead_with_tstamp_precision(linktype:int,snaplen:int,precision:int) -> pcap_handle:
+    #pcap_t *pcap_open_dead_with_tstamp_precision(int linktype, int snaplen, u_int precision);
+    #Los dumpers abiertos sobre este descriptor escriben trazas con la precisión indicada
+    pod = pcap.pcap_open_dead_with_tstamp_precision
+    handle = pod(linktype,snaplen,precision)
+    if handle is None:
+        return None
+    handle = pcap_handle(handle)
+    handle.set_precision(precision)
     return handle
 
-def pcap_dump_open(descr:ctypes.c_void_p, fname:str)-> ctypes.c_void_p:
+class pcap_dumper():
+    #Dumper de libpcap junto con la precisión de timestamps del descriptor con el que se abrió (la de la traza que
+    #escribe). Igual que pcap_handle se pasa directamente a libpcap gracias a _as_parameter_
+    def __init__(self,p:int,precision:int=PCAP_TSTAMP_PRECISION_MICRO):
+        self._as_parameter_ = ctypes.c_void_p(p)
+        self.precision = precision
+
+    def __bool__(self):
+        return self._as_parameter_.value is not None
+
+def pcap_dump_open(descr:pcap_handle, fname:str)-> pcap_dumper:
     #pcap_dumper_t *pcap_dump_open(pcap_t *p, const char *fname);
     if fname is None:
         raise ValueError("El objeto fname no puede ser None")
     if descr is None:
         raise ValueError("El objeto descr no puede ser None")
     pdo = pcap.pcap_dump_open
-    pdo.restype = ctypes.POINTER(ctypes.c_void_p)
     ds = descr
 
     fn =  bytes(str(fname), 'ascii')
     handle = pdo(ds,fn)
-    return handle
+    if handle is None:
+        return None
+    return pcap_dumper(handle,descr.precision)
 
 def pcap_dump(dumper:ctypes.c_void_p,header,data:bytes):
     # void pcap_dump(u_char *user, struct pcap_pkthdr *h,u_char *sp);
@@ -103,37 +1770,123 @@ def pcap_dump(dumper:ctypes.c_void_p,header,data:bytes):
     haux.len = header.len
     haux.caplen = header.caplen
     haux.tv_sec = header.ts.tv_sec
-    haux.tv_usec = header.ts.tv_usec
+    #Un dumper de un descriptor con precisión de nanosegundos espera nanosegundos en tv_usec
+    if getattr(dumper,'precision',PCAP_TSTAMP_PRECISION_MICRO) == PCAP_TSTAMP_PRECISION_NANO:
+        haux.tv_usec = header.ts.tv_nsec
+    else:
+        haux.tv_usec = header.ts.tv_usec
     h = ctypes.byref(haux)
-    d = ctypes.c_char_p(bytes(data))
+    d = data if isinstance(data,bytes) else bytes(data)
     pd(dp,h,d)
 
 
 
-def pcap_open_live(device:str,snaplen:int,promisc:int,to_ms:int,errbuf:bytearray) -> ctypes.c_void_p:
+def pcap_open_live(device:str,snaplen:int,promisc:int,to_ms:int,errbuf:bytearray) -> pcap_handle:
     
     #pcap_t *pcap_open_live(const char *device, int snaplen,int promisc, int to_ms, char *errbuf)
     if device is None:
         raise ValueError("El objeto device no puede ser None")
     pol = pcap.pcap_open_live
-    pol.restype = ctypes.POINTER(ctypes.c_void_p)
     dv =  bytes(str(device), 'ascii')
-    sn = ctypes.c_int(snaplen)
-    tms = ctypes.c_int(to_ms)
-    pr = ctypes.c_int(promisc)
     eb = ctypes.create_string_buffer(256)
-    handle = pol(dv,sn,pr,tms,eb)
+    handle = pol(dv,snaplen,promisc,to_ms,eb)
     errbuf.extend(bytes(format(eb.value).encode('ascii')))
+    if handle is None:
+        return None
+    return pcap_handle(handle)
 
+def pcap_create(device:str,errbuf:bytearray) -> pcap_handle:
+    #pcap_t *pcap_create(const char *source, char *errbuf);
+    if device is None:
+        raise ValueError("El objeto device no puede ser None")
+    if errbuf is None:
+        raise ValueError("El objeto errbuf no puede ser None")
+    pc = pcap.pcap_create
+    dv =  bytes(str(device), 'ascii')
+    eb = ctypes.create_string_buffer(256)
+    handle = pc(dv,eb)
+    errbuf.extend(bytes(format(eb.value).encode('ascii')))
+    if handle is None:
+        return None
+    return pcap_handle(handle)
+
+def pcap_set_snaplen(handle:pcap_handle,snaplen:int) -> int:
+    #int pcap_set_snaplen(pcap_t *p, int snaplen);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return pcap.pcap_set_snaplen(handle,snaplen)
+
+def pcap_set_promisc(handle:pcap_handle,promisc:int) -> int:
+    #int pcap_set_promisc(pcap_t *p, int promisc);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return pcap.pcap_set_promisc(handle,promisc)
+
+def pcap_set_timeout(handle:pcap_handle,to_ms:int) -> int:
+    #int pcap_set_timeout(pcap_t *p, int to_ms);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return pcap.pcap_set_timeout(handle,to_ms)
+
+def pcap_set_buffer_size(handle:pcap_handle,buffer_size:int) -> int:
+    #int pcap_set_buffer_size(pcap_t *p, int buffer_size);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return pcap.pcap_set_buffer_size(handle,buffer_size)
+
+def pcap_set_immediate_mode(handle:pcap_handle,immediate_mode:int) -> int:
+    #int pcap_set_immediate_mode(pcap_t *p, int immediate_mode);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return pcap.pcap_set_immediate_mode(handle,immediate_mode)
+
+def pcap_set_tstamp_precision(handle:pcap_handle,tstamp_precision:int) -> int:
+    #int pcap_set_tstamp_precision(pcap_t *p, int tstamp_precision);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    ret = pcap.pcap_set_tstamp_precision(handle,tstamp_precision)
+    if ret == 0:
+        handle.set_precision(tstamp_precision)
+    return ret
+
+def pcap_activate(handle:pcap_handle) -> int:
+    #int pcap_activate(pcap_t *p);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return pcap.pcap_activate(handle)
+
+def pcap_open_live_ext(device:str,snaplen:int,promisc:int,to_ms:int,errbuf:bytearray,buffer_size:int=0,
+                       immediate:bool=False,tstamp_precision:int=PCAP_TSTAMP_PRECISION_MICRO) -> pcap_handle:
+    #Versión extendida de pcap_open_live basada en pcap_create/pcap_activate. Permite fijar antes de activar la
+    #interfaz el tamaño del buffer del kernel (buffer_size en bytes, 0 para el valor por defecto), el modo inmediato
+    #(entrega cada paquete sin esperar al timeout) y la precisión de los timestamps
+    handle = pcap_create(device,errbuf)
+    if handle is None:
+        return None
+    pcap_set_snaplen(handle,snaplen)
+    pcap_set_promisc(handle,promisc)
+    pcap_set_timeout(handle,to_ms)
+    if buffer_size > 0:
+        pcap_set_buffer_size(handle,buffer_size)
+    if immediate:
+        pcap_set_immediate_mode(handle,1)
+    if tstamp_precision != PCAP_TSTAMP_PRECISION_MICRO:
+        pcap_set_tstamp_precision(handle,tstamp_precision)
+    ret = pcap_activate(handle)
+    if ret < 0:
+        #Error al activar: se devuelve el motivo en errbuf igual que pcap_open_live
+        msg = handle.geterr() or pcap.pcap_statustostr(ret).decode('ascii','replace')
+        errbuf.extend(bytes(msg.encode('ascii','replace')))
+        pcap_close(handle)
+        return None
     return handle
 
-def pcap_close(handle:ctypes.c_void_p):
+def pcap_close(handle:pcap_handle):
     #void pcap_close(pcap_t *p);
 
     if handle is None:
         raise ValueError("El objeto handle no puede ser None")
-    pc = pcap.pcap_close
-    pc(handle)
+    handle.close()
 
 def pcap_dump_close(handle:ctypes.c_void_p):
     #void pcap_close(pcap_dumper_t *p);
@@ -142,62 +1895,189 @@ def pcap_dump_close(handle:ctypes.c_void_p):
     pdc = pcap.pcap_dump_close
     pdc(handle)
 
-def pcap_next(handle:ctypes.c_void_p,header)-> bytes:
+def pcap_next(handle:pcap_handle,header)-> bytes:
     #const u_char *pcap_next(pcap_t *p, struct pcap_pkthdr *h)
     if handle is None:
         raise ValueError("El objeto handle no puede ser None")
     pn = pcap.pcap_next
-    pn.restype = ctypes.c_char_p
     h = pcappkthdr()
     aux = pn(handle,ctypes.byref(h))
+    if not aux:
+        return None
     header.len = h.len
     header.caplen = h.caplen
-    header.ts = timeval(h.tv_sec,h.tv_usec)
-    return bytes(aux)
+    header.ts = timeval(h.tv_sec,tv_nsec=h.tv_usec * handle.ts_mult)
+    return ctypes.string_at(aux,h.caplen)
 
+def pcap_next_ex(handle:pcap_handle,header) -> tuple:
+    #int pcap_next_ex(pcap_t *p, struct pcap_pkthdr **pkt_header, const u_char **pkt_data);
+    #Devuelve una tupla (ret, data). Si ret es 1 rellena header y data contiene el paquete completo (caplen bytes)
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if header is None:
+        raise ValueError("El objeto header no puede ser None")
+    ret,h,data = handle.next_ex()
+    if ret == 1:
+        header.len = h.len
+        header.caplen = h.caplen
+        header.ts = h.ts
+    return ret,data
 
-def pcap_loop(handle:ctypes.c_void_p,cnt:int,callback_fun: Callable[[ctypes.c_void_p,pcap_pkthdr,bytes],None],user:ctypes.c_void_p) -> int:
-    global user_callback
+def pcap_capture(handle:pcap_handle,cnt:int=-1,timeouts:bool=False):
+    #Generador sobre pcap_next_ex que produce tuplas (pcap_pkthdr, bytes): for header,data in pcap_capture(handle): ...
+    #La iteración termina tras cnt paquetes (si cnt >= 0), al final de la traza o tras pcap_breakloop. Si timeouts
+    #es True se produce None cada vez que vence el timeout de lectura sin paquetes. Los errores de captura se
+    #notifican con RuntimeError
     if handle is None:
         raise ValueError("El objeto handle no puede ser None")
-   
-    user_callback = callback_fun
-    #  typedef void (*pcap_handler)(u_char *user, const struct pcap_pkthdr *h,const u_char *bytes);
-    PCAP_HANDLER = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p,ctypes.POINTER(pcappkthdr),ctypes.POINTER(ctypes.c_uint8))
-    cf = PCAP_HANDLER(mycallback)
+    n = 0
+    while cnt < 0 or n < cnt:
+        ret,header,data = handle.next_ex()
+        if ret == 1:
+            n += 1
+            #El tiempo entre la entrega del paquete y la siguiente petición es lo que tarda el consumidor en procesarlo
+            t0 = time.perf_counter_ns()
+            yield header,data
+            handle.record(header.caplen,time.perf_counter_ns() - t0)
+        elif ret == 0:
+            if timeouts:
+                yield None
+        elif ret == PCAP_ERROR_BREAK:
+            return
+        else:
+            raise RuntimeError(handle.geterr())
+
+
+def pcap_loop(handle:pcap_handle,cnt:int,callback_fun: Callable[[ctypes.c_void_p,pcap_pkthdr,bytes],None],user:ctypes.c_void_p) -> int:
     #int pcap_loop(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
-    pl = pcap.pcap_loop
-    pl.restype = ctypes.c_int
-    us = ctypes.c_void_p(user)
-    c = ctypes.c_int(cnt)
-    ret = pl(handle,c,cf,us)
-    user_callback = None
-    return ret
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return handle.loop(cnt,callback_fun,user)
 
-def pcap_dispatch(handle:ctypes.c_void_p,cnt:int,callback_fun:Callable[[ctypes.c_void_p,pcap_pkthdr,bytes],None],user:ctypes.c_void_p) -> int:
-    global user_callback
+def pcap_dispatch(handle:pcap_handle,cnt:int,callback_fun:Callable[[ctypes.c_void_p,pcap_pkthdr,bytes],None],user:ctypes.c_void_p) -> int:
+    #int pcap_dispatch(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
     if handle is None:
         raise ValueError("El objeto handle no puede ser None")
-    user_callback = callback_fun
-    #  typedef void (*pcap_handler)(u_char *user, const struct pcap_pkthdr *h,const u_char *bytes);
-    PCAP_HANDLER = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p,ctypes.POINTER(pcappkthdr),ctypes.POINTER(ctypes.c_uint8))
-    cf = PCAP_HANDLER(mycallback)
-    #int pcap_loop(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
-    pd = pcap.pcap_dispatch
-    pd.restype = ctypes.c_int
-    us = ctypes.c_void_p(user)
-    c = ctypes.c_int(cnt)
-    ret = pd(handle,c,cf,us)
-    user_callback = None
-    return ret
-def pcap_breakloop(handle:ctypes.c_void_p):
+    return handle.dispatch(cnt,callback_fun,user)
+
+def pcap_breakloop(handle:pcap_handle):
     #void pcap_breakloop(pcap_t *);
     if handle is None:
         raise ValueError("El objeto handle no puede ser None")
-    pbl = pcap.pcap_breakloop
-    pbl(handle)
+    handle.breakloop()
+    #Un lector asyncio solo volvería a llamar a dispatch (y vería la petición) con el siguiente evento del descriptor
+    reader = handle.async_reader
+    if reader is not None:
+        reader.wakeup()
+
+def pcap_get_selectable_fd(handle:pcap_handle) -> int:
+    #int pcap_get_selectable_fd(pcap_t *p);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return handle.fileno()
+
+def pcap_setnonblock(handle:pcap_handle,nonblock:int,errbuf:bytearray) -> int:
+    #int pcap_setnonblock(pcap_t *p, int nonblock, char *errbuf);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if errbuf is None:
+        raise ValueError("El objeto errbuf no puede ser None")
+    return handle.setnonblock(nonblock,errbuf)
+
+def pcap_getnonblock(handle:pcap_handle,errbuf:bytearray) -> int:
+    #int pcap_getnonblock(pcap_t *p, char *errbuf);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if errbuf is None:
+        raise ValueError("El objeto errbuf no puede ser None")
+    return handle.getnonblock(errbuf)
+
+class pcap_async_reader():
+    '''
+        Lector de paquetes para asyncio. Pone el descriptor en modo no bloqueante y registra su descriptor
+        seleccionable con loop.add_reader; cada vez que el descriptor es legible se vacía con pcap_dispatch (o con
+        pcap_dispatch_batch si batch > 0, en cuyo caso callback_fun recibe (user, lista de paquetes)). Así un único
+        bucle de eventos puede atender varias interfaces, temporizadores y otras corrutinas sin un hilo por interfaz.
+        budget limita las llamadas a dispatch por evento para no acaparar el bucle durante una ráfaga.
+        pcap_breakloop (desde cualquier hilo) termina la lectura aunque no lleguen más paquetes.
+        Solo tiene sentido con interfaces en vivo (pcap_open_live*, tpacket_open_live).
+    '''
+    def __init__(self,handle:pcap_handle,callback_fun,user=None,loop:asyncio.AbstractEventLoop=None,batch:int=0,
+                 budget:int=64):
+        if handle is None:
+            raise ValueError("El objeto handle no puede ser None")
+        if callback_fun is None:
+            raise ValueError("El objeto callback_fun no puede ser None")
+        self.handle = handle
+        self.callback = callback_fun
+        self.user = user
+        self.loop = loop
+        self.batch = batch
+        self.budget = budget
+        self.fd = -1
+        self.done = None
+
+    def start(self):
+        #Debe llamarse desde el hilo del bucle (o antes de arrancarlo si se pasa loop)
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        errbuf = bytearray()
+        if pcap_setnonblock(self.handle,1,errbuf) != 0:
+            raise RuntimeError(errbuf.decode('ascii','replace'))
+        self.fd = pcap_get_selectable_fd(self.handle)
+        if self.fd < 0:
+            raise RuntimeError("El descriptor no tiene un fd seleccionable")
+        self.done = self.loop.create_future()
+        self.handle.async_reader = self
+        self.loop.add_reader(self.fd,self.on_readable)
 
-def pcap_inject(handle:ctypes.c_void_p,buf:bytes,size:int) -> int:
+    def on_readable(self):
+        ret = 0
+        for _ in range(self.budget):
+            if self.batch > 0:
+                packets = []
+                ret = pcap_dispatch_batch(self.handle,self.batch,packets)
+                if packets:
+                    self.callback(self.user,packets)
+            else:
+                ret = pcap_dispatch(self.handle,-1,self.callback,self.user)
+            if ret <= 0:
+                break
+        if ret < 0:
+            self.finish(ret)
+
+    def wakeup(self):
+        #La llama pcap_breakloop, quizá desde otro hilo: la petición se atiende en el hilo del bucle
+        self.loop.call_soon_threadsafe(self.on_break)
+
+    def on_break(self):
+        if self.fd < 0:
+            return
+        #Se vacía lo pendiente; dispatch devuelve PCAP_ERROR_BREAK (y consume la petición) si lo detecta
+        self.on_readable()
+        if self.fd >= 0:
+            self.finish(PCAP_ERROR_BREAK)
+
+    def finish(self,ret:int):
+        if self.fd >= 0:
+            self.loop.remove_reader(self.fd)
+            self.fd = -1
+            self.handle.async_reader = None
+        if self.done is not None and not self.done.done():
+            if ret == PCAP_ERROR:
+                self.done.set_exception(RuntimeError(self.handle.geterr()))
+            else:
+                self.done.set_result(ret)
+
+    def stop(self):
+        #Deja de leer; no cierra el descriptor
+        self.finish(0)
+
+    async def wait(self) -> int:
+        #Espera a que termine la lectura: 0 tras stop, PCAP_ERROR_BREAK tras pcap_breakloop
+        return await self.done
+
+def pcap_inject(handle:pcap_handle,buf:bytes,size:int) -> int:
     #int pcap_inject(pcap_t *p, const void *buf, size_t size);
     if handle is None:
         raise ValueError("El objeto handle no puede ser None")
@@ -205,12 +2085,722 @@ def pcap_inject(handle:ctypes.c_void_p,buf:bytes,size:int) -> int:
         raise ValueError("El objeto buf no puede ser None")
     if not isinstance(buf, bytes):
         raise ValueError("El objeto buf debe ser de tipo bytes()")
+    if isinstance(handle,tpacket_handle):
+        return handle.inject(buf[:size])
+    pi = pcap.pcap_inject
+    ret = pi(handle,buf,size)
+    return ret
+
+def pcap_inject_batch(handle:pcap_handle,frames:list) -> int:
+    #Envía una lista de tramas (bytes) y devuelve cuántas se han enviado. Con el backend tpacket se usa sendmmsg;
+    #con libpcap, que no tiene envío por lotes, se llama a pcap_inject para cada trama y se para en el primer error
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if frames is None:
+        raise ValueError("El objeto frames no puede ser None")
+    if isinstance(handle,tpacket_handle):
+        return handle.inject_batch(frames)
     pi = pcap.pcap_inject
-    pi.restype = ctypes.c_int
-    ret = pi(handle,ctypes.c_char_p(buf),ctypes.c_longlong(size))
+    sent = 0
+    for frame in frames:
+        if pi(handle,frame,len(frame)) != len(frame):
+            break
+        sent += 1
+    return sent
+
+def pcap_compile(handle:pcap_handle,program:bpf_program,filter:str,optimize:int,netmask:int) -> int:
+    #int pcap_compile(pcap_t *p, struct bpf_program *fp, const char *str, int optimize, bpf_u_int32 netmask);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if program is None:
+        raise ValueError("El objeto program no puede ser None")
+    if filter is None:
+        raise ValueError("El objeto filter no puede ser None")
+    pc = pcap.pcap_compile
+    ret = pc(handle,ctypes.byref(program),bytes(str(filter), 'ascii'),optimize,netmask)
     return ret
 
+def pcap_setfilter(handle:pcap_handle,program:bpf_program) -> int:
+    #int pcap_setfilter(pcap_t *p, struct bpf_program *fp);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if program is None:
+        raise ValueError("El objeto program no puede ser None")
+    psf = pcap.pcap_setfilter
+    ret = psf(handle,ctypes.byref(program))
+    return ret
+
+def pcap_freecode(program:bpf_program):
+    #void pcap_freecode(struct bpf_program *fp);
+    if program is None:
+        raise ValueError("El objeto program no puede ser None")
+    pfc = pcap.pcap_freecode
+    pfc(ctypes.byref(program))
+
+def pcap_apply_filter(handle:pcap_handle,filter:str) -> int:
+    #Compila, instala y libera un filtro BPF en un solo paso. Devuelve 0 si todo es correcto, -1 en otro caso
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if filter is None:
+        raise ValueError("El objeto filter no puede ser None")
+    return handle.setfilter(filter)
+
+
+#Tamaño máximo del buffer de un lote. Con snaplen grandes (262144 por defecto) se piden menos paquetes por lote
+PCAP_BATCH_BUDGET = 4 << 20
+
+class pcap_batch_context():
+    '''
+        Buffer preasignado sobre el que libpcap vuelca los paquetes de pcap_dispatch_batch. El buffer se
+        abre como FILE* con fmemopen y se asocia a un dumper de libpcap, de forma que pcap_dispatch puede
+        usar directamente pcap_dump como callback y rellenar el lote completo sin volver a Python.
+        Como pcap_dispatch no se puede detener a mitad de lote, el buffer debe admitir max_pkts paquetes de
+        snaplen bytes: si eso supera PCAP_BATCH_BUDGET se reduce max_pkts (como mínimo 1 paquete por lote).
+    '''
+    def __init__(self,handle:pcap_handle,max_pkts:int):
+        snaplen = pcap.pcap_snapshot(handle)
+        reclen = PCAP_REC_HDR_LEN + snaplen
+        self.requested = max_pkts
+        self.max_pkts = max(1,min(max_pkts,PCAP_BATCH_BUDGET // reclen))
+        self.size = PCAP_FILE_HDR_LEN + self.max_pkts * reclen
+        self.buf = ctypes.create_string_buffer(self.size)
+        self.view = memoryview(self.buf).cast('B')
+        self.fp = libc.fmemopen(self.buf,self.size,b'w')
+        if not self.fp:
+            raise OSError(ctypes.get_errno(),'fmemopen')
+        self.dumper = pcap.pcap_dump_fopen(handle,self.fp)
+        if not self.dumper:
+            libc.fclose(self.fp)
+            raise OSError('pcap_dump_fopen: {}'.format(handle.geterr()))
+        #pcap_dump escribe las cabeceras de registro en el orden de bytes de la máquina
+        self.rechdr = struct.Struct('=IIII')
+
+    def close(self):
+        #pcap_dump_close cierra también el FILE* de fmemopen
+        pcap.pcap_dump_close(self.dumper)
+        self.dumper = None
+
+def pcap_batch_close(handle:pcap_handle):
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if handle.batch is not None:
+        handle.batch.close()
+        handle.batch = None
+
+def pcap_dispatch_batch(handle:pcap_handle,max_pkts:int,packets:list,copy:bool=True) -> int:
+    #Equivalente a pcap_dispatch pero sin callback por paquete: se procesan hasta max_pkts paquetes en una
+    #única llamada a libpcap y se añaden a packets como tuplas (pcap_pkthdr, datos). Si copy es False los
+    #datos son memoryview sobre el buffer del lote, que solo son válidos hasta la siguiente llamada.
+    #Devuelve lo mismo que pcap_dispatch: número de paquetes, 0, -1 (error) o -2 (pcap_breakloop)
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if packets is None:
+        raise ValueError("El objeto packets no puede ser None")
+    if max_pkts <= 0:
+        raise ValueError("max_pkts debe ser mayor que 0")
+    if isinstance(handle,tpacket_handle):
+        return handle.dispatch_batch(max_pkts,packets,copy)
+    ctx = handle.batch
+    if ctx is None or ctx.requested < max_pkts:
+        pcap_batch_close(handle)
+        ctx = handle.batch = pcap_batch_context(handle,max_pkts)
+    #Se rebobina el FILE* justo detrás de la cabecera de fichero que escribió pcap_dump_fopen
+    libc.fseek(ctx.fp,PCAP_FILE_HDR_LEN,0)
+    ret = pcap.pcap_dispatch(handle,min(max_pkts,ctx.max_pkts),pcap_dump_handler,ctx.dumper)
+    pcap.pcap_dump_flush(ctx.dumper)
+    end = pcap.pcap_dump_ftell(ctx.dumper)
+    view = ctx.view
+    unpack = ctx.rechdr.unpack_from
+    ts_mult = handle.ts_mult
+    off = PCAP_FILE_HDR_LEN
+    while off + PCAP_REC_HDR_LEN <= end:
+        tv_sec,tv_usec,caplen,wirelen = unpack(view,off)
+        off += PCAP_REC_HDR_LEN
+        if off + caplen > end:
+            break
+        data = view[off:off + caplen]
+        packets.append((pcap_pkthdr(wirelen,caplen,timeval(tv_sec,tv_nsec=tv_usec * ts_mult)),bytes(data) if copy else data))
+        off += caplen
+        handle.packets += 1
+        handle.bytes += caplen
+    return ret
+
+def pcap_dispatch_columns(handle:pcap_handle,max_pkts:int,cols:pcap_columns,copy:bool=True) -> int:
+    #Como pcap_dispatch_batch pero las cabeceras se devuelven en columnas (pcap_columns), sin crear ningún objeto
+    #por paquete. cols se vacía y se llena con el lote. Si copy es True cols.data es una copia de los datos del
+    #lote (una sola copia por lote); si no, es un memoryview sobre el buffer del lote, válido hasta la siguiente
+    #llamada. Devuelve lo mismo que pcap_dispatch
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if cols is None:
+        raise ValueError("El objeto cols no puede ser None")
+    if max_pkts <= 0:
+        raise ValueError("max_pkts debe ser mayor que 0")
+    if isinstance(handle,tpacket_handle):
+        return handle.dispatch_columns(max_pkts,cols,copy)
+    cols.clear()
+    ctx = handle.batch
+    if ctx is None or ctx.requested < max_pkts:
+        pcap_batch_close(handle)
+        ctx = handle.batch = pcap_batch_context(handle,max_pkts)
+    libc.fseek(ctx.fp,PCAP_FILE_HDR_LEN,0)
+    ret = pcap.pcap_dispatch(handle,min(max_pkts,ctx.max_pkts),pcap_dump_handler,ctx.dumper)
+    pcap.pcap_dump_flush(ctx.dumper)
+    end = pcap.pcap_dump_ftell(ctx.dumper)
+    view = ctx.view
+    unpack = ctx.rechdr.unpack_from
+    mult = handle.ts_mult
+    ts_ns,caplens,lens,offsets = cols.ts_ns,cols.caplen,cols.len,cols.offset
+    off = PCAP_FILE_HDR_LEN
+    while off + PCAP_REC_HDR_LEN <= end:
+        tv_sec,tv_frac,caplen,wirelen = unpack(view,off)
+        off += PCAP_REC_HDR_LEN
+        if off + caplen > end:
+            break
+        ts_ns.append(tv_sec * 1000000000 + tv_frac * mult)
+        caplens.append(caplen)
+        lens.append(wirelen)
+        #Con copia los datos empiezan en 0 en lugar de en PCAP_FILE_HDR_LEN
+        offsets.append(off - PCAP_FILE_HDR_LEN if copy else off)
+        off += caplen
+        handle.packets += 1
+        handle.bytes += caplen
+    cols.data = bytes(view[PCAP_FILE_HDR_LEN:off]) if copy else view
+    return ret
+
+
+def pcap_stats(handle:pcap_handle,stats:pcap_stat) -> int:
+    #int pcap_stats(pcap_t *p, struct pcap_stat *ps);
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    if stats is None:
+        raise ValueError("El objeto stats no puede ser None")
+    ps = pcap.pcap_stats
+    ret = ps(handle,ctypes.byref(stats))
+    return ret
+
+def pcap_get_stats(handle:pcap_handle) -> pcap_capture_stats:
+    #Devuelve una instantánea con los contadores de libpcap y del lado Python. Se puede llamar desde otro hilo
+    #mientras la captura está en marcha
+    if handle is None:
+        raise ValueError("El objeto handle no puede ser None")
+    return handle.stats()
+
+
+#Constantes de linux/if_packet.h para el backend TPACKET_V3
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+SO_ATTACH_FILTER = 26
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_PROMISC = 1
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_FANOUT = 18
+#Modos de reparto de PACKET_FANOUT: por hash de flujo, por turnos o por CPU que recibe el paquete
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_LB = 1
+PACKET_FANOUT_CPU = 2
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+class sock_fprog(ctypes.Structure):
+    _fields_ = [("len", ctypes.c_ushort), ("filter", ctypes.POINTER(bpf_insn))]
+
+class tpacket_handle():
+    '''
+        Backend de captura que no usa libpcap: un socket AF_PACKET con un anillo PACKET_RX_RING TPACKET_V3 mapeado
+        en memoria. El kernel llena bloques completos de paquetes y aquí se recorren sus descriptores directamente,
+        sin ninguna llamada al sistema por paquete. Ofrece los mismos métodos que pcap_handle (loop, dispatch,
+        next_ex, breakloop, setfilter, stats, close...) así que se puede usar con pcap_loop, pcap_dispatch,
+        pcap_dispatch_batch, pcap_capture, pcap_inject, pcap_get_stats y pcap_close.
+        Si zero_copy es True los datos de cada paquete son memoryview sobre el anillo, válidos solo hasta que
+        termina el callback (o hasta la siguiente llamada a next_ex); en otro caso se entregan como bytes.
+    '''
+    def __init__(self,device:str,snaplen:int,promisc:int,to_ms:int,block_size:int=1 << 20,block_nr:int=16,
+                 frame_size:int=2048,zero_copy:bool=True):
+        self.device = device
+        self.snaplen = snaplen
+        self.timeout = to_ms if to_ms > 0 else -1
+        self.nonblock = False
+        self.tx = None
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.zero_copy = zero_copy
+        self.batch = None
+        #El anillo entrega siempre nanosegundos (ver make_header)
+        self.precision = PCAP_TSTAMP_PRECISION_NANO
+        self.ts_mult = 1
+        self.errmsg = ''
+        self.break_loop = False
+        self.async_reader = None
+        self.mm = None
+        self.view = None
+        self.sock = socket.socket(socket.AF_PACKET,socket.SOCK_RAW,socket.htons(ETH_P_ALL))
+        try:
+            self.sock.setsockopt(SOL_PACKET,PACKET_VERSION,TPACKET_V3)
+            #struct tpacket_req3: block_size, block_nr, frame_size, frame_nr, retire_blk_tov, sizeof_priv, feature_req_word
+            frame_nr = block_size * block_nr // frame_size
+            self.sock.setsockopt(SOL_PACKET,PACKET_RX_RING,struct.pack('=7I',block_size,block_nr,frame_size,frame_nr,max(to_ms,1),0,0))
+            self.mm = mmap.mmap(self.sock.fileno(),block_size * block_nr,mmap.MAP_SHARED,mmap.PROT_READ | mmap.PROT_WRITE)
+            self.view = memoryview(self.mm)
+            self.sock.bind((device,ETH_P_ALL))
+            if promisc:
+                #struct packet_mreq: ifindex, type, alen, address
+                mreq = struct.pack('=iHH8s',socket.if_nametoindex(device),PACKET_MR_PROMISC,0,b'')
+                self.sock.setsockopt(SOL_PACKET,PACKET_ADD_MEMBERSHIP,mreq)
+        except OSError:
+            self.close()
+            raise
+        self.poller = select.poll()
+        self.poller.register(self.sock.fileno(),select.POLLIN | select.POLLERR)
+        #Estado del recorrido del anillo: bloque actual, paquetes pendientes en él y bloque a devolver al kernel
+        self.cur = 0
+        self.pkt_left = 0
+        self.pkt_off = 0
+        self.done_block = None
+        self.blkhdr = struct.Struct('=III')
+        #struct tpacket3_hdr: next_offset, sec, nsec, snaplen, len, status, mac, net
+        self.pkthdr = struct.Struct('=IIIIIIHH')
+        self.packets = 0
+        self.bytes = 0
+        self.histogram = [0] * STATS_HIST_BUCKETS
+        self.kstats = [0,0]
+
+    def __bool__(self):
+        return self.sock is not None
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def set_fanout(self,group_id:int,mode:int=PACKET_FANOUT_HASH):
+        #Une el socket al grupo PACKET_FANOUT group_id: el kernel reparte los paquetes entre todos los sockets del grupo
+        self.sock.setsockopt(SOL_PACKET,PACKET_FANOUT,(group_id & 0xffff) | (mode << 16))
+
+    def setnonblock(self,nonblock:int,errbuf:bytearray) -> int:
+        #En modo no bloqueante dispatch y next_ex no esperan en poll: si el anillo está vacío devuelven 0
+        self.nonblock = bool(nonblock)
+        return 0
+
+    def getnonblock(self,errbuf:bytearray) -> int:
+        return int(self.nonblock)
+
+    def read_packet(self,timeout:int):
+        #Devuelve (sec, nsec, caplen, len, off) del siguiente paquete del anillo o None si vence el timeout; los
+        #datos del paquete son self.view[off:off + caplen].
+        #El bloque anterior se devuelve al kernel al pedir el siguiente paquete, de modo que los datos del
+        #último paquete entregado siguen siendo válidos hasta esta llamada
+        mm = self.mm
+        if self.done_block is not None:
+            struct.pack_into('=I',mm,self.done_block + 8,TP_STATUS_KERNEL)
+            self.done_block = None
+            self.cur = (self.cur + 1) % self.block_nr
+        if self.pkt_left == 0:
+            off = self.cur * self.block_size
+            #struct tpacket_block_desc: version, offset_to_priv, block_status, num_pkts, offset_to_first_pkt...
+            if not struct.unpack_from('=I',mm,off + 8)[0] & TP_STATUS_USER:
+                if timeout == 0 or not self.poller.poll(timeout):
+                    return None
+                if not struct.unpack_from('=I',mm,off + 8)[0] & TP_STATUS_USER:
+                    return None
+            status,num_pkts,first = self.blkhdr.unpack_from(mm,off + 8)
+            if num_pkts == 0:
+                self.done_block = off
+                return None
+            self.pkt_left = num_pkts
+            self.pkt_off = off + first
+        pkt = self.pkt_off
+        next_offset,sec,nsec,caplen,wirelen,status,mac,net = self.pkthdr.unpack_from(mm,pkt)
+        if caplen > self.snaplen:
+            caplen = self.snaplen
+        self.pkt_left -= 1
+        if self.pkt_left == 0:
+            self.done_block = self.cur * self.block_size
+        else:
+            self.pkt_off = pkt + next_offset
+        return sec,nsec,caplen,wirelen,pkt + mac
+
+    def make_header(self,sec:int,nsec:int,caplen:int,wirelen:int) -> pcap_pkthdr:
+        return pcap_pkthdr(wirelen,caplen,timeval(sec,tv_nsec=nsec))
+
+    def record(self,caplen:int,elapsed_ns:int):
+        self.packets += 1
+        self.bytes += caplen
+        self.histogram[min(elapsed_ns.bit_length(),STATS_HIST_BUCKETS - 1)] += 1
+
+    def dispatch(self,cnt:int,callback_fun,user) -> int:
+        #Como pcap_dispatch: procesa como mucho un bloque del anillo (o cnt paquetes si cnt > 0)
+        if self.break_loop:
+            self.break_loop = False
+            return PCAP_ERROR_BREAK
+        n = 0
+        pkt = self.read_packet(0 if self.nonblock else self.timeout)
+        while pkt is not None:
+            sec,nsec,caplen,wirelen,off = pkt
+            data = self.view[off:off + caplen]
+            header = self.make_header(sec,nsec,caplen,wirelen)
+            t0 = time.perf_counter_ns()
+            callback_fun(user,header,data if self.zero_copy else bytes(data))
+            self.record(caplen,time.perf_counter_ns() - t0)
+            n += 1
+            if (cnt > 0 and n >= cnt) or self.pkt_left == 0:
+                break
+            pkt = self.read_packet(0)
+        return n
+
+    def loop(self,cnt:int,callback_fun,user) -> int:
+        n = 0
+        while cnt <= 0 or n < cnt:
+            ret = self.dispatch(cnt - n if cnt > 0 else -1,callback_fun,user)
+            if ret < 0:
+                return ret
+            n += ret
+        return 0
+
+    def dispatch_batch(self,max_pkts:int,packets:list,copy:bool=True) -> int:
+        #Como pcap_dispatch_batch: añade a packets como mucho un bloque del anillo (o max_pkts paquetes)
+        if self.break_loop:
+            self.break_loop = False
+            return PCAP_ERROR_BREAK
+        n = 0
+        pkt = self.read_packet(0 if self.nonblock else self.timeout)
+        while pkt is not None:
+            sec,nsec,caplen,wirelen,off = pkt
+            data = self.view[off:off + caplen]
+            packets.append((self.make_header(sec,nsec,caplen,wirelen),bytes(data) if copy else data))
+            self.packets += 1
+            self.bytes += caplen
+            n += 1
+            if n >= max_pkts or self.pkt_left == 0:
+                break
+            pkt = self.read_packet(0)
+        return n
+
+    def dispatch_columns(self,max_pkts:int,cols:'pcap_columns',copy:bool=True) -> int:
+        #Como pcap_dispatch_columns: llena cols con como mucho un bloque del anillo (o max_pkts paquetes). Sin copia
+        #cols.data es el anillo completo y los desplazamientos apuntan dentro de él
+        cols.clear()
+        if self.break_loop:
+            self.break_loop = False
+            return PCAP_ERROR_BREAK
+        n = 0
+        buf = bytearray() if copy else None
+        view = self.view
+        pkt = self.read_packet(0 if self.nonblock else self.timeout)
+        while pkt is not None:
+            sec,nsec,caplen,wirelen,off = pkt
+            cols.ts_ns.append(sec * 1000000000 + nsec)
+            cols.caplen.append(caplen)
+            cols.len.append(wirelen)
+            if copy:
+                cols.offset.append(len(buf))
+                buf += view[off:off + caplen]
+            else:
+                cols.offset.append(off)
+            self.packets += 1
+            self.bytes += caplen
+            n += 1
+            if n >= max_pkts or self.pkt_left == 0:
+                break
+            pkt = self.read_packet(0)
+        cols.data = buf if copy else view
+        return n
+
+    def next_ex(self) -> tuple:
+        if self.break_loop:
+            self.break_loop = False
+            return PCAP_ERROR_BREAK,None,None
+        pkt = self.read_packet(0 if self.nonblock else self.timeout)
+        if pkt is None:
+            return 0,None,None
+        sec,nsec,caplen,wirelen,off = pkt
+        data = self.view[off:off + caplen]
+        return 1,self.make_header(sec,nsec,caplen,wirelen),data if self.zero_copy else bytes(data)
+
+    def breakloop(self):
+        self.break_loop = True
+
+    def inject(self,buf:bytes) -> int:
+        try:
+            return self.sock.send(buf)
+        except OSError as e:
+            self.errmsg = str(e)
+            return PCAP_ERROR
+
+    def inject_batch(self,frames:list) -> int:
+        if self.tx is None:
+            self.tx = packet_tx_socket(self.device,self.sock)
+        sent = self.tx.send_batch(frames)
+        if sent < len(frames):
+            self.errmsg = self.tx.errmsg
+        return sent
+
+    def setfilter(self,filter:str) -> int:
+        #Se compila el filtro con libpcap sobre un descriptor muerto y se instala en el socket con SO_ATTACH_FILTER
+        dead = pcap_open_dead(DLT_EN10MB,self.snaplen)
+        program = bpf_program()
+        try:
+            if pcap_compile(dead,program,filter,1,PCAP_NETMASK_UNKNOWN) != 0:
+                self.errmsg = dead.geterr()
+                return -1
+            try:
+                fprog = sock_fprog(program.bf_len,program.bf_insns)
+                self.sock.setsockopt(socket.SOL_SOCKET,SO_ATTACH_FILTER,bytes(fprog))
+            finally:
+                #El kernel copia el programa, así que se libera tanto si se ha instalado como si no
+                pcap_freecode(program)
+            return 0
+        except OSError as e:
+            self.errmsg = str(e)
+            return -1
+        finally:
+            pcap_close(dead)
+
+    def geterr(self) -> str:
+        return self.errmsg
+
+    def stats(self) -> pcap_capture_stats:
+        st = pcap_capture_stats()
+        if self:
+            #struct tpacket_stats_v3: tp_packets, tp_drops, tp_freeze_q_cnt. El kernel los pone a 0 en cada lectura
+            packets,drops,freeze = struct.unpack('=III',self.sock.getsockopt(SOL_PACKET,PACKET_STATISTICS,12))
+            self.kstats[0] += packets
+            self.kstats[1] += drops
+            st.recv = self.kstats[0]
+            st.drop = self.kstats[1]
+            st.ifdrop = 0
+        st.packets = self.packets
+        st.bytes = self.bytes
+        st.histogram = list(self.histogram)
+        return st
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                pass
+            self.mm = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def tpacket_open_live(device:str,snaplen:int,promisc:int,to_ms:int,errbuf:bytearray,block_size:int=1 << 20,
+                      block_nr:int=16,zero_copy:bool=True) -> tpacket_handle:
+    #Abre una interfaz con el backend TPACKET_V3 (ver tpacket_handle). Igual que pcap_open_live devuelve None y
+    #deja el motivo en errbuf si no se puede abrir. block_size debe ser múltiplo del tamaño de página
+    if device is None:
+        raise ValueError("El objeto device no puede ser None")
+    if errbuf is None:
+        raise ValueError("El objeto errbuf no puede ser None")
+    try:
+        return tpacket_handle(device,snaplen,promisc,to_ms,block_size,block_nr,zero_copy=zero_copy)
+    except OSError as e:
+        errbuf.extend(bytes(str(e).encode('ascii','replace')))
+        return None
+
+#Número máximo de mensajes por llamada a sendmmsg (UIO_MAXIOV)
+SENDMMSG_MAX = 1024
+
+class packet_tx_socket():
+    '''
+        Socket AF_PACKET de solo envío que transmite listas de tramas con sendmmsg: una única llamada al sistema
+        (y un único cruce ctypes) por cada SENDMMSG_MAX tramas en lugar de uno por trama como pcap_inject.
+        Las tramas deben ser bytes con la cabecera Ethernet incluida; no se copian. Si se pasa sock se envía por ese
+        socket (ya asociado a la interfaz) y close no lo cierra.
+    '''
+    def __init__(self,device:str,sock:socket.socket=None):
+        if device is None:
+            raise ValueError("El objeto device no puede ser None")
+        self.own = sock is None
+        if sock is None:
+            #Protocolo 0: el socket no recibe nada, solo se usa para enviar
+            sock = socket.socket(socket.AF_PACKET,socket.SOCK_RAW,0)
+            try:
+                sock.bind((device,0))
+            except OSError:
+                sock.close()
+                raise
+        self.sock = sock
+        self.errmsg = ''
+        #Vectores de mensajes preparados una sola vez: cada mmsghdr apunta a su iovec
+        self.iov = (iovec * SENDMMSG_MAX)()
+        self.msgs = (mmsghdr * SENDMMSG_MAX)()
+        for i in range(SENDMMSG_MAX):
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iov[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send_batch(self,frames:list) -> int:
+        #Envía las tramas en orden y devuelve cuántas se han enviado. Si hay un error se para y el motivo queda en errmsg
+        fd = self.sock.fileno()
+        iov = self.iov
+        n = len(frames)
+        sent = 0
+        while sent < n:
+            k = min(n - sent,SENDMMSG_MAX)
+            for i in range(k):
+                frame = frames[sent + i]
+                iov[i].iov_base = frame
+                iov[i].iov_len = len(frame)
+            ret = libc.sendmmsg(fd,self.msgs,k,0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                self.errmsg = os.strerror(err)
+                break
+            sent += ret
+        for i in range(min(n,SENDMMSG_MAX)):
+            iov[i].iov_base = None
+        return sent
+
+    def close(self):
+        if self.sock is not None and self.own:
+            self.sock.close()
+        self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+class pcap_fanout():
+    '''
+        Captura en varios núcleos: arranca nworkers procesos, cada uno con su propio anillo TPACKET_V3
+        (tpacket_handle) en el mismo grupo PACKET_FANOUT, de modo que el kernel reparte los paquetes entre ellos
+        según mode (PACKET_FANOUT_HASH mantiene cada flujo en el mismo proceso). Cada proceso ejecuta localmente
+        callback_fun(user, header, data) y los valores que devuelve distintos de None se envían al proceso padre
+        por lotes a través de una cola. El padre los recoge con poll() y obtiene las estadísticas agregadas con stats().
+        Los procesos se crean con fork, así que callback_fun y el estado global que use se heredan tal cual estaban
+        al llamar a start(); los resultados deben poder serializarse con pickle.
+    '''
+    def __init__(self,device:str,nworkers:int,callback_fun,snaplen:int,promisc:int,to_ms:int,user=None,
+                 filter:str=None,mode:int=PACKET_FANOUT_HASH,group_id:int=None,block_size:int=1 << 20,
+                 block_nr:int=16,zero_copy:bool=True):
+        if device is None:
+            raise ValueError("El objeto device no puede ser None")
+        if callback_fun is None:
+            raise ValueError("El objeto callback_fun no puede ser None")
+        if nworkers <= 0:
+            raise ValueError("nworkers debe ser mayor que 0")
+        self.device = device
+        self.nworkers = nworkers
+        self.callback = callback_fun
+        self.snaplen = snaplen
+        self.promisc = promisc
+        #Los procesos comprueban si deben parar cada vez que vence el timeout
+        self.to_ms = to_ms if to_ms > 0 else 100
+        self.user = user
+        self.filter = filter
+        self.mode = mode
+        self.group_id = os.getpid() & 0xffff if group_id is None else group_id
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.zero_copy = zero_copy
+        self.ctx = multiprocessing.get_context('fork')
+        self.queue = None
+        self.stop_event = None
+        self.workers = []
+        self.worker_stats = {}
+        self.errors = []
+
+    def start(self):
+        self.queue = self.ctx.Queue()
+        self.stop_event = self.ctx.Event()
+        for i in range(self.nworkers):
+            worker = self.ctx.Process(target=self.run_worker,args=(i,),daemon=True)
+            worker.start()
+            self.workers.append(worker)
 
+    def run_worker(self,idx:int):
+        #Cuerpo de cada proceso. Envía a la cola tuplas (idx, 'r', resultados), (idx, 's', estadísticas) y (idx, 'e', error)
+        results_queue = self.queue
+        errbuf = bytearray()
+        handle = tpacket_open_live(self.device,self.snaplen,self.promisc,self.to_ms,errbuf,self.block_size,
+                                   self.block_nr,self.zero_copy)
+        if handle is None:
+            results_queue.put((idx,'e',errbuf.decode('ascii','replace')))
+            return
+        results = []
+        def collect(user,header,data):
+            ret = self.callback(user,header,data)
+            if ret is not None:
+                results.append(ret)
+        try:
+            handle.set_fanout(self.group_id,self.mode)
+            if self.filter is not None and handle.setfilter(self.filter) != 0:
+                #Sin el filtro el trabajador no captura: se informa y el finally cierra el descriptor
+                results_queue.put((idx,'e',handle.geterr()))
+                return
+            last = time.monotonic()
+            while not self.stop_event.is_set():
+                if handle.dispatch(-1,collect,self.user) < 0:
+                    break
+                if results:
+                    results_queue.put((idx,'r',results))
+                    results = []
+                now = time.monotonic()
+                if now - last >= 1:
+                    results_queue.put((idx,'s',handle.stats()))
+                    last = now
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            results_queue.put((idx,'e',str(e)))
+        finally:
+            if results:
+                results_queue.put((idx,'r',results))
+            results_queue.put((idx,'s',handle.stats()))
+            handle.close()
 
+    def poll(self,timeout:float=None) -> list:
+        #Devuelve los resultados recibidos de los procesos, esperando como mucho timeout segundos por el primero
+        out = []
+        block = timeout is None or timeout > 0
+        while True:
+            try:
+                idx,kind,payload = self.queue.get(block,timeout)
+            except queue.Empty:
+                return out
+            block = False
+            if kind == 'r':
+                out.extend(payload)
+            elif kind == 's':
+                self.worker_stats[idx] = payload
+            else:
+                self.errors.append(payload)
 
+    def stats(self) -> pcap_capture_stats:
+        #Estadísticas agregadas de todos los procesos (las últimas que han enviado, como mucho de hace un segundo)
+        st = pcap_capture_stats()
+        for ws in self.worker_stats.values():
+            st.add(ws)
+        return st
 
+    def stop(self,timeout:float=5) -> list:
+        #Para los procesos y devuelve los resultados que aún quedaban en la cola
+        if self.stop_event is None:
+            return []
+        self.stop_event.set()
+        out = []
+        deadline = time.monotonic() + timeout
+        #Hay que vaciar la cola mientras terminan: un proceso no acaba hasta haber entregado lo que ha encolado
+        while any(w.is_alive() for w in self.workers) and time.monotonic() < deadline:
+            out.extend(self.poll(0.05))
+        for w in self.workers:
+            w.join(0.1)
+            if w.is_alive():
+                w.terminate()
+        out.extend(self.poll(0))
+        self.workers = []
+        self.stop_event = None
+        return out
@@ -0,0 +1,181 @@
+'''
+    replay.py
+    Reinyecta en una interfaz el tráfico de una traza pcap respetando los tiempos entre paquetes
+    originales (opcionalmente acelerados o frenados), a una tasa fija de paquetes por segundo o a la
+    máxima velocidad posible. Al terminar informa de la tasa conseguida y del error de temporización.
+
+    Para probarlo en una sola máquina se puede usar un par veth:
+        ip link add vt0 type veth peer name vt1; ip link set vt0 up; ip link set vt1 up
+        python3 replay.py --file traza.pcap --itf vt0      (y capturar en vt1 con practica1.py)
+
+    2020 EPS-UAM
+'''
+
+from rc1_pcap import *
+import sys
+import signal
+import argparse
+from argparse import RawTextHelpFormatter
+import time
+import array
+import logging
+
+ETH_FRAME_MAX = 1514
+NO_PROMISC = 0
+TO_MS = 10
+#Margen (en ns) que se espera activamente en lugar de con time.sleep, cuya precisión es de decenas de microsegundos
+SPIN_NS = 200000
+stop = False
+
+def signal_handler(nsignal,frame):
+	global stop
+	logging.info('Control C pulsado')
+	stop = True
+
+
+def wait_until(deadline):
+	#Espera hasta deadline (perf_counter_ns): duerme mientras falte más de SPIN_NS y el resto lo espera activamente.
+	#Como se espera a instantes absolutos y no a intervalos, los errores no se acumulan de un paquete al siguiente
+	remaining = deadline - time.perf_counter_ns()
+	if remaining > SPIN_NS:
+		time.sleep((remaining - SPIN_NS) / 1e9)
+	while time.perf_counter_ns() < deadline:
+		pass
+
+
+def send_batch(handle,frames):
+	#Envía un lote con pcap_inject_batch. Si un paquete falla (p.ej. demasiado corto) se descarta solo ese y se
+	#sigue con el resto del lote. Devuelve (paquetes enviados, bytes enviados, errores)
+	sent = 0
+	nbytes = 0
+	errors = 0
+	while frames:
+		n = pcap_inject_batch(handle,frames)
+		sent += n
+		nbytes += sum(len(f) for f in frames[:n])
+		if n < len(frames):
+			errors += 1
+			n += 1
+		frames = frames[n:]
+	return sent,nbytes,errors
+
+
+def replay(handle,reader,speed=1.0,pps=0,topspeed=False,batch=64,loops=1):
+	'''
+		Envía los paquetes de reader por handle. Modos:
+			-topspeed: sin esperas, en lotes de batch paquetes con pcap_inject_batch
+			-pps > 0: un paquete cada 1/pps segundos
+			-en otro caso: con los tiempos de la traza divididos por speed
+		Devuelve un diccionario con los paquetes y bytes enviados, los errores de envío, la duración y los errores
+		de temporización (ns de retraso de cada envío respecto a su instante previsto)
+	'''
+	sent = 0
+	nbytes = 0
+	errors = 0
+	lateness = array.array('q')
+	start = time.perf_counter_ns()
+	for _ in range(loops):
+		if topspeed:
+			frames = []
+			for ts_sec,ts_usec,caplen,wirelen,data in reader:
+				frames.append(bytes(data))
+				if len(frames) >= batch:
+					n,b,e = send_batch(handle,frames)
+					sent += n
+					nbytes += b
+					errors += e
+					frames = []
+					if stop:
+						break
+			if frames:
+				n,b,e = send_batch(handle,frames)
+				sent += n
+				nbytes += b
+				errors += e
+		else:
+			#Los instantes de envío se calculan desde el principio de cada vuelta, no desde el paquete anterior
+			base = time.perf_counter_ns()
+			first = None
+			i = 0
+			for ts_sec,ts_usec,caplen,wirelen,data in reader:
+				if pps > 0:
+					deadline = base + i * 1000000000 // pps
+				else:
+					ts = ts_sec * 1000000000 + ts_usec * 1000
+					if first is None:
+						first = ts
+					deadline = base + int((ts - first) / speed)
+				i += 1
+				frame = bytes(data)
+				wait_until(deadline)
+				ret = pcap_inject(handle,frame,len(frame))
+				lateness.append(time.perf_counter_ns() - deadline)
+				if ret != len(frame):
+					errors += 1
+				else:
+					sent += 1
+					nbytes += len(frame)
+				if stop:
+					break
+		if stop:
+			break
+	return {'packets': sent, 'bytes': nbytes, 'errors': errors, 'elapsed_ns': time.perf_counter_ns() - start,
+			'lateness': lateness}
+
+
+def print_report(stats):
+	elapsed = stats['elapsed_ns'] / 1e9
+	print('Enviados {} paquetes ({} bytes) en {:.3f} s, {} errores de envío'.format(stats['packets'],stats['bytes'],elapsed,stats['errors']))
+	if elapsed > 0:
+		print('Tasa conseguida: {:.0f} paquetes/s, {:.3f} Mbps'.format(stats['packets'] / elapsed,stats['bytes'] * 8 / elapsed / 1e6))
+	lateness = sorted(stats['lateness'])
+	if lateness:
+		print('Error de temporización (us): medio {:.1f}, mediana {:.1f}, p99 {:.1f}, máximo {:.1f}'.format(
+			sum(lateness) / len(lateness) / 1000,lateness[len(lateness) // 2] / 1000,
+			lateness[min(len(lateness) - 1,len(lateness) * 99 // 100)] / 1000,lateness[-1] / 1000))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Reinyecta el tráfico de una traza pcap en una interfaz',
+	formatter_class=RawTextHelpFormatter)
+	parser.add_argument('--file', dest='tracefile', default=False,help='Fichero pcap a reinyectar')
+	parser.add_argument('--itf', dest='interface', default=False,help='Interfaz por la que enviar')
+	parser.add_argument('--speed', dest='speed', type=float, default=1.0,help='Multiplicador de velocidad respecto a los tiempos originales (2: el doble de rápido)')
+	parser.add_argument('--pps', dest='pps', type=int, default=0,help='Enviar a una tasa fija de paquetes por segundo en lugar de con los tiempos de la traza')
+	parser.add_argument('--topspeed', dest='topspeed', default=False, action='store_true',help='Enviar a la máxima velocidad posible')
+	parser.add_argument('--batch', dest='batch', type=int, default=64,help='Paquetes por llamada en modo --topspeed')
+	parser.add_argument('--loops', dest='loops', type=int, default=1,help='Número de veces que se reinyecta la traza')
+	parser.add_argument('--tpacket', dest='tpacket', default=False, action='store_true',help='Enviar por un socket AF_PACKET (sendmmsg en modo --topspeed) en lugar de con libpcap')
+	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
+	args = parser.parse_args()
+
+	if args.debug:
+		logging.basicConfig(level = logging.DEBUG, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+	else:
+		logging.basicConfig(level = logging.INFO, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+
+	if args.tracefile is False or args.interface is False:
+		logging.error('Hay que especificar la traza y la interfaz')
+		parser.print_help()
+		sys.exit(-1)
+	if args.speed <= 0:
+		logging.error('El multiplicador de velocidad debe ser mayor que 0')
+		sys.exit(-1)
+
+	signal.signal(signal.SIGINT, signal_handler)
+
+	errbuf = bytearray()
+	if args.tpacket:
+		handle = tpacket_open_live(args.interface, ETH_FRAME_MAX, NO_PROMISC, TO_MS, errbuf, block_size=1 << 16, block_nr=1)
+	else:
+		handle = pcap_open_live(args.interface, ETH_FRAME_MAX, NO_PROMISC, TO_MS, errbuf)
+	if handle is None:
+		logging.error('No se ha podido abrir la interfaz {}: {}'.format(args.interface, errbuf.decode('ascii', 'replace')))
+		sys.exit(-1)
+
+	with pcap_mmap_reader(args.tracefile) as reader:
+		if reader.linktype != DLT_EN10MB:
+			logging.warning('La traza no es Ethernet (linktype {})'.format(reader.linktype))
+		stats = replay(handle, reader, args.speed, args.pps, args.topspeed, args.batch, args.loops)
+	print_report(stats)
+	pcap_close(handle)
@@ -13,6 +13,7 @@ import socket
 import struct
 import fcntl
 import time
+import asyncio
 from threading import Lock
 from expiringdict import ExpiringDict
 
@@ -54,6 +55,8 @@ cache = ExpiringDict(max_len=100, max_age_seconds=10)
 MAX_RTX = 3
 #Tiempo de espera entre intentos de ARP
 SLEEP_TIME = 1
+#Lock que serializa las resoluciones de ARPResolutionAsync (se crea en el bucle de eventos al usarse por primera vez)
+asyncLock = None
 
 def getIP(interface:str) -> int:
     '''
@@ -296,3 +299,44 @@ def ARPResolution(ip:int) -> bytes:
         return resolvedMAC
 
     return None
+
+async def ARPResolutionAsync(ip:int) -> bytes:
+    '''
+        Nombre: ARPResolutionAsync
+        Descripción: Versión para asyncio de ARPResolution, pensada para cuando el nivel Ethernet se ejecuta en un bucle
+            de eventos (startEthernetLevel con loop). Las esperas entre reenvíos se hacen con asyncio.sleep, de modo que
+            el bucle sigue recibiendo tramas (y la respuesta) mientras tanto. Como solo hay una petición en curso
+            (requestedIP), las resoluciones concurrentes se atienden de una en una mediante asyncLock.
+        Argumentos:
+            -ip: dirección IP a resolver
+        Retorno: dirección MAC resuelta o None si no hay respuesta
+    '''
+    global requestedIP,awaitingResponse,resolvedMAC,asyncLock
+    with cacheLock:
+        if ip in cache:
+            return cache[ip]
+
+    if asyncLock is None:
+        asyncLock = asyncio.Lock()
+    async with asyncLock:
+        #La resolución que tenía el cerrojo puede haber sido de esta misma IP
+        with cacheLock:
+            if ip in cache:
+                return cache[ip]
+        request = createARPRequest(ip)
+        with globalLock:
+            requestedIP = ip
+            awaitingResponse = True
+
+        nTimes = 0
+        awaiting = True
+        while awaiting and nTimes < MAX_RTX:
+            sendEthernetFrame(request, len(request), ethertype, broadcastAddr)
+            nTimes += 1
+            await asyncio.sleep(SLEEP_TIME)
+            with globalLock:
+                awaiting = awaitingResponse
+
+        if not awaiting:
+            return resolvedMAC
+        return None
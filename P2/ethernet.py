@@ -12,6 +12,8 @@ import struct
 from binascii import hexlify
 import struct 
 import threading 
+import asyncio
+import queue
 #Tamaño máximo de una trama Ethernet (para las prácticas)
 ETH_FRAME_MAX = 1514
 #Tamaño mínimo de una trama Ethernet
@@ -21,12 +23,27 @@ ETH_HDR_LEN = 14
 PROMISC = 1
 NO_PROMISC = 0
 TO_MS = 10
+#Tamaño del buffer de recepción del kernel (absorbe ráfagas mientras Python procesa)
+RX_BUFFER_SIZE = 4*1024*1024
+#Hilos de procesado por Ethertype registrado que usa startEthernetLevel por defecto (ver frameWorkerPool)
+ETH_WORKERS = 4
 #Dirección de difusión (Broadcast)
 broadcastAddr = bytes([0xFF]*6)
 #Diccionario que alamacena para un Ethertype dado qué función de callback se debe ejecutar
 upperProtos = {}
 #Bandera de nivel ethernet inicializado
 levelInitialized = False
+#Lector asyncio (pcap_async_reader) cuando el nivel Ethernet se ejecuta en un bucle de eventos en lugar de en rxThread
+asyncReader = None
+#Socket de envío por lotes (packet_tx_socket) usado por sendEthernetFrames
+txSocket = None
+#Captura multiproceso (pcap_fanout) y hilo que entrega sus resultados cuando se usa startEthernetFanout
+fanout = None
+fanoutThread = None
+#Conjunto de hilos de procesado (frameWorkerPool). Es el modo por defecto; con nWorkers=0 se usa un hilo por trama
+workerPool = None
+#Hilo de recepción (rxThread) cuando la recepción no se hace en un bucle asyncio ni en modo fanout
+recvThread = None
 
 def getHwAddr(interface:str):
     '''
@@ -63,7 +80,8 @@ def process_Ethernet_frame(us:ctypes.c_void_p,header:pcap_pkthdr,data:bytes) ->
             -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts.
             -data: bytearray con el contenido de la trama Ethernet
         Retorno:
-            -Ninguno
+            -Lo que devuelva la función de nivel superior (None si la trama se descarta). En modo fanout
+                (startEthernetFanout) los valores distintos de None se entregan a resultCallback en el proceso padre
     '''
     global upperProtos, macAddress
 
@@ -77,7 +95,7 @@ def process_Ethernet_frame(us:ctypes.c_void_p,header:pcap_pkthdr,data:bytes) ->
 
     if ethertype in upperProtos.keys():
         callback = upperProtos[ethertype]
-        callback(us, header, payload, macOrigin)
+        return callback(us, header, payload, macOrigin)
     else:
         return
 
@@ -98,26 +116,225 @@ def process_frame(us:ctypes.c_void_p,header:pcap_pkthdr,data:bytes) -> None:
     threading.Thread(target=process_Ethernet_frame,args=(us,header,data)).start()
 
 
+def process_Ethernet_frames(us:ctypes.c_void_p,packets:list) -> None:
+    '''
+        Nombre: process_Ethernet_frames
+        Descripción: Esta función procesa en orden un lote de tramas obtenido con pcap_dispatch_batch llamando
+            a process_Ethernet_frame para cada una de ellas.
+        Argumentos:
+            -us: datos de usuarios (en nuestro caso será None)
+            -packets: lista de tuplas (header, data) con las tramas del lote
+        Retorno:
+            -Ninguno
+    '''
+    for header,data in packets:
+        process_Ethernet_frame(us,header,data)
+
+
+def process_frames(us:ctypes.c_void_p,packets:list) -> None:
+    '''
+        Nombre: process_frames
+        Descripción: Equivalente a process_frame para un lote de tramas. Se crea un único hilo por lote en lugar
+            de uno por trama, manteniendo el hilo de recepción libre para seguir recibiendo.
+        Argumentos:
+            -us: datos de usuarios (en nuestro caso será None)
+            -packets: lista de tuplas (header, data) con las tramas del lote
+        Retorno:
+            -Ninguno
+    '''
+    threading.Thread(target=process_Ethernet_frames,args=(us,packets)).start()
+
+
+class frameWorkerPool():
+    ''' Conjunto fijo de hilos que ejecutan process_Ethernet_frame para las tramas que encola el hilo de recepción,
+        en lugar de crear un hilo por trama. Cada Ethertype registrado en upperProtos tiene sus propias colas y sus
+        propios hilos (se crean con su primera trama), así que los niveles superiores de un protocolo pueden quedarse
+        bloqueados sin retener las tramas de otro: un hilo IP esperando en ARPResolution no impide que el hilo ARP
+        procese la respuesta que espera. Las tramas de Ethertypes no registrados se descartan sin encolarlas.
+        Cada cola admite como mucho queueSize tramas; si está llena la trama se descarta y se cuenta.
+        Con order=None los nWorkers hilos de un Ethertype comparten una cola y sus tramas se procesan en cualquier
+        orden. Con order='mac' cada uno de esos hilos tiene su propia cola y las tramas con la misma MAC origen van
+        siempre al mismo hilo. Con order='ethertype' cada Ethertype tiene un único hilo que procesa sus tramas en el
+        orden en que llegaron.
+    '''
+    def __init__(self,nWorkers:int,queueSize:int=1024,order:str=None):
+        if order not in (None,'mac','ethertype'):
+            raise ValueError("order debe ser None, 'mac' o 'ethertype'")
+        if nWorkers <= 0:
+            raise ValueError("nWorkers debe ser mayor que 0")
+        self.nWorkers = nWorkers
+        self.queueSize = queueSize
+        self.order = order
+        #Ethertype -> (colas, hilos). Solo el hilo de recepción añade entradas; lock protege las lecturas de otros hilos
+        self.lanes = {}
+        self.lock = threading.Lock()
+        self.drops = 0
+        self.highWater = 0
+
+    def addLane(self,etherType:int) -> list:
+        nThreads = 1 if self.order == 'ethertype' else self.nWorkers
+        queues = [queue.Queue(self.queueSize) for _ in range(nThreads if self.order == 'mac' else 1)]
+        workers = []
+        for i in range(nThreads):
+            t = threading.Thread(target=self.run,args=(queues[i % len(queues)],),daemon=True)
+            workers.append(t)
+            t.start()
+        with self.lock:
+            self.lanes[etherType] = (queues,workers)
+        return queues
+
+    def put(self,us:ctypes.c_void_p,header:pcap_pkthdr,data:bytes) -> None:
+        #Se pasa a pcap_loop en lugar de process_frame: solo encola la trama en la cola que le corresponde
+        etherType = (data[12] << 8) | data[13]
+        lane = self.lanes.get(etherType)
+        if lane is None:
+            if etherType not in upperProtos:
+                return
+            queues = self.addLane(etherType)
+        else:
+            queues = lane[0]
+        if self.order == 'mac':
+            q = queues[hash(data[6:12]) % len(queues)]
+        else:
+            q = queues[0]
+        try:
+            q.put_nowait((us,header,data))
+        except queue.Full:
+            self.drops += 1
+            return
+        depth = q.qsize()
+        if depth > self.highWater:
+            self.highWater = depth
+
+    def putBatch(self,us:ctypes.c_void_p,packets:list) -> None:
+        #Equivalente a process_frames: encola cada trama de un lote de pcap_dispatch_batch
+        for header,data in packets:
+            self.put(us,header,data)
+
+    def run(self,q:queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                process_Ethernet_frame(*item)
+            except Exception:
+                logging.exception('Error al procesar una trama')
+
+    def depth(self) -> int:
+        with self.lock:
+            lanes = list(self.lanes.values())
+        return sum(q.qsize() for queues,_ in lanes for q in queues)
+
+    def stop(self,timeout:float=1.0):
+        #Termina los hilos cuando acaben con las tramas ya encoladas (sin esperar más de timeout por hilo)
+        with self.lock:
+            lanes = list(self.lanes.values())
+            self.lanes = {}
+        for queues,workers in lanes:
+            for q in queues:
+                for _ in range(len(workers) // len(queues)):
+                    try:
+                        q.put(None,timeout=timeout)
+                    except queue.Full:
+                        pass
+            for t in workers:
+                t.join(timeout)
+
+
 class rxThread(threading.Thread): 
     ''' Clase que implementa un hilo de recepción. De esta manera al iniciar el nivel Ethernet
         podemos dejar un hilo con pcap_loop que reciba los paquetes sin bloquear el envío.
-        En esta clase NO se debe modificar código
+        Con batchSize > 0 recibe por lotes con pcap_dispatch_batch. Las tramas se pasan al conjunto de hilos de
+        procesado (workerPool) o, sin él, a un hilo nuevo por trama o por lote. Es el único hilo que usa handle
+        mientras la recepción está en marcha: stop y requestFilterUpdate interrumpen el bucle con pcap_breakloop y el
+        cambio de filtro se hace desde run. Cualquier otra operación sobre handle debe seguir ese mismo esquema.
     '''
-    def __init__(self): 
+    def __init__(self,batchSize:int=0): 
         threading.Thread.__init__(self) 
+        self.batchSize = batchSize
+        self.running = True
+        self.filterPending = False
 
     def run(self): 
         global handle
         #Ejecuta pcap_loop. OJO: handle debe estar inicializado con el resultado de pcap_open_live
+        if handle is None:
+            return
+        #pcap_breakloop interrumpe el bucle tanto para parar como para cambiar el filtro (requestFilterUpdate).
+        #El filtro se instala desde este hilo, que es el único que usa handle mientras la recepción está en marcha
+        while self.running:
+            if self.filterPending:
+                self.filterPending = False
+                updateEthernetFilter()
+            if self.batchSize <= 0:
+                ret = pcap_loop(handle,-1,process_frame if workerPool is None else workerPool.put,None)
+            else:
+                ret = self.runBatches()
+            if ret != PCAP_ERROR_BREAK:
+                break
+
+    def runBatches(self) -> int:
+        #Modo por lotes: cada llamada a pcap_dispatch_batch entrega hasta batchSize tramas de una vez
+        processBatch = process_frames if workerPool is None else workerPool.putBatch
+        while True:
+            packets = []
+            ret = pcap_dispatch_batch(handle,self.batchSize,packets)
+            if packets:
+                processBatch(None,packets)
+            if ret < 0:
+                return ret
+
+    def requestFilterUpdate(self):
+        global handle
+        #Pide al hilo de recepción que reinstale el filtro BPF (ver registerCallback)
+        self.filterPending = True
         if handle is not None:
-            pcap_loop(handle,-1,process_frame,None)
+            pcap_breakloop(handle)
+
     def stop(self):
         global handle
         #Para la ejecución de pcap_loop
+        self.running = False
         if handle is not None:
             pcap_breakloop(handle)
 
 
+def buildEthernetFilter() -> str:
+    '''
+        Nombre: buildEthernetFilter
+        Descripción: Construye la expresión BPF que instala updateEthernetFilter: tramas dirigidas a nuestra MAC o a
+            difusión y con un Ethertype registrado en upperProtos.
+        Argumentos: Ninguno
+        Retorno: cadena con el filtro
+    '''
+    global macAddress,upperProtos
+    bpfFilter = '(ether dst {} or ether broadcast)'.format(':'.join(['{:02x}'.format(b) for b in macAddress]))
+    if upperProtos:
+        bpfFilter += ' and ({})'.format(' or '.join(['ether proto {}'.format(t) for t in sorted(upperProtos.keys())]))
+    return bpfFilter
+
+
+def updateEthernetFilter() -> int:
+    '''
+        Nombre: updateEthernetFilter
+        Descripción: Esta función instala en la interfaz un filtro BPF que solo deja pasar las tramas dirigidas a nuestra
+            dirección MAC o a la de difusión y cuyo Ethertype tenga registrada una función de nivel superior. De esta forma
+            el resto del tráfico se descarta en el kernel y nunca llega al intérprete. Si no se puede instalar el filtro
+            las tramas se siguen filtrando en process_Ethernet_frame.
+        Argumentos: Ninguno
+        Retorno: 0 si todo es correcto, -1 en otro caso
+    '''
+    global macAddress,handle,upperProtos
+    if handle is None:
+        return -1
+    bpfFilter = buildEthernetFilter()
+    if pcap_apply_filter(handle, bpfFilter) != 0:
+        logging.warning('No se ha podido instalar el filtro BPF "{}": {}'.format(bpfFilter, handle.geterr()))
+        return -1
+    return 0
+
+
 def registerCallback(callback_func: Callable[[ctypes.c_void_p,pcap_pkthdr,bytes],None], ethertype:int) -> None:
     '''
         Nombre: registerCallback
@@ -141,9 +358,17 @@ def registerCallback(callback_func: Callable[[ctypes.c_void_p,pcap_pkthdr,bytes]
     global upperProtos
     #upperProtos es el diccionario que relaciona función de callback y ethertype
     upperProtos[ethertype] = callback_func
+    #El filtro del kernel debe dejar pasar también el nuevo Ethertype. libpcap no admite usar el mismo handle desde
+    #varios hilos: el filtro lo instala el hilo que está recibiendo (el de rxThread o el del bucle asyncio)
+    if levelInitialized:
+        if asyncReader is not None:
+            asyncReader.loop.call_soon_threadsafe(updateEthernetFilter)
+        elif recvThread is not None:
+            recvThread.requestFilterUpdate()
 
 
-def startEthernetLevel(interface:str) -> int:
+def startEthernetLevel(interface:str,batchSize:int=0,backend:str='pcap',loop:asyncio.AbstractEventLoop=None,
+                       nWorkers:int=ETH_WORKERS,queueSize:int=1024,order:str=None) -> int:
     '''
         Nombre: startEthernetLevel
         Descripción: Esta función recibe el nombre de una interfaz de red e inicializa el nivel Ethernet. 
@@ -151,13 +376,24 @@ def startEthernetLevel(interface:str) -> int:
                 -Comprobar si el nivel Ethernet ya estaba inicializado (mediante una variable global). Si ya estaba inicializado devolver -1.
                 -Obtener y almacenar en una variable global la dirección MAC asociada a la interfaz que se especifica
                 -Abrir la interfaz especificada en modo promiscuo usando la librería rc1-pcap
+                -Instalar el filtro BPF de nuestra MAC/difusión y Ethertypes registrados (updateEthernetFilter)
                 -Arrancar un hilo de recepción (rxThread) que llame a la función pcap_loop. 
                 -Si todo es correcto marcar la variable global de nivel incializado a True
         Argumentos:
             -Interface: nombre de la interfaz sobre la que inicializar el nivel Ethernet
+            -batchSize: si es mayor que 0 las tramas se reciben en lotes de hasta batchSize tramas (pcap_dispatch_batch)
+            -backend: 'pcap' para capturar con libpcap o 'tpacket' para usar el anillo TPACKET_V3 (tpacket_open_live)
+            -loop: si no es None la recepción se hace en este bucle asyncio (pcap_async_reader) en lugar de en rxThread.
+                Las tramas se procesan en el propio bucle, así que las funciones de nivel superior no deben bloquear.
+                Debe llamarse desde el hilo del bucle
+            -nWorkers: hilos fijos por Ethertype registrado que procesan las tramas recibidas (frameWorkerPool). Con 0
+                se vuelve a crear un hilo nuevo por trama
+            -queueSize: tramas que admite cada cola del conjunto de hilos antes de empezar a descartar
+            -order: None (sin orden), 'mac' o 'ethertype' para procesar en orden las tramas de la misma MAC origen
+                o del mismo Ethertype (ver frameWorkerPool)
         Retorno: 0 si todo es correcto, -1 en otro caso
     '''
-    global macAddress,handle,levelInitialized,recvThread
+    global macAddress,handle,levelInitialized,recvThread,asyncReader,txSocket,workerPool
     handle = None
     #TODO: implementar aquí la inicialización de la interfaz y de las variables globales
     if levelInitialized:
@@ -166,20 +402,109 @@ def startEthernetLevel(interface:str) -> int:
     try:
         macAddress = getHwAddr(interface)
         errbuf = bytearray()
-        handle = pcap_open_live(interface, ETH_FRAME_MAX, PROMISC, TO_MS, errbuf)
+        #Modo inmediato: las tramas (p.ej. respuestas ARP) se entregan al llegar, sin esperar a que venza TO_MS
+        if backend == 'tpacket':
+            #Las tramas se copian: el hilo de recepción las pasa a otros hilos y el bloque del anillo se reutiliza
+            handle = tpacket_open_live(interface, ETH_FRAME_MAX, PROMISC, TO_MS, errbuf, zero_copy=False)
+        else:
+            handle = pcap_open_live_ext(interface, ETH_FRAME_MAX, PROMISC, TO_MS, errbuf, RX_BUFFER_SIZE, True)
+        if handle is None:
+            logging.error('Error al abrir la interfaz {}: {}'.format(interface, errbuf.decode('ascii', 'replace')))
+            return -1
+        updateEthernetFilter()
+        if backend != 'tpacket':
+            #Con tpacket se envía por lotes por el propio socket de captura (pcap_inject_batch)
+            try:
+                txSocket = packet_tx_socket(interface)
+            except OSError:
+                txSocket = None
         levelInitialized = True
 
+        if loop is not None:
+            if batchSize > 0:
+                asyncReader = pcap_async_reader(handle,process_Ethernet_frames,None,loop,batchSize)
+            else:
+                asyncReader = pcap_async_reader(handle,process_Ethernet_frame,None,loop)
+            asyncReader.start()
+            return 0
+
+        if nWorkers > 0:
+            workerPool = frameWorkerPool(nWorkers, queueSize, order)
+
         #Una vez hemos abierto la interfaz para captura y hemos inicializado las variables globales (macAddress, handle y levelInitialized) arrancamos
         #el hilo de recepción
-        recvThread = rxThread()
+        recvThread = rxThread(batchSize)
         recvThread.daemon = True
         recvThread.start()
         return 0
     except:
         return -1
 
+class fanoutResultThread(threading.Thread):
+    ''' Hilo del proceso padre en modo fanout: recoge los resultados de los procesos de captura y llama a
+        resultCallback con cada uno de ellos.
+    '''
+    def __init__(self,fanout:pcap_fanout,resultCallback):
+        threading.Thread.__init__(self)
+        self.fanout = fanout
+        self.resultCallback = resultCallback
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for result in self.fanout.poll(0.1):
+                self.resultCallback(result)
+        #Resultados que quedaban en la cola al parar los procesos
+        for result in self.fanout.stop():
+            self.resultCallback(result)
+
+    def stop(self):
+        self.running = False
+
+
+def startEthernetFanout(interface:str,nworkers:int,resultCallback,mode:int=PACKET_FANOUT_HASH) -> int:
+    '''
+        Nombre: startEthernetFanout
+        Descripción: Inicializa el nivel Ethernet en modo multiproceso. Se arrancan nworkers procesos de captura en el
+            mismo grupo PACKET_FANOUT (pcap_fanout); cada uno ejecuta process_Ethernet_frame y las funciones de nivel
+            superior registradas localmente, y lo que estas devuelven (si no es None) se entrega a resultCallback en un
+            hilo del proceso padre. Las funciones de nivel superior deben registrarse ANTES de llamar a esta función,
+            ya que los procesos heredan upperProtos al arrancar, y no deben depender de estado compartido con el
+            proceso padre (por ejemplo ARP, cuyo estado de resolución vive en el padre, debe usar startEthernetLevel).
+            El envío de tramas se hace con sendEthernetFrames.
+        Argumentos:
+            -interface: nombre de la interfaz
+            -nworkers: número de procesos de captura
+            -resultCallback: función que recibe cada resultado en el proceso padre
+            -mode: modo de reparto de PACKET_FANOUT (por defecto por hash de flujo)
+        Retorno: 0 si todo es correcto, -1 en otro caso
+    '''
+    global macAddress,handle,levelInitialized,txSocket,fanout,fanoutThread
+    if levelInitialized:
+        return -1
+
+    try:
+        macAddress = getHwAddr(interface)
+        handle = None
+        fanout = pcap_fanout(interface, nworkers, process_Ethernet_frame, ETH_FRAME_MAX, PROMISC, TO_MS,
+                             filter=buildEthernetFilter(), mode=mode, zero_copy=False)
+        fanout.start()
+        try:
+            txSocket = packet_tx_socket(interface)
+        except OSError:
+            txSocket = None
+        levelInitialized = True
+        fanoutThread = fanoutResultThread(fanout, resultCallback)
+        fanoutThread.daemon = True
+        fanoutThread.start()
+        return 0
+    except:
+        fanout = None
+        return -1
+
+
 def stopEthernetLevel()->int:
-    global macAddress,handle,levelInitialized,recvThread
+    global macAddress,handle,levelInitialized,recvThread,asyncReader,txSocket,fanout,fanoutThread,workerPool
     '''
         Nombre: stopEthernetLevel
         Descripción_ Esta función parará y liberará todos los recursos necesarios asociados al nivel Ethernet.
@@ -191,8 +516,26 @@ def stopEthernetLevel()->int:
         Retorno: 0 si todo es correcto y -1 en otro caso
     '''
     try:
-        recvThread.stop()
+        if fanout is not None:
+            fanoutThread.stop()
+            fanoutThread.join()
+            fanoutThread = None
+            fanout = None
+        elif asyncReader is not None:
+            asyncReader.stop()
+            asyncReader = None
+        else:
+            recvThread.stop()
+            #pcap_close libera el buffer de lotes y el trampolín que el hilo puede estar usando todavía
+            recvThread.join()
+            recvThread = None
+            if workerPool is not None:
+                workerPool.stop()
+                workerPool = None
 
+        if txSocket is not None:
+            txSocket.close()
+            txSocket = None
         if handle is not None:
             pcap_close(handle)
 
@@ -201,6 +544,51 @@ def stopEthernetLevel()->int:
     except:
         return -1
 
+def getEthernetStats() -> pcap_capture_stats:
+    '''
+        Nombre: getEthernetStats
+        Descripción: Esta función devuelve una instantánea de las estadísticas de recepción del nivel Ethernet
+            (paquetes recibidos y descartados por libpcap, paquetes entregados a Python e histograma de tiempos
+            de procesado). Con un conjunto de hilos de procesado incluye también la ocupación de sus colas, su máximo
+            y las tramas descartadas por tener la cola llena. Puede llamarse desde cualquier hilo mientras el hilo de
+            recepción está en marcha.
+        Argumentos: Ninguno
+        Retorno: objeto pcap_capture_stats o None si el nivel Ethernet no está inicializado
+    '''
+    global handle,fanout,workerPool
+    if not levelInitialized:
+        return None
+    if fanout is not None:
+        return fanout.stats()
+    if handle is None:
+        return None
+    stats = pcap_get_stats(handle)
+    pool = workerPool
+    if pool is not None:
+        stats.queue_depth = pool.depth()
+        stats.queue_high = pool.highWater
+        stats.queue_drops = pool.drops
+    return stats
+
+def buildEthernetFrame(data:bytes,len:int,etherType:int,dstMac:bytes) -> bytes:
+    '''
+        Nombre: buildEthernetFrame
+        Descripción: Construye una trama Ethernet (cabecera + payload) con nuestra dirección MAC como origen,
+            rellenando con 0s hasta ETH_FRAME_MIN si es necesario.
+        Argumentos: los mismos que sendEthernetFrame
+        Retorno: la trama en bytes o None si supera ETH_FRAME_MAX
+    '''
+    global macAddress
+    frameLen = ETH_HDR_LEN + len
+    if frameLen > ETH_FRAME_MAX:
+        return None
+
+    frame = dstMac + macAddress + struct.pack('!H', etherType) + data
+
+    if frameLen < ETH_FRAME_MIN:
+        frame = frame.ljust(ETH_FRAME_MIN, b'\0')
+    return frame
+
 def sendEthernetFrame(data:bytes,len:int,etherType:int,dstMac:bytes) -> int:
     '''
         Nombre: sendEthernetFrame
@@ -219,16 +607,11 @@ def sendEthernetFrame(data:bytes,len:int,etherType:int,dstMac:bytes) -> int:
         Retorno: 0 si todo es correcto, -1 en otro caso
     '''
     global macAddress,handle
-    frameLen = ETH_HDR_LEN + len
-    if frameLen > ETH_FRAME_MAX:
+    frame = buildEthernetFrame(data,len,etherType,dstMac)
+    if frame is None:
         return -1
 
-    frame = dstMac + macAddress + struct.pack('!H', etherType) + data
-
-    if frameLen < ETH_FRAME_MIN:
-        frame = frame.ljust(ETH_FRAME_MIN, b'\0')
-        frameLen = ETH_FRAME_MIN
-
+    frameLen = max(ETH_HDR_LEN + len, ETH_FRAME_MIN)
     try:
         ret = pcap_inject(handle, frame, frameLen)
         if ret != frameLen:
@@ -238,3 +621,34 @@ def sendEthernetFrame(data:bytes,len:int,etherType:int,dstMac:bytes) -> int:
         return 0
     except:
         return -1
+
+def sendEthernetFrames(frames:list) -> int:
+    '''
+        Nombre: sendEthernetFrames
+        Descripción: Versión por lotes de sendEthernetFrame. Construye todas las tramas y las envía de una vez con
+            sendmmsg sobre un socket AF_PACKET (txSocket), con una única llamada al sistema por cada SENDMMSG_MAX
+            tramas. Si no hay socket de envío se usa pcap_inject_batch (sendmmsg con el backend tpacket, pcap_inject
+            trama a trama con libpcap). Si alguna trama es demasiado grande no se envía ninguna.
+        Argumentos:
+            -frames: lista de tuplas (data, etherType, dstMac) con los mismos significados que en sendEthernetFrame
+        Retorno: número de tramas enviadas o -1 si hay algún error
+    '''
+    global handle,txSocket
+    built = []
+    for data,etherType,dstMac in frames:
+        frame = buildEthernetFrame(data,len(data),etherType,dstMac)
+        if frame is None:
+            return -1
+        built.append(frame)
+
+    try:
+        if txSocket is not None:
+            sent = txSocket.send_batch(built)
+        else:
+            sent = pcap_inject_batch(handle,built)
+        if sent != len(built):
+            logging.error('Enviadas {} de {} tramas'.format(sent, len(built)))
+            return -1
+        return sent
+    except:
+        return -1
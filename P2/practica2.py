@@ -8,6 +8,7 @@
 from ethernet import *
 from arp import *
 import sys
+import os
 import binascii
 import signal
 import argparse
@@ -16,9 +17,77 @@ from argparse import RawTextHelpFormatter
 import time
 import logging
 import socket
+import asyncio
 
 
+def printResolution(msg,ret):
+	if ret is not None:
+		print('{}: {}'.format(msg,':'.join(['{:02X}'.format(b) for b in ret])))
+	else:
+		print('{}: Dirección no encontrada'.format(msg))
+
+async def resolve(msg):
+	try:
+		ip=struct.unpack('!I',socket.inet_aton(msg))[0]
+	except OSError:
+		print('Formato de IP incorrecta\n')
+		return
+	printResolution(msg,await ARPResolutionAsync(ip))
 
+async def asyncMain(interface):
+	''' Versión con asyncio: la recepción Ethernet, la lectura del teclado y las resoluciones ARP comparten
+		un único bucle de eventos. Cada línea puede contener varias IPs, que se resuelven como tareas independientes.
+	'''
+	loop = asyncio.get_running_loop()
+	if startEthernetLevel(interface,loop=loop) != 0:
+		logging.error('Ethernet no inicializado')
+		return -1
+	#initARP hace una resolución bloqueante (ARP gratuito): se ejecuta fuera del bucle para que siga recibiendo
+	if await loop.run_in_executor(None,initARP,interface) == -1:
+		logging.error('ARP no inicializado')
+		stopEthernetLevel()
+		return -1
+	#Se lee el descriptor con os.read y se parte en líneas a mano: sys.stdin tiene su propio buffer y un readline
+	#podría dejar en él líneas que el bucle no vería hasta que llegase más entrada
+	lines = asyncio.Queue()
+	fd = sys.stdin.fileno()
+	pending = bytearray()
+	def readStdin():
+		data = os.read(fd,4096)
+		if not data:
+			loop.remove_reader(fd)
+			if pending:
+				lines.put_nowait(pending.decode('utf-8','replace'))
+			lines.put_nowait('')
+			return
+		pending.extend(data)
+		while True:
+			end = pending.find(b'\n')
+			if end < 0:
+				break
+			lines.put_nowait(pending[:end + 1].decode('utf-8','replace'))
+			del pending[:end + 1]
+	loop.add_reader(fd,readStdin)
+	tasks = set()
+	print('Introduce las direcciones IP a resolver (q para salir, p para mostrar la caché y s para mostrar estadísticas):')
+	while True:
+		line = await lines.get()
+		if line == '' or line.strip() == 'q':
+			break
+		for msg in line.split():
+			if msg == 'p':
+				printCache()
+			elif msg == 's':
+				print(getEthernetStats())
+			else:
+				task = asyncio.create_task(resolve(msg))
+				tasks.add(task)
+				task.add_done_callback(tasks.discard)
+	loop.remove_reader(fd)
+	for task in tasks:
+		task.cancel()
+	print(getEthernetStats())
+	return stopEthernetLevel()
 
 
 if __name__ == "__main__":
@@ -26,6 +95,9 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Esta práctica ejecuta resoluciones ARP. Dada una dirección IP devuelve cual es la MAC asociada en la LAN actual',
 	formatter_class=RawTextHelpFormatter)
 	parser.add_argument('--itf', dest='interface', default=False,help='Interfaz a abrir')
+	parser.add_argument('--asyncio', dest='asyncio', default=False, action='store_true',help='Ejecutar la recepción y las resoluciones en un bucle asyncio en lugar de hilos')
+	parser.add_argument('--workers', dest='workers', type=int, default=ETH_WORKERS,help='Hilos fijos que procesan las tramas recibidas de cada Ethertype (por defecto {}, 0: un hilo por trama)'.format(ETH_WORKERS))
+	parser.add_argument('--order', dest='order', choices=['mac','ethertype'], default=None,help='Procesar en orden las tramas de la misma MAC origen o del mismo Ethertype')
 	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
 	args = parser.parse_args()
 
@@ -39,10 +111,14 @@ if __name__ == "__main__":
 		parser.print_help()
 		sys.exit(-1)
 
-	
+	if args.asyncio:
+		try:
+			sys.exit(asyncio.run(asyncMain(args.interface)))
+		except KeyboardInterrupt:
+			sys.exit(0)
 	
 	#Inicializamos el nivel Ethernet en la interfaz especificada
-	if (startEthernetLevel(args.interface) != 0):
+	if (startEthernetLevel(args.interface, nWorkers=args.workers, order=args.order) != 0):
 		logging.error('Ethernet no inicializado')
 		sys.exit(-1)
 	#Inicializamos ARP. Si no podemos inicializar salimos.
@@ -55,11 +131,13 @@ if __name__ == "__main__":
 	'''
 	while True:
 		try:
-			msg = input('Introduce la dirección IP a resolver (q para salir y p para mostrar la caché):\n')
+			msg = input('Introduce la dirección IP a resolver (q para salir, p para mostrar la caché y s para mostrar estadísticas):\n')
 			if msg == 'q':
 				break
 			elif msg == 'p':
 				printCache()
+			elif msg == 's':
+				print(getEthernetStats())
 			else:
 				try:
 					#Convertimos la dirección IP en formato textual (X.X.X.X) a un entero de 32 bits.
@@ -78,6 +156,7 @@ if __name__ == "__main__":
 			print('\n')
 			break
 	logging.info('Cerrando ....')
+	print(getEthernetStats())
 	#Paramos el nivel Ethernet
 	if(stopEthernetLevel()!=0):
 		logging.error('Parando nivel Ethernet')
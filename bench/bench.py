@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+'''
+    bench.py
+    Pruebas de rendimiento de los caminos críticos de captura, volcado y análisis. Se ejecutan sin red sobre
+    trazas sintéticas generadas con P1/pcapgen.py (siempre con la misma semilla) y cada prueba se lanza en un
+    proceso hijo para medir su pico de memoria por separado. El resultado es una línea JSON por prueba con
+    paquetes/s, ns/paquete y pico de memoria, o con el error si falta alguna dependencia (libpcap, expiringdict,
+    matplotlib...), de modo que las ejecuciones se pueden comparar entre versiones.
+
+    Ejemplo:
+        python3 bench/bench.py --count 500000 --out resultados.jsonl
+        python3 bench/bench.py --only mmap_reader,pcap_writer --repeat 5
+'''
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import json
+import time
+import resource
+import platform
+import multiprocessing
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for d in ('P3','P2','P1'):
+    sys.path.insert(0,os.path.join(ROOT,d))
+
+#Semilla y mezcla de tráfico fijas: todas las ejecuciones miden exactamente la misma traza
+SEED = 2020
+MIX = 'tcp:6,udp:3,arp:1'
+
+
+def load_frames(fname):
+    #Carga la traza en memoria como lista de (header, bytes) para las pruebas que no miden la lectura
+    from rc1_pcap import pcap_mmap_reader,pcap_pkthdr,timeval
+    frames = []
+    with pcap_mmap_reader(fname) as reader:
+        for ts_sec,ts_usec,caplen,wirelen,data in reader:
+            frames.append((pcap_pkthdr(wirelen,caplen,timeval(ts_sec,ts_usec)),bytes(data)))
+    return frames
+
+
+def tshark_fields(frames,field):
+    #Simula la salida de tshark -T fields que procesan las funciones de practica3 (columnas separadas por tabuladores)
+    lines = []
+    for header,data in frames:
+        if data[12:14] != b'\x08\x00':
+            continue
+        if field == 'ip.src':
+            key = '.'.join(str(b) for b in data[26:30])
+        else:
+            key = '{:.6f}'.format(header.ts.tv_sec + header.ts.tv_usec / 1e6)
+        lines.append('{}\t{}'.format(key,header.len))
+    return '\n'.join(lines) + '\n'
+
+
+'''
+    Cada prueba recibe la ruta de la traza, prepara lo que necesite (fuera de la medida de tiempo) y devuelve
+    una función sin argumentos que ejecuta la parte medida y devuelve el número de paquetes procesados.
+'''
+
+def bench_pcap_loop(fname):
+    from rc1_pcap import pcap_open_offline,pcap_loop,pcap_close
+    def run():
+        errbuf = bytearray()
+        handle = pcap_open_offline(fname,errbuf)
+        if handle is None:
+            raise RuntimeError(errbuf.decode('ascii','replace'))
+        count = [0]
+        def callback(us,header,data):
+            count[0] += 1
+        pcap_loop(handle,-1,callback,None)
+        pcap_close(handle)
+        return count[0]
+    return run
+
+
+def bench_pcap_dispatch_batch(fname):
+    from rc1_pcap import pcap_open_offline,pcap_dispatch_batch,pcap_close
+    def run():
+        errbuf = bytearray()
+        handle = pcap_open_offline(fname,errbuf)
+        if handle is None:
+            raise RuntimeError(errbuf.decode('ascii','replace'))
+        n = 0
+        while True:
+            packets = []
+            if pcap_dispatch_batch(handle,1024,packets,False) <= 0 and not packets:
+                break
+            n += len(packets)
+        pcap_close(handle)
+        return n
+    return run
+
+
+def bench_mmap_reader(fname):
+    from rc1_pcap import pcap_mmap_reader
+    def run():
+        n = 0
+        with pcap_mmap_reader(fname) as reader:
+            for rec in reader:
+                n += 1
+            rec = None
+        return n
+    return run
+
+
+def bench_mmap_columns(fname):
+    from rc1_pcap import pcap_mmap_reader,pcap_columns,PCAP_FILE_HDR_LEN
+    def run():
+        n = 0
+        cols = pcap_columns()
+        with pcap_mmap_reader(fname) as reader:
+            off = PCAP_FILE_HDR_LEN
+            while True:
+                off = reader.columns(cols,off,max_pkts=4096)
+                if not len(cols):
+                    break
+                n += len(cols)
+            cols.clear()
+        return n
+    return run
+
+
+def bench_pcap_dump(fname):
+    from rc1_pcap import pcap_open_dead,pcap_dump_open,pcap_dump,pcap_dump_close,pcap_close,DLT_EN10MB
+    frames = load_frames(fname)
+    out = fname + '.dump.pcap'
+    def run():
+        handle = pcap_open_dead(DLT_EN10MB,1514)
+        dumper = pcap_dump_open(handle,out)
+        for header,data in frames:
+            pcap_dump(dumper,header,data)
+        pcap_dump_close(dumper)
+        pcap_close(handle)
+        os.unlink(out)
+        return len(frames)
+    return run
+
+
+def bench_pcap_writer(fname):
+    from rc1_pcap import pcap_writer
+    frames = load_frames(fname)
+    out = fname + '.writer.pcap'
+    def run():
+        with pcap_writer(out) as writer:
+            for header,data in frames:
+                writer.dump(header,data)
+        os.unlink(out)
+        return len(frames)
+    return run
+
+
+def bench_process_Ethernet_frame(fname):
+    import ethernet
+    frames = load_frames(fname)
+    #Las tramas de la traza no van a nuestra MAC: se simula que todas lo son para medir el reparto completo
+    ethernet.macAddress = frames[0][1][0:6]
+    frames = [(h,ethernet.macAddress + d[6:]) for h,d in frames]
+    def upper(us,header,payload,srcMac):
+        return None
+    ethernet.upperProtos = {0x0800: upper,0x0806: upper}
+    def run():
+        process = ethernet.process_Ethernet_frame
+        for header,data in frames:
+            process(None,header,data)
+        return len(frames)
+    return run
+
+
+def bench_process_arp_frame(fname):
+    import arp
+    frames = [(h,d) for h,d in load_frames(fname) if d[12:14] == b'\x08\x06']
+    #IP propia que no aparece en la traza: se mide el análisis de cada trama sin generar respuestas
+    arp.myIP = 0xfffffffe
+    def run():
+        process = arp.process_arp_frame
+        for header,data in frames:
+            process(None,header,data[14:],data[6:12])
+        return len(frames)
+    return run
+
+
+def bench_cuentaTopBytes(fname):
+    import practica3
+    salida = tshark_fields(load_frames(fname),'ip.src')
+    n = salida.count('\n')
+    def run():
+        practica3.cuentaTopBytes(salida)
+        return n
+    return run
+
+
+def bench_topDict(fname):
+    import practica3
+    count = {}
+    for header,data in load_frames(fname):
+        count[data[6:12]] = count.get(data[6:12],0) + header.len
+    def run():
+        #topDict borra las entradas que devuelve: se le pasa una copia
+        practica3.topDict(dict(count),5)
+        return len(count)
+    return run
+
+
+def bench_calcularECDF(fname):
+    import practica3
+    sizes = [header.len for header,data in load_frames(fname)]
+    def run():
+        practica3.calcularECDF(list(sizes))
+        return len(sizes)
+    return run
+
+
+def bench_tsharkToSerie(fname):
+    import practica3
+    salida = tshark_fields(load_frames(fname),'frame.time_epoch')
+    n = salida.count('\n')
+    def run():
+        practica3.tsharkToSerie(salida)
+        return n
+    return run
+
+
+BENCHMARKS = {
+    'pcap_loop': bench_pcap_loop,
+    'pcap_dispatch_batch': bench_pcap_dispatch_batch,
+    'mmap_reader': bench_mmap_reader,
+    'mmap_columns': bench_mmap_columns,
+    'pcap_dump': bench_pcap_dump,
+    'pcap_writer': bench_pcap_writer,
+    'process_Ethernet_frame': bench_process_Ethernet_frame,
+    'process_arp_frame': bench_process_arp_frame,
+    'cuentaTopBytes': bench_cuentaTopBytes,
+    'topDict': bench_topDict,
+    'calcularECDF': bench_calcularECDF,
+    'tsharkToSerie': bench_tsharkToSerie,
+}
+
+
+def run_child(name,fname,repeat,conn):
+    #Cuerpo del proceso hijo: prepara la prueba, la ejecuta repeat veces y envía el mejor resultado
+    result = {'bench': name}
+    try:
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        run = BENCHMARKS[name](fname)
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter_ns()
+            n = run()
+            elapsed = time.perf_counter_ns() - t0
+            if best is None or elapsed < best:
+                best = elapsed
+        result['packets'] = n
+        result['seconds'] = best / 1e9
+        result['pkts_per_s'] = n * 1e9 / best if best else None
+        result['ns_per_pkt'] = best / n if n else None
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['rss_start_kb'] = rss0
+        result['error'] = None
+    except BaseException as e:
+        result['error'] = '{}: {}'.format(type(e).__name__,e)
+        result['traceback'] = traceback.format_exc(limit=3)
+    conn.send(result)
+    conn.close()
+
+
+def run_benchmark(name,fname,repeat):
+    ctx = multiprocessing.get_context('fork')
+    parent,child = ctx.Pipe(False)
+    proc = ctx.Process(target=run_child,args=(name,fname,repeat,child))
+    proc.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {'bench': name,'error': 'El proceso terminó con código {}'.format(proc.exitcode)}
+    proc.join()
+    return result
+
+
+def generate_trace(workdir,count):
+    #Genera (una sola vez) la traza sintética de la prueba
+    fname = os.path.join(workdir,'bench_{}_{}.pcap'.format(SEED,count))
+    if not os.path.exists(fname):
+        import pcapgen
+        pcapgen.generate(fname + '.tmp',count,seed=SEED,mix=MIX,flows=1000)
+        os.replace(fname + '.tmp',fname)
+    return fname
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pruebas de rendimiento de captura, volcado y análisis sobre trazas sintéticas',
+    formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--count', dest='count', type=int, default=200000,help='Paquetes de la traza sintética')
+    parser.add_argument('--workdir', dest='workdir', default='/tmp/rc1_bench',help='Directorio para las trazas generadas')
+    parser.add_argument('--only', dest='only', default=None,help='Lista de pruebas separadas por comas (por defecto todas): ' + ','.join(BENCHMARKS))
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3,help='Repeticiones de cada prueba (se informa de la más rápida)')
+    parser.add_argument('--out', dest='out', default=None,help='Fichero al que añadir los resultados (por defecto la salida estándar)')
+    args = parser.parse_args()
+
+    names = list(BENCHMARKS) if args.only is None else args.only.split(',')
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Prueba desconocida: {}'.format(name),file=sys.stderr)
+            sys.exit(-1)
+
+    out = open(args.out,'a') if args.out else sys.stdout
+    common = {'time': time.time(),'python': platform.python_version(),'count': args.count}
+    os.makedirs(args.workdir,exist_ok=True)
+    try:
+        fname = generate_trace(args.workdir,args.count)
+    except BaseException as e:
+        out.write(json.dumps(dict(common,bench='generate',error='{}: {}'.format(type(e).__name__,e))) + '\n')
+        sys.exit(-1)
+    for name in names:
+        out.write(json.dumps(dict(common,**run_benchmark(name,fname,args.repeat))) + '\n')
+        out.flush()